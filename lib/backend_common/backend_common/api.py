@@ -3,9 +3,11 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
 import pathlib
 
 import connexion
+import connexion.decorators.response
 import flask
 import werkzeug
 
@@ -33,6 +35,34 @@ def common_error_handler(exception):
     )
 
 
+class ResponseValidator(connexion.decorators.response.ResponseValidator):
+    '''Validate the responses of the API, but the streamed ones (e.g. large
+       text or gzip-encoded files), which connexion would read in memory
+       before validating them as JSON.
+    '''
+
+    def __call__(self, function):
+
+        @functools.wraps(function)
+        def wrapper(request):
+            response = function(request)
+            if isinstance(response, flask.Response) and response.is_streamed:
+                return response
+
+            try:
+                connexion_response = self.operation.api.get_connexion_response(response, self.mimetype)
+                self.validate_response(
+                    connexion_response.body, connexion_response.status_code,
+                    connexion_response.headers, request.url)
+            except (connexion.exceptions.NonConformingResponseBody,
+                    connexion.exceptions.NonConformingResponseHeaders) as e:
+                return self.operation.api.get_response(connexion.problem(500, e.reason, e.message))
+
+            return response
+
+        return wrapper
+
+
 class Api:
     '''TODO: add description
        TODO: annotate class
@@ -85,7 +115,7 @@ class Api:
             auth_all_paths=auth_all_paths,
             debug=app.debug,
             resolver_error_handler=resolver_error_handler,
-            validator_map=validator_map,
+            validator_map=dict(dict(response=ResponseValidator), **(validator_map or {})),
             pythonic_params=pythonic_params,
             pass_context_arg_name=pass_context_arg_name,
             options=options,
@@ -3,8 +3,8 @@
 
 let
 
-  inherit (releng_pkgs.lib) mkBackend fromRequirementsFile filterSource mysql2postgresql;
-  inherit (releng_pkgs.pkgs) writeScript;
+  inherit (releng_pkgs.lib) mkBackend mkTaskclusterHook fromRequirementsFile filterSource mysql2postgresql;
+  inherit (releng_pkgs.pkgs) writeScript writeText;
   inherit (releng_pkgs.pkgs.lib) fileContents;
   inherit (releng_pkgs.tools) pypi2nix;
 
@@ -22,6 +22,37 @@ let
   python = import ./requirements.nix { inherit (releng_pkgs) pkgs; };
   project_name = "mapper/api";
 
+  mkCronJob = { schedule, command }:
+    builtins.listToAttrs (
+      map (channel:
+        { name = channel;
+          value =
+            let
+              hook_name = "${self.name}_${command}_${channel}";
+              hook = mkTaskclusterHook {
+                name = hook_name;
+                owner = "rgarbas@mozilla.com";
+                inherit schedule;
+                scopes =
+                  [ "secrets:get:repo:github.com/mozilla-releng/services:branch:${channel}"
+                    "queue:create-task:aws-provisioner-v1/releng-svc"
+                  ];
+                taskImage = self.docker;
+                taskEnv = {
+                  TASKCLUSTER_SECRET = "repo:github.com/mozilla-releng/services:branch:${channel}";
+                };
+                taskCapabilities = {};
+                taskCommand = [
+                  "flask"
+                  command
+                ];
+                deadline = "4 hours";
+                maxRunTime = 4 * 60 * 60;
+              };
+            in
+              writeText "taskcluster-hook-${hook_name}.json" (builtins.toJSON hook);
+        }) ["testing" "staging" "production"]);
+
   self = mkBackend {
     inherit python project_name;
     version = fileContents ./VERSION;
@@ -41,6 +72,11 @@ let
       "-"
     ];
     passthru = {
+      cron = {
+        rebuild_snapshots = mkCronJob { schedule = [ "*/15 * * * *" ];  # every 15 min;
+                                        command = "rebuild-snapshots";
+                                      };
+      };
       migrate = mysql2postgresql {
         inherit beforeSQL afterSQL;
         inherit (self) name;
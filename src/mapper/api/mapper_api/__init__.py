@@ -6,8 +6,14 @@
 import os
 
 import backend_common
+import cli_common.log
+import mapper_api.api
+import mapper_api.cli
 import mapper_api.config
-import mapper_api.models  # noqa
+import mapper_api.models
+import mapper_api.projects
+
+logger = cli_common.log.get_logger(__name__)
 
 
 def create_app(config=None):
@@ -21,9 +27,31 @@ def create_app(config=None):
             'cors',
             'api',
             'auth',
+            'cache',
             'db',
         ],
     )
+    # must be set before the first query, which memoizes the storage type of
+    # the SHA columns
+    mapper_api.models.BINARY_SHAS = app.config.get('BINARY_SHAS', False)
+
     # TODO: add predefined api.yml
     app.api.register(os.path.join(os.path.dirname(__file__), 'api.yml'))
+    app.before_request(mapper_api.api.stream_request_body)
+
+    with app.app_context():
+        try:
+            mapper_api.projects.registry.load(app.db.session)
+        except Exception as e:
+            # e.g. the database isn't reachable yet: the registry is loaded
+            # again on the first lookup of a project
+            logger.warning('Failed to load projects', error=e)
+        finally:
+            app.db.session.remove()
+
+    app.cli.add_command(mapper_api.cli.cmd_rebuild_snapshots, 'rebuild-snapshots')
+    app.cli.add_command(mapper_api.cli.cmd_benchmark_lookups, 'benchmark-lookups')
+    app.cli.add_command(mapper_api.cli.cmd_benchmark_endpoints, 'benchmark-endpoints')
+    app.cli.add_command(mapper_api.cli.cmd_convert_shas, 'convert-shas')
+
     return app
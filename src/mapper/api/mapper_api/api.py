@@ -3,7 +3,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import bisect
 import calendar
+import codecs
 import re
 import time
 import typing
@@ -11,15 +13,23 @@ import typing
 import dateutil.parser
 import flask
 import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql
 import werkzeug.exceptions
 
 import backend_common.auth
 import cli_common
+import mapper_api.cache
 import mapper_api.config
 import mapper_api.models
+import mapper_api.projects
+import mapper_api.snapshots
 
 logger = cli_common.log.get_logger(__name__)
 
+MAPPING_LINE_REGEX = re.compile('^([a-f0-9]{40}) ([a-f0-9]{40})$')
+# the bulk insert endpoints, which read their body as it comes
+STREAMED_BODY_RULES = ('/<project>/insert', '/<project>/insert/ignoredups')
+
 
 @backend_common.auth.auth.require_permissions([mapper_api.config.SCOPE_PROJECT_INSERT])
 def post_project(project: str) -> dict:
@@ -36,6 +46,7 @@ def post_project(project: str) -> dict:
         raise werkzeug.exceptions.Conflict(
             'Project {} could not be inserted into the database'.format(project))
 
+    mapper_api.projects.registry.add(project, p.id)
     return {}
 
 
@@ -50,16 +61,15 @@ def post_hg_git_mapping(project: str,
         session,
         git_commit,
         hg_changeset,
-        _get_project(session, project),  # can raise HTTP 404 or HTTP 500
+        _get_project_id(session, project),  # can raise HTTP 404
     )
 
     try:
         session.commit()
+        mapper_api.cache.revisions.invalidate_missing()
         q = mapper_api.models.Hash.query
-        q = q.join(mapper_api.models.Project)
-        q = q.filter(_project_filter(project))
-        q = q.filter(sa.text('git_commit == :commit'))
-        q = q.params(commit=git_commit)
+        q = q.filter(_project_filter(session, project))
+        q = q.filter(mapper_api.models.Hash.git_commit == git_commit)
         return q.one().as_json()
 
     except sa.exc.IntegrityError:
@@ -95,27 +105,38 @@ def post_hg_git_mapping(project: str,
 
 
 @backend_common.auth.auth.require_permissions([mapper_api.config.SCOPE_MAPPING_INSERT])
-def post_insert_many_ignoredups(project: str,
-                                body: typing.Union[bytes, str],
-                                ) -> dict:
-    return _insert_many(
+def post_insert_many_ignoredups(project: str) -> flask.Response:
+    return flask.jsonify(_insert_many(
         project,
-        body,
+        _read_lines(flask.request.stream),
         flask.current_app.db.session,
         ignore_dups=True,
-    )
+    ))
 
 
 @backend_common.auth.auth.require_permissions([mapper_api.config.SCOPE_MAPPING_INSERT])
-def post_insert_many(project: str,
-                     body: typing.Union[bytes, str],
-                     ) -> dict:
-    return _insert_many(
+def post_insert_many(project: str) -> flask.Response:
+    return flask.jsonify(_insert_many(
         project,
-        body,
+        _read_lines(flask.request.stream),
         flask.current_app.db.session,
         ignore_dups=False,
-    )
+    ))
+
+
+def stream_request_body() -> None:
+    '''Keep connexion from reading the body of the bulk insert requests.
+
+    connexion reads the whole body of a request before calling its view,
+    while the bulk insert endpoints read theirs from flask.request.stream,
+    chunk by chunk: the body connexion gets is left empty instead.
+    '''
+    rule = flask.request.url_rule
+    if rule is not None and rule.rule in STREAMED_BODY_RULES:
+        # loading the form data, which doesn't read text/plain bodies, would
+        # otherwise replace the stream with the empty body
+        flask.request.form
+        flask.request._cached_data = b''
 
 
 def get_projects() -> dict:
@@ -131,7 +152,7 @@ def get_projects() -> dict:
 
 def get_mapfile_since(projects: str,
                       since: str,
-                      ) -> typing.Optional[flask.Response]:
+                      ) -> flask.Response:
     try:
         since_dt = dateutil.parser.parse(since)
 
@@ -143,17 +164,20 @@ def get_mapfile_since(projects: str,
     since_epoch = calendar.timegm(since_dt.utctimetuple())
 
     q = mapper_api.models.Hash.query
-    q = q.join(mapper_api.models.Project)
-    q = q.filter(_project_filter(projects))
+    q = q.filter(_project_filter(flask.current_app.db.session, projects))
     q = q.order_by(mapper_api.models.Hash.hg_changeset)
     q = q.filter(mapper_api.models.Hash.date_added > since_epoch)
     return _stream_mapfile(q)
 
 
-def get_full_mapfile(projects: str) -> typing.Optional[flask.Response]:
+def get_full_mapfile(projects: str) -> flask.Response:
+    if ',' not in projects:
+        response = mapper_api.snapshots.serve(projects)
+        if response is not None:
+            return response
+
     q = mapper_api.models.Hash.query
-    q = q.join(mapper_api.models.Project)
-    q = q.filter(_project_filter(projects))
+    q = q.filter(_project_filter(flask.current_app.db.session, projects))
     q = q.order_by(mapper_api.models.Hash.hg_changeset)
     return _stream_mapfile(q)
 
@@ -163,22 +187,16 @@ def get_revision(projects: str,
                  commit: str,
                  ) -> flask.Response:
     _check_well_formed_sha(vcs_type, commit, exact_length=None)  # can raise http 400
-    q = mapper_api.models.Hash.query
-    q = q.join(mapper_api.models.Project)
-    q = q.filter(_project_filter(projects))
 
-    if vcs_type == 'git':
-        q = q.filter(sa.text('git_commit like :cspatttern'))
-        q = q.params(cspatttern=commit + '%')
-
-    elif vcs_type == 'hg':
-        q = q.filter(sa.text('hg_changeset like :cspatttern'))
-        q = q.params(cspatttern=commit + '%')
+    mapping = mapper_api.cache.revisions.get(projects, vcs_type, commit)
+    if mapping is None:
+        mapping = _lookup_revision(projects, vcs_type, commit)
+        if mapping is None:
+            mapper_api.cache.revisions.set_missing(projects, vcs_type, commit)
+        else:
+            mapper_api.cache.revisions.set(projects, vcs_type, commit, mapping)
 
-    try:
-        row = q.one()
-
-    except sa.orm.exc.NoResultFound:
+    if mapping in (None, mapper_api.cache.MISSING):
         if vcs_type == 'git':
             raise werkzeug.exceptions.NotFound(
                 'No hg changeset found for git commit id {} in '
@@ -197,6 +215,45 @@ def get_revision(projects: str,
                 )
             )
 
+    return flask.Response(
+        '%s %s' % mapping,
+        mimetype='plain/text',
+    )
+
+
+def get_cache_stats() -> dict:
+    return mapper_api.cache.revisions.stats()
+
+
+def _lookup_revision(projects: str,
+                     vcs_type: str,
+                     commit: str,
+                     ) -> typing.Optional[typing.Tuple[str, str]]:
+    '''Helper method to map a git commit to a hg changeset, or vice-versa.
+    Args:
+        projects: Comma-separated list of project names
+        vcs_type: Name of the vcs system of the commit ('hg' or 'git')
+        commit: Full or abbreviated SHA
+    Returns:
+        The (git_commit, hg_changeset) mapping, or None if there is none
+    Exceptions:
+        HTTP 500: Multiple mappings found
+    '''
+    q = mapper_api.models.Hash.query
+    q = q.filter(_project_filter(flask.current_app.db.session, projects))
+
+    if vcs_type == 'git':
+        q = q.filter(_prefix_filter(mapper_api.models.Hash.git_commit, commit))
+
+    elif vcs_type == 'hg':
+        q = q.filter(_prefix_filter(mapper_api.models.Hash.hg_changeset, commit))
+
+    try:
+        row = q.one()
+
+    except sa.orm.exc.NoResultFound:
+        return None
+
     except sa.orm.exc.MultipleResultsFound:
         raise werkzeug.exceptions.InternalServerError(
             'Internal error - multiple results returned for {} commit {} in '
@@ -208,28 +265,127 @@ def get_revision(projects: str,
             )
         )
 
-    return flask.Response(
-        '%s %s' % (row.git_commit, row.hg_changeset),
-        mimetype='plain/text',
-    )
+    return row.git_commit, row.hg_changeset
+
+
+def post_revisions(projects: str,
+                   vcs_type: str,
+                   body: dict,
+                   ) -> flask.Response:
+    '''Map many git commits to hg changesets, or vice-versa, at once.
+
+    All the SHAs are resolved with a single query: exact matches for full
+    SHAs, and index range scans for abbreviated ones.
+    Returns:
+        * Text output (streamed): a mapfile line for each SHA which could be
+          mapped, in the order of the request; or
+        * JSON output, if the client accepts it rather than text: the mapped
+          SHAs, and the SHAs which are missing or ambiguous
+    Exceptions:
+        HTTP 400: Unknown vcs, malformed or too short SHA, or too many SHAs
+    '''
+    commits = body['commits']
+    if len(commits) > mapper_api.config.REVISIONS_MAX_COMMITS:
+        raise werkzeug.exceptions.BadRequest(
+            'At most {} SHAs can be mapped at once'.format(
+                mapper_api.config.REVISIONS_MAX_COMMITS))
+    for commit in commits:
+        _check_well_formed_sha(vcs_type, commit, exact_length=None)  # can raise http 400
+        if len(commit) < mapper_api.config.REVISIONS_MIN_PREFIX_LENGTH:
+            raise werkzeug.exceptions.BadRequest(
+                '{} SHA "{}" should be at least {} characters long'.format(
+                    vcs_type, commit, mapper_api.config.REVISIONS_MIN_PREFIX_LENGTH))
+
+    column = {
+        'git': mapper_api.models.Hash.git_commit,
+        'hg': mapper_api.models.Hash.hg_changeset,
+    }[vcs_type]
+    full = [commit for commit in commits if len(commit) == 40]
+    conditions = [_prefix_filter(column, prefix)
+                  for prefix in set(commits) if len(prefix) < 40]
+    if full:
+        conditions.append(column.in_(full))
+
+    rows = []
+    if conditions:
+        q = mapper_api.models.Hash.query
+        q = q.filter(_project_filter(flask.current_app.db.session, projects))
+        q = q.filter(sa.or_(*conditions))
+        q = q.with_entities(column,
+                            mapper_api.models.Hash.git_commit,
+                            mapper_api.models.Hash.hg_changeset)
+        # sorted here rather than by the database, whose collation may not
+        # sort like bisect does
+        rows = sorted(q.all(), key=lambda row: row[0])
+    keys = [row[0] for row in rows]
+
+    mappings, missing, ambiguous = [], [], []
+    for commit in commits:
+        start = bisect.bisect_left(keys, commit)
+        end = bisect.bisect_left(keys, commit + 'g', lo=start)
+        if start == end:
+            missing.append(commit)
+        elif end - start > 1:
+            ambiguous.append(commit)
+        else:
+            mappings.append(dict(commit=commit,
+                                 git_commit=rows[start].git_commit,
+                                 hg_changeset=rows[start].hg_changeset,
+                                 ))
+
+    if flask.request.accept_mimetypes.best_match(['text/plain', 'application/json']) == 'application/json':
+        return flask.jsonify(mappings=mappings, missing=missing, ambiguous=ambiguous)
 
+    def contents():
+        for mapping in mappings:
+            yield '{git_commit} {hg_changeset}\n'.format(**mapping)
+
+    return flask.Response(contents(), mimetype='text/plain')
 
-def _project_filter(projects_arg):
+
+def _prefix_filter(column, sha: str):
+    '''Helper method that returns the SQLAlchemy filter expression for the
+    SHAs of a column starting with the given, possibly abbreviated, SHA.
+
+    Unlike LIKE 'prefix%', which can only use an index with the C collation
+    or text_pattern_ops, this range condition is served by the
+    (project_id, sha) indexes whatever the collation, and whether SHAs are
+    stored as text or as bytes.
+    Args:
+        column: Hash.git_commit or Hash.hg_changeset
+        sha: Well-formed SHA, full or abbreviated
+    Returns:
+        A SQLAlchemy filter expression
+    '''
+    if len(sha) == 40:
+        return column == sha
+    return sa.and_(column >= sha.ljust(40, '0'), column <= sha.ljust(40, 'f'))
+
+
+def _project_filter(session, projects_arg):
     '''Helper method that returns the SQLAlchemy filter expression for the
     project name(s) specified. This can be a comma-separated list, which is
     the way we combine queries across multiple projects.
+
+    Names are resolved to ids with the project registry, so that the
+    filter applies to the hashes table directly, without joining the
+    projects table.
     Args:
+        session: SQLAlchemy ORM Session object
         projects_arg: Comma-separated list of project names
     Returns:
         A SQLAlchemy filter expression
     '''
-    if ',' in projects_arg:
-        return mapper_api.models.Project.name.in_(projects_arg.split(','))
+    ids = mapper_api.projects.registry.ids(session, projects_arg.split(','))
+    if not ids:
+        return sa.false()
+    elif len(ids) == 1:
+        return mapper_api.models.Hash.project_id == ids[0]
     else:
-        return mapper_api.models.Project.name == projects_arg
+        return mapper_api.models.Hash.project_id.in_(ids)
 
 
-def _stream_mapfile(query) -> typing.Optional[flask.Response]:
+def _stream_mapfile(query) -> flask.Response:
     '''Helper method to build a map file from a SQLAlchemy query.
     Args:
         query: SQLAlchemy query
@@ -238,20 +394,33 @@ def _stream_mapfile(query) -> typing.Optional[flask.Response]:
           40 characters hg changeset SHA, a newline (streamed); or
         * HTTP 404: if the query returns no results
     '''
-    # this helps keep memory use down a little, but the DBAPI still loads
-    # the entire result set into memory..
-    # http://docs.sqlalchemy.org/en/latest/orm/query.html#sqlalchemy.orm.query.Query.yield_per
-    query = query.yield_per(100)
-
-    if query.count() == 0:
+    query = query.with_entities(mapper_api.models.Hash.git_commit,
+                                mapper_api.models.Hash.hg_changeset)
+
+    # with stream_results, the DBAPI reads the result set through a
+    # server-side cursor, chunk by chunk, rather than all at once; the
+    # options given to session.connection() are ignored once the transaction
+    # has a connection, so they're set on a branch of it
+    connection = query.session.connection().execution_options(stream_results=True)
+    result = connection.execute(query.statement)
+
+    # no need to count the results to know whether there are any
+    rows = result.fetchmany(mapper_api.config.MAPFILE_CHUNK_SIZE)
+    if not rows:
+        result.close()
         raise werkzeug.exceptions.NotFound('No mappings found.')
 
-    def contents():
-        for r in query:
-            yield '{} {}'.format(r.git_commit, r.hg_changeset) + '\n'
+    def contents(rows):
+        try:
+            while rows:
+                yield ''.join([f'{git_commit} {hg_changeset}\n' for git_commit, hg_changeset in rows])
+                rows = result.fetchmany(mapper_api.config.MAPFILE_CHUNK_SIZE)
+        finally:
+            result.close()
 
-    if contents:
-        return flask.Response(contents(), mimetype='text/plain')
+    # keep the request context, and so the session and its cursor, around
+    # while the response is streamed
+    return flask.Response(flask.stream_with_context(contents(rows)), mimetype='text/plain')
 
 
 def _check_well_formed_sha(vcs: str,
@@ -298,40 +467,30 @@ def _check_well_formed_sha(vcs: str,
         )
 
 
-def _get_project(session,
-                 project: str,
-                 ) -> mapper_api.models.Project:
-    '''Helper method to return Project class for a project with the given name.
+def _get_project_id(session, project: str) -> int:
+    '''Helper method to return the id of the project with the given name.
     Args:
         session: SQLAlchemy ORM Session object
         project: Name of the project (e.g. 'build-tools')
     Returns:
-        the corresponding python Project object
+        the id of the project
     Exceptions:
         HTTP 404: Project could not be found
-        HTTP 500: Multiple projects with same name found
     '''
-    try:
-        q = session.query(mapper_api.models.Project)
-        q = q.filter(mapper_api.models.Project.name == project)
-        return q.one()
-
-    except sa.orm.exc.MultipleResultsFound:
-        raise werkzeug.exceptions.InternalServerError(
-            'Multiple projects with name {} found in database'.format(project))
-
-    except sa.orm.exc.NoResultFound:
+    project_id = mapper_api.projects.registry.id(session, project)
+    if project_id is None:
         raise werkzeug.exceptions.NotFound(
             'Could not find project {} in database'.format(project))
+    return project_id
 
 
-def _add_hash(session, git_commit: str, hg_changeset: str, project: str) -> None:
+def _add_hash(session, git_commit: str, hg_changeset: str, project_id: int) -> None:
     '''Helper method to add a git-hg mapping into the current SQLAlchemy ORM session.
     Args:
         session: SQLAlchemy ORM Session object
         git_commit: String of the 40 character SHA of the git commit
         hg_changeset: String of the 40 character SHA of the hg changeset
-        project: String of the name of the project (e.g. 'build-tools')
+        project_id: Id of the project
     Exceptions:
         HTTP 400: Malformed SHA
     '''
@@ -340,48 +499,70 @@ def _add_hash(session, git_commit: str, hg_changeset: str, project: str) -> None
 
     h = mapper_api.models.Hash(git_commit=git_commit,
                                hg_changeset=hg_changeset,
-                               project=project,
+                               project_id=project_id,
                                date_added=time.time(),
                                )
     session.add(h)
 
 
-def _insert_many(project: str,
-                 body: typing.Union[bytes, str],
-                 session,
-                 ignore_dups: bool = False,
-                 ) -> dict:
-    '''Update the database with many git-hg mappings.
+def _read_lines(stream,
+                read_size: int = mapper_api.config.INSERT_READ_SIZE,
+                ) -> typing.Iterator[str]:
+    '''Helper method to read the lines of an utf-8 encoded stream, without
+    holding more than a chunk of it in memory.
     Args:
-        project: Single project name string
-        ignore_dups: Boolean; if False, abort on duplicate entries without inserting
-        anything
+        stream: File-like object, e.g. the request body stream
+        read_size: Number of bytes read at once
     Returns:
-        An empty json response body
+        Iterator of lines, without their line terminator
     Exceptions:
-        HTTP 400: Malformed SHA
-        HTTP 404: Project not found
-        HTTP 409: ignore_dups=False and there are duplicate entries
-        HTTP 415: Request content-type is not 'text/plain'
-        HTTP 500: Multiple projects found with matching project name
+        HTTP 400: Invalid utf-8 or line too long
     '''
-    if isinstance(body, bytes):
-        body = body.decode('utf-8')
-
-    if body == '':
-        return {}
-
-    if flask.request.content_type != 'text/plain':
-        raise werkzeug.exceptions.UnsupportedMediaType(
-            'HTTP request header "Content-Type" must be set to "text/plain"')
-
-    proj = _get_project(session, project)  # can raise HTTP 404 or HTTP 500
-    for line in body.split('\n'):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        data = stream.read(read_size)
+        try:
+            text = decoder.decode(data, final=not data)
+        except UnicodeDecodeError as e:
+            raise werkzeug.exceptions.BadRequest(
+                'Request body is not valid utf-8: {}'.format(e))
+        lines = (pending + text).split('\n')
+        pending = lines.pop()
+        if len(pending) > read_size:
+            raise werkzeug.exceptions.BadRequest(
+                'Input line "{}..." is too long'.format(pending[:100]))
+        yield from lines
+        if not data:
+            break
+    if pending:
+        yield pending
+
+
+def _parse_mappings(lines: typing.Iterable[str],
+                    project: str,
+                    ) -> typing.Iterator[typing.Tuple[str, str]]:
+    '''Helper method to parse the lines of a mapfile.
+    Args:
+        lines: Iterable of mapfile lines
+        project: Name of the project, for error messages
+    Returns:
+        Iterator of (git_commit, hg_changeset) tuples
+    Exceptions:
+        HTTP 400: Malformed line or SHA
+    '''
+    for line in lines:
         line = line.rstrip()
 
         if line == '':
             continue
 
+        match = MAPPING_LINE_REGEX.match(line)
+        if match:
+            yield match.groups()
+            continue
+
+        # the line is malformed, find out why
         try:
             git_commit, hg_changeset = line.split(' ')
 
@@ -396,23 +577,127 @@ def _insert_many(project: str,
                 'Input line "{}" received for project {} did not contain '
                 'a space'.format(line, project))
 
-        _add_hash(session, git_commit, hg_changeset, proj)  # can raise HTTP 400
+        _check_well_formed_sha('git', git_commit)  # can raise http 400
+        _check_well_formed_sha('hg', hg_changeset)  # can raise http 400
+
+
+def _chunks(iterable: typing.Iterable, size: int) -> typing.Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
+def _insert_hashes(session,
+                   project_id: int,
+                   mappings: typing.List[typing.Tuple[str, str]],
+                   ignore_dups: bool = False,
+                   date_added: typing.Optional[int] = None,
+                   ) -> int:
+    '''Helper method to insert many git-hg mappings with a single statement.
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project of the mappings
+        mappings: List of (git_commit, hg_changeset) tuples of well-formed SHAs
+        ignore_dups: Boolean; if True, skip the mappings which already exist
+        date_added: Epoch timestamp of the mappings, defaults to now
+    Returns:
+        The number of inserted mappings
+    Exceptions:
+        sa.exc.IntegrityError: ignore_dups=False and a mapping already exists
+    '''
+    table = mapper_api.models.Hash.__table__
+    if date_added is None:
+        date_added = int(time.time())
+    rows = [
+        dict(git_commit=git_commit,
+             hg_changeset=hg_changeset,
+             project_id=project_id,
+             date_added=date_added,
+             )
+        for git_commit, hg_changeset in mappings
+    ]
+
+    if session.get_bind().dialect.name == 'postgresql':
+        # a single multi-row INSERT, reporting how many rows it inserted
+        if ignore_dups:
+            statement = sqlalchemy.dialects.postgresql.insert(table)
+            statement = statement.on_conflict_do_nothing()
+        else:
+            statement = table.insert()
+        result = session.execute(statement.values(rows))
+    else:
+        # SQLite, which limits the number of parameters of a statement
+        statement = table.insert()
         if ignore_dups:
-            try:
+            statement = statement.prefix_with('OR IGNORE')
+        result = session.execute(statement, rows)
+
+    return result.rowcount
+
+
+def _insert_many(project: str,
+                 lines: typing.Iterable[str],
+                 session,
+                 ignore_dups: bool = False,
+                 ) -> dict:
+    '''Update the database with many git-hg mappings.
+
+    Mappings are validated and inserted in chunks of INSERT_CHUNK_SIZE lines,
+    with one multi-row INSERT each, as they are read from `lines`.  When
+    duplicates are ignored, each chunk is committed on its own; otherwise all
+    of them are committed together.
+    Args:
+        project: Single project name string
+        lines: Iterable of mapfile lines, e.g. read from the request body stream
+        ignore_dups: Boolean; if False, abort on duplicate entries without inserting
+        anything
+    Returns:
+        A json response body with the number of inserted and duplicate mappings
+    Exceptions:
+        HTTP 400: Malformed SHA
+        HTTP 404: Project not found
+        HTTP 409: ignore_dups=False and there are duplicate entries
+        HTTP 415: Request content-type is not 'text/plain'
+    '''
+    if flask.request.content_length == 0:
+        return dict(inserted=0, duplicates=0)
+
+    if flask.request.content_type != 'text/plain':
+        raise werkzeug.exceptions.UnsupportedMediaType(
+            'HTTP request header "Content-Type" must be set to "text/plain"')
+
+    project_id = _get_project_id(session, project)  # can raise HTTP 404
+    mappings = _parse_mappings(lines, project)  # can raise HTTP 400
+    inserted = duplicates = 0
+    try:
+        for chunk in _chunks(mappings, mapper_api.config.INSERT_CHUNK_SIZE):
+            count = _insert_hashes(session, project_id, chunk, ignore_dups)
+            inserted += count
+            duplicates += len(chunk) - count
+            if ignore_dups:
                 session.commit()
 
-            except sa.exc.IntegrityError:
-                session.rollback()
+        session.commit()
 
-    if not ignore_dups:
-        try:
-            session.commit()
+    except sa.exc.IntegrityError:
+        session.rollback()
+        raise werkzeug.exceptions.Conflict(
+            'Some of the given mappings for project {} already '
+            'exist'.format(project))
 
-        except sa.exc.IntegrityError:
-            session.rollback()
-            raise werkzeug.exceptions.Conflict(
-                'Some of the given mappings for project {} already '
-                'exist'.format(project))
+    except werkzeug.exceptions.HTTPException:
+        session.rollback()
+        raise
 
-    return {}
+    finally:
+        if inserted:
+            mapper_api.cache.revisions.invalidate_missing()
+
+    logger.info('Inserted {} mappings for project {}, ignored {} duplicates'.format(
+        inserted, project, duplicates))
+    return dict(inserted=inserted, duplicates=duplicates)
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import random
+import resource
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+import sqlalchemy as sa
+import werkzeug.exceptions
+
+import cli_common.log
+import mapper_api.api
+import mapper_api.config
+import mapper_api.models
+import mapper_api.projects
+
+logger = cli_common.log.get_logger(__name__)
+
+SEED_INTERVAL = 60
+
+
+def percentile(values: typing.List[float], percent: float) -> float:
+    '''Return the given percentile of sorted values, by nearest rank.
+    '''
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(percent / 100. * len(values))) - 1))
+    return values[rank]
+
+
+def seed(session, project: str, rows: int) -> int:
+    '''Add random mappings to a project, creating it if needed, until it has
+    at least `rows` of them.
+    Args:
+        session: SQLAlchemy ORM Session object
+        project: Name of the project
+        rows: Number of mappings the project should have
+    Returns:
+        The id of the project
+    '''
+    project_id = session.query(mapper_api.models.Project.id) \
+        .filter(mapper_api.models.Project.name == project) \
+        .scalar()
+    if project_id is None:
+        p = mapper_api.models.Project(name=project)
+        session.add(p)
+        session.commit()
+        project_id = p.id
+        mapper_api.projects.registry.add(project, project_id)
+
+    count = session.query(sa.func.count()) \
+        .filter(mapper_api.models.Hash.project_id == project_id) \
+        .scalar()
+    missing = rows - count
+    logger.info('Seeding mappings', project=project, existing=count, missing=max(0, missing))
+    now = int(time.time())
+    while missing > 0:
+        size = min(missing, mapper_api.config.INSERT_CHUNK_SIZE)
+        chunk = [(os.urandom(20).hex(), os.urandom(20).hex()) for _ in range(size)]
+        # spread the mappings over the past, a chunk every SEED_INTERVAL
+        # seconds, so that mapfiles since a date are of a realistic size
+        date_added = now - SEED_INTERVAL * (missing // mapper_api.config.INSERT_CHUNK_SIZE)
+        missing -= mapper_api.api._insert_hashes(session, project_id, chunk, ignore_dups=True, date_added=date_added)
+        session.commit()
+    return project_id
+
+
+def sample(session, project_id: int, samples: int) -> typing.List[typing.Tuple[str, str]]:
+    '''Return random (git_commit, hg_changeset) mappings of a project.
+    '''
+    q = session.query(mapper_api.models.Hash.git_commit,
+                      mapper_api.models.Hash.hg_changeset)
+    q = q.filter(mapper_api.models.Hash.project_id == project_id)
+    return q.order_by(sa.func.random()).limit(samples).all()
+
+
+def benchmark_lookups(session,
+                      project: str,
+                      rows: int,
+                      samples: int,
+                      lengths: typing.Iterable[int] = (7, 12, 40),
+                      ) -> dict:
+    '''Measure the latency of revision lookups for SHAs abbreviated to each of
+    `lengths`, in a project of `rows` mappings, with the range conditions
+    get_revision uses, and with the LIKE conditions it used to.
+    '''
+    project_id = seed(session, project, rows)
+    shas = [git_commit for git_commit, _ in sample(session, project_id, samples)]
+
+    def lookup_range(prefix):
+        try:
+            mapper_api.api._lookup_revision(project, 'git', prefix)
+        except werkzeug.exceptions.InternalServerError:
+            return False
+        return True
+
+    def lookup_like(prefix):
+        q = session.query(mapper_api.models.Hash.git_commit,
+                          mapper_api.models.Hash.hg_changeset)
+        q = q.filter(mapper_api.models.Hash.project_id == project_id)
+        q = q.filter(mapper_api.models.Hash.git_commit.like(prefix + '%'))
+        return len(q.all()) == 1
+
+    queries = [('range', lookup_range)]
+    if not mapper_api.models.BINARY_SHAS:
+        queries.append(('like', lookup_like))
+
+    results = []
+    for length in lengths:
+        for query, lookup in queries:
+            timings = []
+            ambiguous = 0
+            for sha in shas:
+                start = time.perf_counter()
+                if not lookup(sha[:length]):
+                    ambiguous += 1
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            results.append(dict(
+                length=length,
+                query=query,
+                lookups=len(timings),
+                ambiguous=ambiguous,
+                mean_ms=1000 * sum(timings) / max(1, len(timings)),
+                p50_ms=1000 * percentile(timings, 50),
+                p95_ms=1000 * percentile(timings, 95),
+                p99_ms=1000 * percentile(timings, 99),
+            ))
+    return dict(
+        dialect=session.get_bind().dialect.name,
+        binary_shas=mapper_api.models.BINARY_SHAS,
+        rows=rows,
+        storage=storage_sizes(session),
+        results=results,
+    )
+
+
+def storage_sizes(session) -> typing.Optional[dict]:
+    '''Return the size in bytes of the hashes table and of each of its
+    indexes, on PostgreSQL.
+    '''
+    if session.get_bind().dialect.name != 'postgresql':
+        return None
+    table = mapper_api.models.Hash.__tablename__
+    return dict(
+        table=session.execute('SELECT pg_table_size(:table)', dict(table=table)).scalar(),
+        indexes=dict(session.execute(
+            'SELECT indexname, pg_relation_size(indexname::regclass) FROM pg_indexes '
+            'WHERE tablename = :table',
+            dict(table=table),
+        ).fetchall()),
+    )
+
+
+def rss(pid: int) -> typing.Optional[int]:
+    '''Return the resident set size of a process in bytes, or None where
+    /proc isn't available.
+    '''
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class MemorySampler:
+    '''Record the peak resident set size of a process while in use, sampling
+    it every `interval` seconds from a background thread.
+    '''
+
+    def __init__(self, pid: int, interval: float = 0.01) -> None:
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) -> None:
+        value = rss(self.pid)
+        if value is not None and (self.peak is None or value > self.peak):
+            self.peak = value
+
+    def _run(self) -> None:
+        while not self._done.wait(self.interval):
+            self._sample()
+
+    def __enter__(self) -> 'MemorySampler':
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._done.set()
+        self._thread.join()
+        self._sample()
+
+
+class FlaskClientDriver:
+    '''Send requests to the application in this process, through the flask
+    test client.
+    '''
+
+    def __init__(self, app, headers: dict) -> None:
+        self.app = app
+        self.headers = headers
+        self.pid = os.getpid()
+
+    def request(self, method: str, path: str, data: typing.Optional[bytes] = None, headers: typing.Optional[dict] = None) -> typing.Tuple[int, bytes]:
+        response = self.app.test_client().open(path, method=method, data=data, headers={**self.headers, **(headers or {})})
+        return response.status_code, response.get_data()
+
+
+class HttpDriver:
+    '''Send requests to a mapper server, e.g. one started locally with the
+    configuration to size.
+    '''
+
+    def __init__(self, url: str, headers: dict, pid: typing.Optional[int] = None) -> None:
+        self.url = url.rstrip('/')
+        self.headers = headers
+        self.pid = pid
+
+    def request(self, method: str, path: str, data: typing.Optional[bytes] = None, headers: typing.Optional[dict] = None) -> typing.Tuple[int, bytes]:
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={**self.headers, **(headers or {})})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def load(driver,
+         endpoint: str,
+         requests: typing.List[typing.Tuple[str, str, typing.Optional[bytes], typing.Callable[[bytes], int]]],
+         concurrency: int,
+         ) -> dict:
+    '''Send `requests` with `concurrency` parallel clients, and return the
+    latency percentiles, the throughput and the peak memory of the server.
+    Args:
+        driver: FlaskClientDriver or HttpDriver
+        endpoint: Name of the endpoint, for the results
+        requests: List of (method, path, body, rows) tuples, where rows returns
+        the number of rows a successful response body is worth
+        concurrency: Number of requests sent in parallel
+    '''
+    def send(request):
+        method, path, data, rows = request
+        headers = {'Content-Type': 'text/plain'} if data is not None else {}
+        start = time.perf_counter()
+        status, body = driver.request(method, path, data, headers)
+        elapsed = time.perf_counter() - start
+        if status >= 400:
+            logger.debug('Request failed', path=path, status=status)
+            return elapsed, status, 0
+        return elapsed, status, rows(body)
+
+    logger.info('Load testing endpoint', endpoint=endpoint, requests=len(requests), concurrency=concurrency)
+    sampler = MemorySampler(driver.pid) if driver.pid else contextlib.nullcontext()
+    with sampler:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(send, requests))
+        duration = time.perf_counter() - start
+
+    timings = sorted(elapsed for elapsed, _, _ in results)
+    rows = sum(count for _, _, count in results)
+    return dict(
+        endpoint=endpoint,
+        requests=len(results),
+        concurrency=concurrency,
+        errors=sum(1 for _, status, _ in results if status >= 400),
+        statuses=dict(collections.Counter(str(status) for _, status, _ in results)),
+        seconds=duration,
+        requests_per_s=len(results) / duration if duration else 0.0,
+        rows=rows,
+        rows_per_s=rows / duration if duration else 0.0,
+        mean_ms=1000 * sum(timings) / max(1, len(timings)),
+        p50_ms=1000 * percentile(timings, 50),
+        p95_ms=1000 * percentile(timings, 95),
+        p99_ms=1000 * percentile(timings, 99),
+        peak_rss=sampler.peak if driver.pid else None,
+    )
+
+
+def _count_lines(body: bytes) -> int:
+    return body.count(b'\n')
+
+
+def benchmark_endpoints(session,
+                        driver,
+                        projects: int,
+                        rows: int,
+                        requests: int,
+                        mapfile_requests: int,
+                        concurrency: int,
+                        since: int,
+                        insert_size: int,
+                        insert: bool = True,
+                        ) -> dict:
+    '''Seed `projects` projects with `rows` mappings in total, and load test
+    the revision, mapfile and insert endpoints with them.
+    Args:
+        session: SQLAlchemy ORM Session object, of the database the driver's
+        server uses
+        driver: FlaskClientDriver or HttpDriver
+        projects: Number of projects
+        rows: Total number of mappings
+        requests: Number of revision and insert requests
+        mapfile_requests: Number of requests for each of the mapfile endpoints
+        concurrency: Number of requests sent in parallel
+        since: Age in seconds of the oldest mapping in the mapfiles since a date
+        insert_size: Number of mappings of each insert request
+        insert: Whether to load test the insert endpoint, which requires
+        credentials with the mapping insert scope
+    Returns:
+        The results for each endpoint
+    '''
+    names = [f'benchmark-{n}' for n in range(projects)]
+    shas = []
+    for name in names:
+        project_id = seed(session, name, rows // projects)
+        shas.extend((name, git_commit, hg_changeset)
+                    for git_commit, hg_changeset in sample(session, project_id, requests // projects + 1))
+    random.shuffle(shas)
+
+    def revision(request):
+        name, git_commit, hg_changeset = request
+        if random.random() < 0.5:
+            return ('GET', f'/{name}/rev/git/{git_commit}', None, lambda body: 1)
+        return ('GET', f'/{name}/rev/hg/{hg_changeset}', None, lambda body: 1)
+
+    since_date = datetime.datetime.utcfromtimestamp(time.time() - since).strftime('%Y-%m-%dT%H:%M:%SZ')
+    workloads = [
+        ('get_revision', [revision(request) for request in shas[:requests]]),
+        ('get_mapfile_since', [
+            ('GET', f'/{random.choice(names)}/mapfile/since/{since_date}', None, _count_lines)
+            for _ in range(mapfile_requests)
+        ]),
+        ('get_full_mapfile', [
+            ('GET', f'/{random.choice(names)}/mapfile/full', None, _count_lines)
+            for _ in range(mapfile_requests)
+        ]),
+    ]
+    if insert:
+        workloads.append(('post_insert_many', [
+            ('POST',
+             f'/{random.choice(names)}/insert',
+             ''.join(f'{os.urandom(20).hex()} {os.urandom(20).hex()}\n' for _ in range(insert_size)).encode('utf-8'),
+             lambda body: json.loads(body.decode('utf-8'))['inserted'])
+            for _ in range(requests)
+        ]))
+    else:
+        logger.warning('Skipping post_insert_many, which requires credentials')
+
+    # end the transaction of the sampling queries, whose locks would
+    # otherwise block the inserts on sqlite
+    session.commit()
+
+    results = [load(driver, endpoint, workload, concurrency) for endpoint, workload in workloads]
+    return dict(
+        dialect=session.get_bind().dialect.name,
+        binary_shas=mapper_api.models.BINARY_SHAS,
+        projects=projects,
+        rows=rows,
+        results=results,
+    )
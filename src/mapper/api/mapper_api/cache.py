@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+import time
+import typing
+
+import backend_common.cache
+import mapper_api.config
+
+MISSING = 'missing'
+GENERATION_KEY = 'mapper:revision:generation'
+
+Mapping = typing.Tuple[str, str]
+
+
+class RevisionCache:
+    '''Cache of the results of revision lookups, keyed by (projects, vcs, sha).
+
+    A bounded in-process LRU sits in front of the shared flask-caching cache
+    of backend_common.  Mappings are never updated, so the mappings of full
+    SHAs are cached for good.  Those of abbreviated SHAs are not cached, since
+    a prefix can become ambiguous when new mappings are inserted.
+
+    Lookups which found nothing are cached for a short time, and stamped with
+    a generation number kept in the shared cache, which inserts bump to
+    invalidate all of them at once.  Those of the in-process LRU are also
+    stamped with a generation number of the process, so that its inserts
+    invalidate them even if the shared cache can't count, e.g. when it is
+    flask-caching's null cache.
+    '''
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._local_generation = 0
+
+    @staticmethod
+    def _key(projects: str, vcs_type: str, commit: str) -> str:
+        projects = ','.join(sorted(projects.split(',')))
+        return f'mapper:revision:{projects}:{vcs_type}:{commit}'
+
+    def _remember(self, key: str, value: tuple) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _generation(self) -> int:
+        return backend_common.cache.cache.get(GENERATION_KEY) or 0
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get(self,
+            projects: str,
+            vcs_type: str,
+            commit: str,
+            ) -> typing.Union[Mapping, str, None]:
+        '''Return the cached (git_commit, hg_changeset) mapping of a SHA,
+        MISSING if it is known not to be mapped, or None if it isn't cached.
+        '''
+        key = self._key(projects, vcs_type, commit)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            local_generation = self._local_generation
+        source = 'local'
+        if value is None:
+            value = backend_common.cache.cache.get(key)
+            if value is not None:
+                source = 'shared'
+                value = tuple(value)
+                if value[0] == MISSING:
+                    value += (local_generation,)
+                self._remember(key, value)
+
+        if value is None:
+            self._count('misses')
+            return None
+
+        if value[0] == MISSING:
+            _, generation, expires, local = value
+            if expires < time.time() or generation != self._generation() or local != local_generation:
+                self._forget(key)
+                self._count('misses')
+                return None
+            self._count('negative_hits')
+            return MISSING
+
+        self._count(f'{source}_hits')
+        return tuple(value)
+
+    def set(self,
+            projects: str,
+            vcs_type: str,
+            commit: str,
+            mapping: Mapping,
+            ) -> None:
+        if len(commit) != 40:
+            return
+        key = self._key(projects, vcs_type, commit)
+        self._remember(key, mapping)
+        backend_common.cache.cache.set(key, mapping, timeout=0)
+
+    def set_missing(self, projects: str, vcs_type: str, commit: str) -> None:
+        ttl = mapper_api.config.REVISION_CACHE_NEGATIVE_TTL
+        key = self._key(projects, vcs_type, commit)
+        value = (MISSING, self._generation(), time.time() + ttl)
+        with self._lock:
+            local_generation = self._local_generation
+        self._remember(key, value + (local_generation,))
+        backend_common.cache.cache.set(key, value, timeout=ttl)
+
+    def invalidate_missing(self) -> None:
+        '''Forget the lookups which found nothing, after mappings are inserted.
+        '''
+        with self._lock:
+            self._local_generation += 1
+        # flask-caching only exposes inc() on its backend
+        backend_common.cache.cache.cache.inc(GENERATION_KEY)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = collections.Counter(self._stats)
+            size = len(self._entries)
+        hits = stats['local_hits'] + stats['shared_hits'] + stats['negative_hits']
+        lookups = hits + stats['misses']
+        return dict(
+            size=size,
+            capacity=self.size,
+            local_hits=stats['local_hits'],
+            shared_hits=stats['shared_hits'],
+            negative_hits=stats['negative_hits'],
+            misses=stats['misses'],
+            hit_rate=hits / lookups if lookups else 0.0,
+        )
+
+
+revisions = RevisionCache(mapper_api.config.REVISION_CACHE_SIZE)
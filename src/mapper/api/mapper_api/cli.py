@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import click
+import flask
+
+import mapper_api.benchmark
+import mapper_api.config
+import mapper_api.models
+import mapper_api.snapshots
+
+
+@click.command()
+@click.option('--force', is_flag=True,
+              help='Rebuild the snapshots which are up to date too.')
+@click.argument('projects', nargs=-1)
+@flask.cli.with_appcontext
+def cmd_rebuild_snapshots(force, projects):
+    '''Rebuild the full mapfile snapshots of the given projects, or of all of
+    them, which are missing or have more than MAPFILE_SNAPSHOT_DELTA_THRESHOLD
+    mappings added since they were built.  Run it periodically.
+    '''
+    session = flask.current_app.db.session
+    q = session.query(mapper_api.models.Project)
+    if projects:
+        q = q.filter(mapper_api.models.Project.name.in_(projects))
+    for project in q.all():
+        snapshot = session.query(mapper_api.models.Snapshot).get(project.id)
+        if not force and snapshot is not None:
+            delta_count, _ = mapper_api.snapshots.delta(session, snapshot)
+            if delta_count <= mapper_api.config.MAPFILE_SNAPSHOT_DELTA_THRESHOLD:
+                continue
+        mapper_api.snapshots.rebuild(session, project.id)
+
+
+@click.command()
+@click.argument('storage', type=click.Choice(['binary', 'hex']))
+@flask.cli.with_appcontext
+def cmd_convert_shas(storage):
+    '''Convert the SHAs of the database to binary or hexadecimal storage,
+    rebuilding the hashes table and its indexes.  Set BINARY_SHAS accordingly
+    and restart once done.
+    '''
+    session = flask.current_app.db.session
+    if session.get_bind().dialect.name != 'postgresql':
+        raise click.ClickException('Only PostgreSQL databases can be converted.')
+
+    table = mapper_api.models.Hash.__tablename__
+    data_type = 'bytea' if storage == 'binary' else 'character varying'
+    columns = [
+        column
+        for column, current in session.execute(
+            'SELECT column_name, data_type FROM information_schema.columns '
+            'WHERE table_name = :table AND column_name IN (\'git_commit\', \'hg_changeset\')',
+            dict(table=table),
+        )
+        if current != data_type
+    ]
+    if not columns:
+        click.echo(f'SHAs are already stored as {storage}.')
+        return
+
+    if storage == 'binary':
+        alter = 'ALTER COLUMN {0} TYPE bytea USING decode({0}, \'hex\')'
+    else:
+        alter = 'ALTER COLUMN {0} TYPE varchar(40) USING encode({0}, \'hex\')'
+    session.execute(f'ALTER TABLE {table} ' + ', '.join(alter.format(column) for column in columns))
+    session.commit()
+    click.echo(f'SHAs are now stored as {storage}, set BINARY_SHAS accordingly.')
+
+
+@click.command()
+@click.option('--project', default='benchmark', show_default=True,
+              help='Project to seed with random mappings, and to look them up in.')
+@click.option('--rows', default=10000000, show_default=True,
+              help='Number of mappings the project is seeded with.')
+@click.option('--samples', default=1000, show_default=True,
+              help='Number of lookups for each SHA length.')
+@flask.cli.with_appcontext
+def cmd_benchmark_lookups(project, rows, samples):
+    '''Measure the latency of revision lookups for 7, 12 and 40 characters
+    SHAs, and the size of the hashes table and indexes, and print them as JSON.
+    Run it before and after convert-shas to compare SHA storages.  This adds
+    mappings to the database: use a scratch database.
+    '''
+    results = mapper_api.benchmark.benchmark_lookups(
+        flask.current_app.db.session, project, rows, samples)
+    click.echo(json.dumps(results, indent=2))
+
+
+@click.command()
+@click.option('--projects', default=4, show_default=True,
+              help='Number of projects the mappings are spread across.')
+@click.option('--rows', default=1000000, show_default=True,
+              help='Total number of mappings the projects are seeded with.')
+@click.option('--requests', default=1000, show_default=True,
+              help='Number of revision lookups, and of inserts.')
+@click.option('--mapfile-requests', default=10, show_default=True,
+              help='Number of requests for each of the mapfile endpoints.')
+@click.option('--concurrency', default=8, show_default=True,
+              help='Number of requests sent in parallel.')
+@click.option('--since', default=60 * 60, show_default=True,
+              help='Age in seconds of the mapfiles since a date; the seeded mappings are spread over the past, '
+                   f'{mapper_api.config.INSERT_CHUNK_SIZE} every {mapper_api.benchmark.SEED_INTERVAL} seconds.')
+@click.option('--insert-size', default=1000, show_default=True,
+              help='Number of mappings of each insert.')
+@click.option('--url',
+              help='Load test the mapper server at this url, which uses the same database, '
+                   'rather than this application through the flask test client.')
+@click.option('--server-pid', type=int,
+              help='Pid of the server given with --url, to report its peak memory.')
+@click.option('--authorization',
+              help='Authorization header with the mapping insert scope; inserts are skipped without it.')
+@flask.cli.with_appcontext
+def cmd_benchmark_endpoints(projects, rows, requests, mapfile_requests, concurrency, since, insert_size,
+                            url, server_pid, authorization):
+    '''Seed the database with mappings, load test the revision, mapfile and
+    insert endpoints, and print the latency percentiles, throughput and peak
+    memory of each of them as JSON.  This adds mappings to the database: use
+    a scratch database.
+    '''
+    headers = {'Authorization': authorization} if authorization else {}
+    if url:
+        driver = mapper_api.benchmark.HttpDriver(url, headers, server_pid)
+    else:
+        driver = mapper_api.benchmark.FlaskClientDriver(flask.current_app._get_current_object(), headers)
+    results = mapper_api.benchmark.benchmark_endpoints(
+        flask.current_app.db.session, driver, projects, rows, requests, mapfile_requests,
+        concurrency, since, insert_size, insert=bool(authorization))
+    click.echo(json.dumps(results, indent=2))
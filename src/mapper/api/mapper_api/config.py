@@ -8,3 +8,29 @@ APP_NAME = 'mapper/api'
 SCOPE_PREFIX = f'project:releng:services/{PROJECT_NAME}'
 SCOPE_PROJECT_INSERT = f'{SCOPE_PREFIX}/project/insert'
 SCOPE_MAPPING_INSERT = f'{SCOPE_PREFIX}/mapping/insert'
+
+# number of mappings inserted with each INSERT statement by the bulk insert
+# endpoints
+INSERT_CHUNK_SIZE = 1000
+# number of bytes of the request body read at once by the bulk insert
+# endpoints
+INSERT_READ_SIZE = 64 * 1024
+# number of mappings read from the database, and sent, at once by the
+# mapfile endpoints
+MAPFILE_CHUNK_SIZE = 10000
+# full mapfiles are served from a snapshot, merged with the mappings added
+# since it was built; once there are more of those than this threshold, the
+# snapshot is rebuilt by the rebuild-snapshots command
+MAPFILE_SNAPSHOT_DELTA_THRESHOLD = 10000
+# snapshots leave out the mappings added during the last MARGIN seconds, so
+# that they don't miss those of transactions committed after they're built
+MAPFILE_SNAPSHOT_MARGIN = 60 * 60
+# the revisions endpoint maps at most this many SHAs at once, and only SHAs
+# at least this long, so that a single prefix can't match a large part of a
+# project's mappings
+REVISIONS_MAX_COMMITS = 1000
+REVISIONS_MIN_PREFIX_LENGTH = 7
+# number of revision lookups cached by each process, and for how long, in
+# seconds, the lookups which found nothing are cached
+REVISION_CACHE_SIZE = 100000
+REVISION_CACHE_NEGATIVE_TTL = 60
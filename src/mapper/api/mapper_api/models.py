@@ -4,9 +4,41 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql
 
 import backend_common.db
 
+# whether SHAs are stored as 20 bytes rather than 40 hexadecimal characters;
+# set from the BINARY_SHAS setting by create_app, see Sha
+BINARY_SHAS = False
+
+
+class Sha(sa.types.TypeDecorator):
+    '''
+    A 40 characters hexadecimal SHA, stored as such, or as 20 bytes (BYTEA on
+    PostgreSQL) when BINARY_SHAS is set, which about halves the size of the
+    hashes table and of its indexes.  Either way, SHAs are hexadecimal
+    strings in python, and binary SHAs sort like hexadecimal ones.
+    '''
+    impl = sa.String(40)
+
+    def load_dialect_impl(self, dialect):
+        if not BINARY_SHAS:
+            return dialect.type_descriptor(sa.String(40))
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(sqlalchemy.dialects.postgresql.BYTEA())
+        return dialect.type_descriptor(sa.types.BINARY(20))
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and BINARY_SHAS:
+            return bytes.fromhex(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and BINARY_SHAS:
+            return bytes(value).hex()
+        return value
+
 
 class Project(backend_common.db.db.Model):
     '''
@@ -26,8 +58,8 @@ class Hash(backend_common.db.db.Model):
     '''
     __tablename__ = 'releng_mapper_hashes'
 
-    hg_changeset = sa.Column(sa.String(40), nullable=False)
-    git_commit = sa.Column(sa.String(40), nullable=False)
+    hg_changeset = sa.Column(Sha, nullable=False)
+    git_commit = sa.Column(Sha, nullable=False)
     project_id = sa.Column(sa.Integer, sa.ForeignKey(Project.id), nullable=False)
     project = sa.orm.relationship(Project, primaryjoin=(project_id == Project.id))
     date_added = sa.Column(sa.Integer, nullable=False)
@@ -41,12 +73,10 @@ class Hash(backend_common.db.db.Model):
         }
 
     __table_args__ = (
-        # TODO: (needs verification) all queries specifying a hash are for
-        # (project, hash), so these aren't used
-        sa.Index('hg_changeset', 'hg_changeset'),
-        sa.Index('git_commit', 'git_commit'),
-        # TODO: this index is a prefix of others and will never be used
-        sa.Index('project_id', 'project_id'),
+        # all queries specifying a hash are for (project, hash), including
+        # those for abbreviated hashes, which use range conditions (see
+        # mapper_api.api._prefix_filter) these indexes can serve whatever the
+        # collation
         sa.Index('project_id__date_added', 'project_id', 'date_added'),
         sa.Index('project_id__hg_changeset', 'project_id', 'hg_changeset', unique=True),
         sa.Index('project_id__git_commit', 'project_id', 'git_commit', unique=True),
@@ -57,3 +87,19 @@ class Hash(backend_common.db.db.Model):
         # matter which
         'primary_key': [project_id, hg_changeset],
     }
+
+
+class Snapshot(backend_common.db.db.Model):
+    '''
+    Object-relational mapping between python class Snapshot
+    and database table "snapshots": the gzip-compressed full mapfile of a
+    project, for the mappings added before `cutoff`
+    '''
+    __tablename__ = 'releng_mapper_snapshots'
+
+    project_id = sa.Column(sa.Integer, sa.ForeignKey(Project.id), primary_key=True)
+    cutoff = sa.Column(sa.Integer, nullable=False)
+    count = sa.Column(sa.Integer, nullable=False)
+    etag = sa.Column(sa.String(32), nullable=False)
+    # only loaded when the mapfile is sent
+    mapfile = sa.orm.deferred(sa.Column(sa.LargeBinary, nullable=False))
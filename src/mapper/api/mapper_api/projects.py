@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import typing
+
+import cli_common.log
+import mapper_api.models
+
+logger = cli_common.log.get_logger(__name__)
+
+
+class ProjectRegistry:
+    '''Process-wide mapping of project names to ids.
+
+    Projects are almost never created, and never renamed nor deleted, so
+    the mapping is loaded once, at startup.  Names which aren't known, e.g.
+    of projects created by another process, are looked up on their own.
+    '''
+
+    def __init__(self) -> None:
+        self._ids = dict()
+        self._lock = threading.Lock()
+
+    def load(self, session) -> None:
+        '''Load the names and ids of all the projects from the database.
+        '''
+        q = session.query(mapper_api.models.Project.name,
+                          mapper_api.models.Project.id)
+        ids = dict(q.all())
+        with self._lock:
+            self._ids = ids
+        logger.info('Loaded projects', count=len(ids))
+
+    def add(self, name: str, project_id: int) -> None:
+        with self._lock:
+            self._ids[name] = project_id
+
+    def ids(self, session, names: typing.Iterable[str]) -> typing.List[int]:
+        '''Return the ids of the projects with the given names, looking up
+        those which are unknown in the database.  Names of projects which
+        don't exist are skipped.
+        '''
+        names = list(names)
+        unknown = {name for name in names if name not in self._ids}
+        if unknown:
+            q = session.query(mapper_api.models.Project.name,
+                              mapper_api.models.Project.id)
+            q = q.filter(mapper_api.models.Project.name.in_(unknown))
+            found = dict(q.all())
+            if found:
+                with self._lock:
+                    self._ids.update(found)
+        ids = self._ids
+        return [ids[name] for name in names if name in ids]
+
+    def id(self, session, name: str) -> typing.Optional[int]:
+        '''Return the id of the project with the given name, or None if there
+        is no such project.
+        '''
+        ids = self.ids(session, [name])
+        return ids[0] if ids else None
+
+
+registry = ProjectRegistry()
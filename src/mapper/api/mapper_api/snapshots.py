@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import time
+import typing
+import zlib
+
+import flask
+import sqlalchemy as sa
+import werkzeug.exceptions
+
+import cli_common.log
+import mapper_api.config
+import mapper_api.models
+import mapper_api.projects
+
+logger = cli_common.log.get_logger(__name__)
+
+# number of bytes of a snapshot read from the database at once
+SNAPSHOT_READ_SIZE = 1024 * 1024
+# a mapfile line is a git commit SHA, a space, an hg changeset SHA and a
+# newline, so the hg changeset, by which mapfiles are sorted, is at:
+HG_CHANGESET = slice(41, 81)
+
+
+def _gzip(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    # as a single gzip member, whose header has no mtime, which keeps the
+    # output, and so the etag, reproducible
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _gunzip(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def _lines(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+
+
+def _merge(chunks: typing.Iterable[bytes], lines: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    '''Merge mapfile lines into the chunks of a mapfile, both sorted by hg
+    changeset, chunk by chunk.  The chunks before the next line to merge are
+    sent as-is, so merging a few lines into a large mapfile costs little.
+    '''
+    lines = iter(lines)
+    line = next(lines, None)
+    rest = b''
+    for chunk in chunks:
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        chunk, rest = chunk[:end], chunk[end:]
+        if line is None or not chunk or line[HG_CHANGESET] > chunk[end - 41:end - 1]:
+            yield chunk
+            continue
+        merged = []
+        for chunk_line in chunk.splitlines(keepends=True):
+            while line is not None and line[HG_CHANGESET] < chunk_line[HG_CHANGESET]:
+                merged.append(line)
+                line = next(lines, None)
+            merged.append(chunk_line)
+        yield b''.join(merged)
+    yield rest
+    if line is not None:
+        yield line
+        yield from lines
+
+
+def _mapfile_chunks(session, query) -> typing.Iterator[bytes]:
+    '''Helper method to render the mapfile of a query over
+    (git_commit, hg_changeset) columns, chunk by chunk.
+    '''
+    # see mapper_api.api._stream_mapfile
+    connection = session.connection().execution_options(stream_results=True)
+    result = connection.execute(query.statement)
+    try:
+        while True:
+            rows = result.fetchmany(mapper_api.config.MAPFILE_CHUNK_SIZE)
+            if not rows:
+                break
+            yield ''.join([f'{git_commit} {hg_changeset}\n' for git_commit, hg_changeset in rows]).encode('utf-8')
+    finally:
+        result.close()
+
+
+def _snapshot_chunks(session, snapshot: mapper_api.models.Snapshot) -> typing.Iterator[bytes]:
+    '''Read the gzip-compressed mapfile of a snapshot, chunk by chunk, with
+    substring() so that it's never loaded at once.
+    '''
+    Snapshot = mapper_api.models.Snapshot
+    offset = 1
+    while True:
+        q = session.query(sa.func.substring(Snapshot.mapfile, offset, SNAPSHOT_READ_SIZE))
+        q = q.filter(Snapshot.project_id == snapshot.project_id)
+        q = q.filter(Snapshot.etag == snapshot.etag)
+        chunk = q.scalar()
+        if chunk is None:
+            # the response can only be cut short at this point
+            raise Exception(f'Snapshot {snapshot.etag} was rebuilt while it was sent.')
+        if not chunk:
+            break
+        yield bytes(chunk)
+        offset += len(chunk)
+
+
+def _mappings_query(session, project_id: int):
+    q = session.query(mapper_api.models.Hash.git_commit,
+                      mapper_api.models.Hash.hg_changeset)
+    q = q.filter(mapper_api.models.Hash.project_id == project_id)
+    return q.order_by(mapper_api.models.Hash.hg_changeset)
+
+
+def rebuild(session, project_id: int) -> mapper_api.models.Snapshot:
+    '''Build the snapshot of the full mapfile of a project, replacing the
+    previous one.  This is done by the rebuild-snapshots command, rather than
+    by the web workers.
+    Args:
+        session: SQLAlchemy ORM Session object
+        project_id: Id of the project
+    Returns:
+        The new snapshot
+    '''
+    cutoff = int(time.time()) - mapper_api.config.MAPFILE_SNAPSHOT_MARGIN
+    q = _mappings_query(session, project_id)
+    q = q.filter(mapper_api.models.Hash.date_added < cutoff)
+
+    count = 0
+
+    def counted(chunks):
+        nonlocal count
+        for chunk in chunks:
+            count += chunk.count(b'\n')
+            yield chunk
+
+    mapfile = b''.join(_gzip(counted(_mapfile_chunks(session, q))))
+    snapshot = session.merge(mapper_api.models.Snapshot(
+        project_id=project_id,
+        cutoff=cutoff,
+        count=count,
+        etag=hashlib.md5(mapfile).hexdigest(),
+        mapfile=mapfile,
+    ))
+    session.commit()
+    logger.info('Rebuilt mapfile snapshot', project_id=project_id, count=count, size=len(mapfile))
+    return snapshot
+
+
+def delta(session, snapshot: mapper_api.models.Snapshot) -> typing.Tuple[int, typing.Optional[int]]:
+    '''Return the number of mappings added to a project since its snapshot
+    was built, and the date the last one was added.
+    '''
+    q = session.query(sa.func.count(), sa.func.max(mapper_api.models.Hash.date_added))
+    q = q.filter(mapper_api.models.Hash.project_id == snapshot.project_id)
+    q = q.filter(mapper_api.models.Hash.date_added >= snapshot.cutoff)
+    return q.one()
+
+
+def serve(project: str) -> typing.Optional[flask.Response]:
+    '''Serve the full mapfile of a project from its snapshot.
+
+    The response is the snapshot, into which the mappings added since it was
+    built are merged, so that it's sorted by hg changeset like the other
+    mapfiles.  It supports If-None-Match, and is sent as a single gzip member
+    to the clients which accept it; each encoding has its own ETag.
+    Args:
+        project: Name of the project
+    Returns:
+        The response, or None if the project has no snapshot yet
+    Exceptions:
+        HTTP 404: The project has no mappings
+    '''
+    session = flask.current_app.db.session
+    project_id = mapper_api.projects.registry.id(session, project)
+    if project_id is None:
+        return None
+
+    snapshot = session.query(mapper_api.models.Snapshot).get(project_id)
+    if snapshot is None:
+        return None
+
+    # mappings are never updated nor deleted, so the number of mappings added
+    # since the snapshot and the date of the last one identify its version
+    delta_count, delta_last = delta(session, snapshot)
+    if snapshot.count + delta_count == 0:
+        raise werkzeug.exceptions.NotFound('No mappings found.')
+
+    gzipped = 'gzip' in flask.request.accept_encodings
+    etag = f'{snapshot.etag}-{delta_count}-{delta_last or 0}'
+    if gzipped:
+        etag += '-gz'
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def contents():
+        chunks = _snapshot_chunks(session, snapshot)
+        if delta_count == 0:
+            # the snapshot is sent as-is
+            yield from (chunks if gzipped else _gunzip(chunks))
+            return
+        q = _mappings_query(session, project_id)
+        q = q.filter(mapper_api.models.Hash.date_added >= snapshot.cutoff)
+        mapfile = _merge(_gunzip(chunks), _lines(_mapfile_chunks(session, q)))
+        yield from (_gzip(mapfile) if gzipped else mapfile)
+
+    # keep the request context, and so the session, around while the
+    # response is streamed
+    response = flask.Response(flask.stream_with_context(contents()), mimetype='text/plain')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+        if delta_count == 0:
+            size = session.query(sa.func.length(mapper_api.models.Snapshot.mapfile)).filter(
+                mapper_api.models.Snapshot.project_id == project_id).scalar()
+            response.headers['Content-Length'] = str(size)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,62 @@
+"""Initial mapper schema, as created by db.create_all() before migrations
+
+Revision ID: 37dcbac448e9
+Revises: None
+Create Date: 2026-10-18 11:02:14.318206
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '37dcbac448e9'
+down_revision = None
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    # the tables exist already in databases created by db.create_all()
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'releng_mapper_projects' not in tables:
+        op.create_table('releng_mapper_projects',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=255), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('name')
+        )
+    if 'releng_mapper_hashes' not in tables:
+        op.create_table('releng_mapper_hashes',
+        sa.Column('hg_changeset', sa.String(length=40), nullable=False),
+        sa.Column('git_commit', sa.String(length=40), nullable=False),
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('date_added', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['project_id'], ['releng_mapper_projects.id'], )
+        )
+    if 'releng_mapper_snapshots' not in tables:
+        op.create_table('releng_mapper_snapshots',
+        sa.Column('project_id', sa.Integer(), nullable=False),
+        sa.Column('cutoff', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('etag', sa.String(length=32), nullable=False),
+        sa.Column('mapfile', sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(['project_id'], ['releng_mapper_projects.id'], ),
+        sa.PrimaryKeyConstraint('project_id')
+        )
+
+    # the indexes exist already in databases created by db.create_all()
+    for name, columns, unique in [
+            ('hg_changeset', 'hg_changeset', False),
+            ('git_commit', 'git_commit', False),
+            ('project_id', 'project_id', False),
+            ('project_id__date_added', 'project_id, date_added', False),
+            ('project_id__hg_changeset', 'project_id, hg_changeset', True),
+            ('project_id__git_commit', 'project_id, git_commit', True),
+            ]:
+        op.execute('CREATE {}INDEX IF NOT EXISTS {} ON releng_mapper_hashes ({})'.format(
+            'UNIQUE ' if unique else '', name, columns))
+
+
+def downgrade():
+    op.drop_table('releng_mapper_snapshots')
+    op.drop_table('releng_mapper_hashes')
+    op.drop_table('releng_mapper_projects')
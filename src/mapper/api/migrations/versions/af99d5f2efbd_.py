@@ -0,0 +1,31 @@
+"""Drop the mapper hash indexes which are never used
+
+All lookups are per project: by (project_id, git_commit) or
+(project_id, hg_changeset), including abbreviated SHAs, which are looked up
+with range conditions those indexes serve, and by (project_id, date_added).
+The single-column indexes on the SHAs are never used, and the one on
+project_id is a prefix of the others.
+
+Revision ID: af99d5f2efbd
+Revises: 37dcbac448e9
+Create Date: 2026-10-18 11:05:47.902115
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'af99d5f2efbd'
+down_revision = '37dcbac448e9'
+
+from alembic import op
+
+
+def upgrade():
+    op.drop_index('hg_changeset', table_name='releng_mapper_hashes')
+    op.drop_index('git_commit', table_name='releng_mapper_hashes')
+    op.drop_index('project_id', table_name='releng_mapper_hashes')
+
+
+def downgrade():
+    op.create_index('project_id', 'releng_mapper_hashes', ['project_id'], unique=False)
+    op.create_index('git_commit', 'releng_mapper_hashes', ['git_commit'], unique=False)
+    op.create_index('hg_changeset', 'releng_mapper_hashes', ['hg_changeset'], unique=False)
@@ -41,6 +41,10 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 if DEBUG:
     SQLALCHEMY_ECHO = True
 
+# Store SHAs as 20 bytes rather than 40 characters; convert an existing
+# database with `flask convert-shas binary` before enabling it.
+BINARY_SHAS = bool(os.environ.get('BINARY_SHAS', False))
+
 # We require DATABASE_URL set by environment variables for branches deployed to Dockerflow.
 if secrets['APP_CHANNEL'] in ('testing', 'staging', 'production'):
     if 'DATABASE_URL' not in os.environ:
@@ -52,3 +56,32 @@ if secrets['APP_CHANNEL'] in ('testing', 'staging', 'production'):
         SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 else:
     SQLALCHEMY_DATABASE_URI = secrets['DATABASE_URL']
+
+
+# -- CACHE --------------------------------------------------------------------
+#
+# The revision lookups cache is shared between processes through redis, when
+# REDIS_URL is set, and kept in each process otherwise.
+#
+
+CACHE = {
+    x: os.environ.get(x)
+    for x in os.environ.keys()
+    if x.startswith('CACHE_')
+}
+
+if 'CACHE_DEFAULT_TIMEOUT' not in CACHE:
+    CACHE['CACHE_DEFAULT_TIMEOUT'] = 60 * 5
+else:
+    CACHE['CACHE_DEFAULT_TIMEOUT'] = float(CACHE['CACHE_DEFAULT_TIMEOUT'])
+
+if 'CACHE_KEY_PREFIX' not in CACHE:
+    CACHE['CACHE_KEY_PREFIX'] = mapper_api.config.PROJECT_NAME + '-'
+
+if 'REDIS_URL' in os.environ or 'REDIS_URL' in secrets:
+    CACHE['CACHE_TYPE'] = 'redis'
+    CACHE['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL', secrets.get('REDIS_URL'))
+elif 'CACHE_TYPE' not in CACHE:
+    # otherwise flask-caching falls back to its null cache, which caches
+    # nothing, and can't keep the generation of the revision lookups cache
+    CACHE['CACHE_TYPE'] = 'simple'
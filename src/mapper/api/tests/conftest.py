@@ -23,3 +23,33 @@ def app():
     with app.app_context():
         backend_common.testing.configure_app(app)
         yield app
+
+
+@pytest.fixture
+def db(app):
+    '''Empty the database, and the caches of mapper_api, after a test
+    '''
+    import mapper_api.cache
+    import mapper_api.projects
+
+    yield app.db
+    app.db.session.remove()
+    app.db.drop_all()
+    app.db.create_all()
+    mapper_api.projects.registry.load(app.db.session)
+    mapper_api.cache.revisions._entries.clear()
+    app.cache.clear()
+
+
+@pytest.fixture
+def project(db):
+    '''Create a project, named `project`
+    '''
+    import mapper_api.models
+    import mapper_api.projects
+
+    project = mapper_api.models.Project(name='project')
+    db.session.add(project)
+    db.session.commit()
+    mapper_api.projects.registry.add(project.name, project.id)
+    return project
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import backend_common.testing
+
+GIT = 'a' * 40
+HG = 'b' * 40
+
+
+def test_mappings(app, db):
+    import mapper_api.cache
+
+    cache = mapper_api.cache.RevisionCache(10)
+    cache.set('project', 'git', GIT, (GIT, HG))
+    assert cache.get('project', 'git', GIT) == (GIT, HG)
+
+    # abbreviated SHAs can become ambiguous, so their mappings aren't cached
+    cache.set('project', 'git', GIT[:12], (GIT, HG))
+    assert cache.get('project', 'git', GIT[:12]) is None
+
+    # the mappings are shared with the other processes
+    other = mapper_api.cache.RevisionCache(10)
+    assert other.get('project', 'git', GIT) == (GIT, HG)
+    assert other.stats()['shared_hits'] == 1
+
+
+def test_missing_invalidated(app, db):
+    import mapper_api.cache
+
+    cache = mapper_api.cache.RevisionCache(10)
+    other = mapper_api.cache.RevisionCache(10)
+    cache.set_missing('project', 'git', GIT)
+    assert cache.get('project', 'git', GIT) == mapper_api.cache.MISSING
+    assert other.get('project', 'git', GIT) == mapper_api.cache.MISSING
+
+    # an insert bumps the generation in the shared cache, which invalidates
+    # the missing lookups of every process at once
+    other.invalidate_missing()
+    assert other.get('project', 'git', GIT) is None
+    assert cache.get('project', 'git', GIT) is None
+    assert cache.stats()['negative_hits'] == 1
+
+
+def test_missing_invalidated_locally(app, db, monkeypatch):
+    import mapper_api.cache
+
+    # without a shared cache which counts, the inserts of a process still
+    # invalidate its own missing lookups
+    monkeypatch.setattr(mapper_api.cache.RevisionCache, '_generation', lambda self: 0)
+    cache = mapper_api.cache.RevisionCache(10)
+    cache.set_missing('project', 'hg', HG)
+    assert cache.get('project', 'hg', HG) == mapper_api.cache.MISSING
+    cache.invalidate_missing()
+    assert cache.get('project', 'hg', HG) is None
+
+
+def test_missing_expires(app, db, monkeypatch):
+    import mapper_api.cache
+    import mapper_api.config
+
+    monkeypatch.setattr(mapper_api.config, 'REVISION_CACHE_NEGATIVE_TTL', -1)
+    cache = mapper_api.cache.RevisionCache(10)
+    cache.set_missing('project', 'git', GIT)
+    assert cache.get('project', 'git', GIT) is None
+
+
+def test_lru(app, db):
+    import mapper_api.cache
+
+    cache = mapper_api.cache.RevisionCache(2)
+    for sha in ('1' * 40, '2' * 40, '3' * 40):
+        cache.set('project', 'git', sha, (sha, HG))
+    assert cache.stats()['size'] == 2
+    assert list(cache._entries) == [cache._key('project', 'git', sha) for sha in ('2' * 40, '3' * 40)]
+
+
+def test_get_revision_after_insert(client, project, db):
+    import mapper_api.config
+
+    assert client.get(f'/project/rev/git/{GIT}').status_code == 404
+
+    header = backend_common.testing.build_header('test/user@mozilla.com',
+                                                 dict(scopes=[mapper_api.config.SCOPE_MAPPING_INSERT]))
+    response = client.post('/project/insert', data=f'{GIT} {HG}\n', content_type='text/plain',
+                           headers=[('Authorization', header)])
+    assert response.status_code == 200
+
+    # the lookup which found nothing is not served from the cache anymore
+    response = client.get(f'/project/rev/git/{GIT}')
+    assert response.status_code == 200
+    assert response.data.decode('utf-8') == f'{GIT} {HG}'
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import json
+import unittest.mock
+
+import pytest
+import werkzeug.exceptions
+
+import backend_common.testing
+
+GIT_1 = 'a' * 40
+HG_1 = 'b' * 40
+GIT_2 = 'c' * 40
+HG_2 = 'd' * 40
+
+
+def auth_header():
+    import mapper_api.config
+
+    scopes = [mapper_api.config.SCOPE_MAPPING_INSERT]
+    return [('Authorization', backend_common.testing.build_header('test/user@mozilla.com', dict(scopes=scopes)))]
+
+
+def insert(client, project, data, ignore_dups=False):
+    url = f'/{project}/insert/ignoredups' if ignore_dups else f'/{project}/insert'
+    return client.post(url, data=data, content_type='text/plain', headers=auth_header())
+
+
+def mappings(db):
+    import mapper_api.models
+
+    return sorted((h.git_commit, h.hg_changeset) for h in mapper_api.models.Hash.query.all())
+
+
+def test_insert_many(client, project, db):
+    response = insert(client, 'project', f'{GIT_1} {HG_1}\n{GIT_2} {HG_2}\n')
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == dict(inserted=2, duplicates=0)
+    assert mappings(db) == [(GIT_1, HG_1), (GIT_2, HG_2)]
+
+
+def test_insert_many_conflict(client, project, db):
+    assert insert(client, 'project', f'{GIT_1} {HG_1}\n').status_code == 200
+
+    # nothing is inserted when one of the mappings already exists
+    response = insert(client, 'project', f'{GIT_2} {HG_2}\n{GIT_1} {HG_1}\n')
+    assert response.status_code == 409
+    assert mappings(db) == [(GIT_1, HG_1)]
+
+
+def test_insert_many_ignoredups(client, project, db):
+    assert insert(client, 'project', f'{GIT_1} {HG_1}\n').status_code == 200
+
+    response = insert(client, 'project', f'{GIT_1} {HG_1}\n{GIT_2} {HG_2}\n', ignore_dups=True)
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == dict(inserted=1, duplicates=1)
+    assert mappings(db) == [(GIT_1, HG_1), (GIT_2, HG_2)]
+
+
+def test_insert_many_chunks(client, project, db, monkeypatch):
+    import mapper_api.config
+
+    # the mappings are inserted, and duplicates counted, chunk by chunk
+    monkeypatch.setattr(mapper_api.config, 'INSERT_CHUNK_SIZE', 2)
+    assert insert(client, 'project', f'{GIT_2} {HG_2}\n').status_code == 200
+    lines = [f'{i:040x} {i + 100:040x}' for i in range(5)] + [f'{GIT_2} {HG_2}']
+
+    response = insert(client, 'project', '\n'.join(lines), ignore_dups=True)
+    assert json.loads(response.data.decode('utf-8')) == dict(inserted=5, duplicates=1)
+    assert len(mappings(db)) == 6
+
+
+def test_insert_many_empty(client, project, db):
+    response = insert(client, 'project', '')
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == dict(inserted=0, duplicates=0)
+
+
+def test_insert_many_errors(client, project, db):
+    assert insert(client, 'unknown', f'{GIT_1} {HG_1}\n').status_code == 404
+
+    response = client.post('/project/insert', data=f'{GIT_1} {HG_1}\n', content_type='application/json',
+                           headers=auth_header())
+    assert response.status_code == 415
+    assert mappings(db) == []
+
+
+@pytest.mark.parametrize('line', [
+    f'{GIT_1}{HG_1}',
+    f'{GIT_1} {HG_1[:39]}',
+    f'{GIT_1} {HG_1} {HG_2}',
+    f'{GIT_1.upper()} {HG_1}',
+    f'{GIT_1} {"g" * 40}',
+])
+def test_insert_many_malformed(client, project, db, line):
+    # the mappings of the lines before the malformed one aren't inserted
+    response = insert(client, 'project', f'{GIT_2} {HG_2}\n{line}\n')
+    assert response.status_code == 400
+    assert json.loads(response.data.decode('utf-8'))['status'] == 400
+    assert mappings(db) == []
+
+
+def test_insert_many_malformed_chunk(client, project, db, monkeypatch):
+    import mapper_api.config
+
+    # nor those of the chunks inserted before it, unless duplicates are
+    # ignored, in which case each chunk is committed on its own
+    monkeypatch.setattr(mapper_api.config, 'INSERT_CHUNK_SIZE', 1)
+    body = f'{GIT_1} {HG_1}\n{GIT_2} {HG_2}\nmalformed\n'
+    assert insert(client, 'project', body).status_code == 400
+    assert mappings(db) == []
+    assert insert(client, 'project', body, ignore_dups=True).status_code == 400
+    assert mappings(db) == [(GIT_1, HG_1), (GIT_2, HG_2)]
+
+
+def test_insert_many_unauthorized(client, project, db):
+    response = client.post('/project/insert', data=f'{GIT_1} {HG_1}\n', content_type='text/plain')
+    assert response.status_code == 401
+    assert mappings(db) == []
+
+
+def test_insert_many_streamed(client, project, db, monkeypatch):
+    import mapper_api.api
+
+    # the body is read from the request stream, chunk by chunk, rather than
+    # all at once by connexion
+    reads = []
+    read_lines = mapper_api.api._read_lines
+
+    def _read_lines(stream):
+        def read(size):
+            reads.append(stream.read(size))
+            return reads[-1]
+        return read_lines(unittest.mock.Mock(read=read), read_size=100)
+
+    monkeypatch.setattr(mapper_api.api, '_read_lines', _read_lines)
+    response = insert(client, 'project', f'{GIT_1} {HG_1}\r\n{GIT_2} {HG_2}')
+    assert json.loads(response.data.decode('utf-8')) == dict(inserted=2, duplicates=0)
+    assert [len(data) for data in reads] == [100, 64, 0]
+
+
+@pytest.mark.parametrize('read_size', [5, 6, 100])
+def test_read_lines(read_size):
+    import mapper_api.api
+
+    # lines and utf-8 characters can be split across reads
+    data = 'hé\nété\nhiver\n\npluie'.encode('utf-8')
+    lines = mapper_api.api._read_lines(io.BytesIO(data), read_size=read_size)
+    assert list(lines) == ['hé', 'été', 'hiver', '', 'pluie']
+
+
+@pytest.mark.parametrize('data', [
+    b'\xff\xfe\n',
+    b'a' * 20 + b'\n',
+])
+def test_read_lines_errors(data):
+    import mapper_api.api
+
+    with pytest.raises(werkzeug.exceptions.BadRequest):
+        list(mapper_api.api._read_lines(io.BytesIO(data), read_size=8))
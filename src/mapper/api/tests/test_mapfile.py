@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest.mock
+
+import sqlalchemy as sa
+
+MAPPINGS = [
+    ('1' * 40, 'c' * 40),
+    ('2' * 40, 'a' * 40),
+    ('3' * 40, 'b' * 40),
+]
+
+
+def add_mappings(session, project_id, mappings, date_added):
+    import mapper_api.api
+
+    mapper_api.api._insert_hashes(session, project_id, mappings, date_added=date_added)
+    session.commit()
+
+
+def mapfile(mappings):
+    return ''.join(f'{git_commit} {hg_changeset}\n'
+                   for git_commit, hg_changeset in sorted(mappings, key=lambda mapping: mapping[1]))
+
+
+def test_full_mapfile(client, project, db, monkeypatch):
+    import mapper_api.config
+
+    # sorted by hg changeset, whatever the size of the chunks
+    monkeypatch.setattr(mapper_api.config, 'MAPFILE_CHUNK_SIZE', 2)
+    add_mappings(db.session, project.id, MAPPINGS, 1000)
+    response = client.get('/project/mapfile/full')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    assert response.data.decode('utf-8') == mapfile(MAPPINGS)
+
+
+def test_mapfile_since(client, project, db):
+    add_mappings(db.session, project.id, MAPPINGS[:1], 1000)
+    add_mappings(db.session, project.id, MAPPINGS[1:], 2000)
+    response = client.get('/project/mapfile/since/1970-01-01T00:16:40Z')
+    assert response.status_code == 200
+    assert response.data.decode('utf-8') == mapfile(MAPPINGS[1:])
+
+    assert client.get('/project/mapfile/since/1970-01-01T00:33:20Z').status_code == 404
+    assert client.get('/project/mapfile/since/yesterday-ish').status_code == 400
+
+
+def test_full_mapfile_projects(client, project, db):
+    import mapper_api.models
+
+    other = mapper_api.models.Project(name='other')
+    db.session.add(other)
+    db.session.commit()
+    add_mappings(db.session, project.id, MAPPINGS[:2], 1000)
+    add_mappings(db.session, other.id, MAPPINGS[2:], 1000)
+
+    response = client.get('/project,other/mapfile/full')
+    assert response.status_code == 200
+    assert response.data.decode('utf-8') == mapfile(MAPPINGS)
+
+    assert client.get('/unknown/mapfile/full').status_code == 404
+
+
+def test_mapfile_stream_results(client, project, db):
+    add_mappings(db.session, project.id, MAPPINGS, 1000)
+
+    # the mappings are read through a server-side cursor
+    options = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'releng_mapper_hashes' in statement:
+            options.append(context.execution_options.get('stream_results', False))
+
+    sa.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        # after another query, so that the transaction already has a
+        # connection
+        db.session.execute('SELECT 1')
+        response = client.get('/project/mapfile/full')
+        assert response.data.decode('utf-8') == mapfile(MAPPINGS)
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert options == [True]
+
+
+def test_mapfile_not_buffered(client, project, db):
+    import connexion.apis.flask_api
+
+    add_mappings(db.session, project.id, MAPPINGS, 1000)
+
+    # connexion doesn't read the streamed mapfiles in memory to validate them
+    api = connexion.apis.flask_api.FlaskApi
+    with unittest.mock.patch.object(api, 'get_connexion_response', wraps=api.get_connexion_response) as validated:
+        response = client.get('/project/mapfile/full')
+        assert response.data.decode('utf-8') == mapfile(MAPPINGS)
+        assert not validated.called
+
+        # while the other responses are still validated
+        assert client.get('/projects').status_code == 200
+        assert validated.called
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import pytest
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
+
+SHAS = [
+    '0123456' + '0' * 33,
+    '01234567' + 'f' * 32,
+    '0123458' + 'a' * 33,
+    'ff' * 20,
+]
+
+
+@pytest.fixture
+def binary_shas(app, monkeypatch):
+    '''A session on a database of its own, whose SHAs are stored as bytes
+    '''
+    import mapper_api.models
+
+    monkeypatch.setattr(mapper_api.models, 'BINARY_SHAS', True)
+    # the storage type of the SHAs is memoized by the dialect of an engine
+    engine = sa.create_engine('sqlite://')
+    tables = [mapper_api.models.Project.__table__, mapper_api.models.Hash.__table__]
+    mapper_api.models.Hash.metadata.create_all(engine, tables=tables)
+    session = sa.orm.Session(bind=engine)
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.mark.parametrize('dialect, impl', [
+    (sqlalchemy.dialects.sqlite.dialect(), sa.types.BINARY),
+    (sqlalchemy.dialects.postgresql.dialect(), sqlalchemy.dialects.postgresql.BYTEA),
+])
+def test_sha_binary(app, monkeypatch, dialect, impl):
+    import mapper_api.models
+
+    sha = mapper_api.models.Sha()
+    assert isinstance(sha.load_dialect_impl(dialect), sa.String)
+    assert sha.process_bind_param(SHAS[0], dialect) == SHAS[0]
+
+    monkeypatch.setattr(mapper_api.models, 'BINARY_SHAS', True)
+    assert isinstance(sha.load_dialect_impl(dialect), impl)
+    value = sha.process_bind_param(SHAS[0], dialect)
+    assert value == bytes.fromhex(SHAS[0]) and len(value) == 20
+    assert sha.process_result_value(memoryview(value), dialect) == SHAS[0]
+    assert sha.process_bind_param(None, dialect) is None
+    assert sha.process_result_value(None, dialect) is None
+
+
+def test_sha_binary_storage(binary_shas):
+    import mapper_api.models
+
+    Hash = mapper_api.models.Hash
+    binary_shas.add(mapper_api.models.Project(id=1, name='project'))
+    for i, sha in enumerate(SHAS):
+        binary_shas.add(Hash(git_commit=sha, hg_changeset=SHAS[-1 - i], project_id=1, date_added=0))
+    binary_shas.commit()
+
+    # stored as 20 bytes, read as hexadecimal strings
+    assert binary_shas.execute('SELECT length(git_commit) FROM releng_mapper_hashes').scalar() == 20
+    assert [hash.git_commit for hash in binary_shas.query(Hash).order_by(Hash.git_commit)] == SHAS
+    assert binary_shas.query(Hash).filter(Hash.git_commit == SHAS[2]).one().hg_changeset == SHAS[1]
+
+
+@pytest.mark.parametrize('prefix, expected', [
+    ('0123456', SHAS[:2]),
+    ('01234567', SHAS[1:2]),
+    ('0123458a', SHAS[2:3]),
+    ('ff', SHAS[3:]),
+    ('1', []),
+    (SHAS[1], SHAS[1:2]),
+])
+def test_prefix_filter(binary_shas, prefix, expected):
+    import mapper_api.api
+    import mapper_api.models
+
+    Hash = mapper_api.models.Hash
+    binary_shas.add(mapper_api.models.Project(id=1, name='project'))
+    for sha in SHAS:
+        binary_shas.add(Hash(git_commit=sha, hg_changeset=sha, project_id=1, date_added=0))
+    binary_shas.commit()
+
+    # binary SHAs sort like hexadecimal ones, so odd length prefixes too are
+    # looked up with range conditions
+    q = binary_shas.query(Hash.git_commit)
+    q = q.filter(mapper_api.api._prefix_filter(Hash.git_commit, prefix))
+    assert sorted(sha for sha, in q) == expected
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+
+import sqlalchemy as sa
+
+import backend_common.testing
+
+
+@contextlib.contextmanager
+def queries(engine):
+    '''Record the statements run on the projects table
+    '''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'releng_mapper_projects' in statement:
+            statements.append((statement, parameters))
+
+    sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def add_project(session, name):
+    import mapper_api.models
+
+    project = mapper_api.models.Project(name=name)
+    session.add(project)
+    session.commit()
+    return project.id
+
+
+def test_registry(app, db):
+    import mapper_api.projects
+
+    first = add_project(db.session, 'first')
+    second = add_project(db.session, 'second')
+    registry = mapper_api.projects.ProjectRegistry()
+    registry.load(db.session)
+
+    # known projects are never looked up in the database
+    with queries(db.engine) as statements:
+        assert registry.ids(db.session, ['second', 'first']) == [second, first]
+        assert registry.id(db.session, 'first') == first
+    assert statements == []
+
+
+def test_registry_unknown(app, db):
+    import mapper_api.projects
+
+    first = add_project(db.session, 'first')
+    registry = mapper_api.projects.ProjectRegistry()
+    registry.load(db.session)
+
+    # e.g. created by another process: only the unknown names are looked up
+    third = add_project(db.session, 'third')
+    with queries(db.engine) as statements:
+        assert registry.ids(db.session, ['first', 'third', 'missing']) == [first, third]
+    assert len(statements) == 1
+    assert ' IN ' in statements[0][0]
+    assert sorted(statements[0][1]) == ['missing', 'third']
+
+    # and remembered, when they exist
+    with queries(db.engine) as statements:
+        assert registry.id(db.session, 'third') == third
+        assert registry.id(db.session, 'missing') is None
+    assert len(statements) == 1
+
+
+def test_registry_add(app, db):
+    import mapper_api.projects
+
+    registry = mapper_api.projects.ProjectRegistry()
+    registry.load(db.session)
+    registry.add('project', 42)
+    with queries(db.engine) as statements:
+        assert registry.id(db.session, 'project') == 42
+    assert statements == []
+
+
+def test_post_project(client, db):
+    import mapper_api.config
+    import mapper_api.projects
+
+    header = backend_common.testing.build_header('test/user@mozilla.com',
+                                                 dict(scopes=[mapper_api.config.SCOPE_PROJECT_INSERT]))
+    assert client.post('/project', headers=[('Authorization', header)]).status_code == 200
+    assert client.post('/project', headers=[('Authorization', header)]).status_code == 409
+
+    # the new project is added to the registry of the process
+    with queries(db.engine) as statements:
+        assert mapper_api.projects.registry.id(db.session, 'project') is not None
+    assert statements == []
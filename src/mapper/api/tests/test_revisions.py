@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+MAPPINGS = [
+    ('abcdef0' + '1' * 33, '0123456' + 'a' * 33),
+    ('abcdef0' + '2' * 33, '0123456' + 'b' * 33),
+    ('fedcba9' + '3' * 33, '6543210' + 'c' * 33),
+]
+
+
+@pytest.fixture
+def mappings(project, db):
+    import mapper_api.api
+
+    mapper_api.api._insert_hashes(db.session, project.id, MAPPINGS)
+    db.session.commit()
+    return MAPPINGS
+
+
+def revisions(client, vcs_type, commits, accept='text/plain', projects='project'):
+    return client.post(f'/{projects}/revs/{vcs_type}', data=json.dumps(dict(commits=commits)),
+                       content_type='application/json', headers=[('Accept', accept)])
+
+
+def test_revisions(client, mappings):
+    git_1, hg_1 = mappings[0]
+    git_3, hg_3 = mappings[2]
+    missing = 'f' * 40
+
+    # in the order of the request, skipping the SHAs which aren't mapped
+    response = revisions(client, 'git', [git_3, missing, git_1[:12]])
+    assert response.status_code == 200
+    assert response.data.decode('utf-8') == f'{git_3} {hg_3}\n{git_1} {hg_1}\n'
+
+    response = revisions(client, 'hg', [hg_1, hg_3[:7]])
+    assert response.data.decode('utf-8') == f'{git_1} {hg_1}\n{git_3} {hg_3}\n'
+
+
+def test_revisions_json(client, mappings):
+    git_1, hg_1 = mappings[0]
+
+    # an abbreviated SHA matching several mappings is ambiguous
+    commits = [git_1[:10], 'abcdef0', 'f' * 40, 'fedcba8']
+    response = revisions(client, 'git', commits, accept='application/json')
+    assert response.status_code == 200
+    assert json.loads(response.data.decode('utf-8')) == dict(
+        mappings=[dict(commit=git_1[:10], git_commit=git_1, hg_changeset=hg_1)],
+        missing=['f' * 40, 'fedcba8'],
+        ambiguous=['abcdef0'],
+    )
+
+
+def test_revisions_projects(client, mappings, db):
+    import mapper_api.api
+    import mapper_api.models
+
+    other = mapper_api.models.Project(name='other')
+    db.session.add(other)
+    db.session.commit()
+    git, hg = 'abcdef0' + '4' * 33, '0123456' + 'd' * 33
+    mapper_api.api._insert_hashes(db.session, other.id, [(git, hg)])
+    db.session.commit()
+
+    response = revisions(client, 'git', [git, mappings[2][0]], accept='application/json')
+    assert json.loads(response.data.decode('utf-8'))['missing'] == [git]
+    response = revisions(client, 'git', [git, mappings[2][0]], accept='application/json', projects='project,other')
+    assert json.loads(response.data.decode('utf-8'))['missing'] == []
+    response = revisions(client, 'git', ['abcdef0'], accept='application/json', projects='other')
+    assert json.loads(response.data.decode('utf-8'))['mappings'][0]['hg_changeset'] == hg
+
+    # no project, no mapping
+    response = revisions(client, 'git', [git], accept='application/json', projects='unknown')
+    assert json.loads(response.data.decode('utf-8'))['missing'] == [git]
+
+
+@pytest.mark.parametrize('vcs_type, commits', [
+    ('svn', ['a' * 40]),
+    ('git', ['abcdef']),
+    ('git', ['ABCDEF0']),
+    ('git', ['a' * 41]),
+    ('git', ['a' * 40] * 1001),
+])
+def test_revisions_errors(client, mappings, vcs_type, commits):
+    assert revisions(client, vcs_type, commits).status_code == 400
+
+
+def test_revision(client, mappings):
+    git, hg = mappings[2]
+
+    for vcs_type, commit in (('git', git), ('git', git[:7]), ('hg', hg)):
+        response = client.get(f'/project/rev/{vcs_type}/{commit}')
+        assert response.status_code == 200
+        assert response.data.decode('utf-8') == f'{git} {hg}'
+
+    assert client.get(f'/project/rev/git/{"f" * 40}').status_code == 404
+    assert client.get('/project/rev/git/abcdef0').status_code == 500
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import time
+
+import pytest
+import sqlalchemy as sa
+
+OLD = [
+    ('1' * 40, 'c' * 40),
+    ('2' * 40, 'a' * 40),
+    ('3' * 40, 'e' * 40),
+]
+NEW = [
+    ('4' * 40, 'b' * 40),
+    ('5' * 40, 'f' * 40),
+]
+
+
+def add_mappings(session, project_id, mappings, date_added):
+    import mapper_api.api
+
+    mapper_api.api._insert_hashes(session, project_id, mappings, date_added=date_added)
+    session.commit()
+
+
+def mapfile(mappings):
+    return ''.join(f'{git_commit} {hg_changeset}\n'
+                   for git_commit, hg_changeset in sorted(mappings, key=lambda mapping: mapping[1])).encode('utf-8')
+
+
+@pytest.fixture
+def snapshot(project, db):
+    '''Build the snapshot of the OLD mappings of `project`
+    '''
+    import mapper_api.snapshots
+
+    add_mappings(db.session, project.id, OLD, 1000)
+    return mapper_api.snapshots.rebuild(db.session, project.id)
+
+
+def test_rebuild(project, db):
+    import mapper_api.models
+    import mapper_api.snapshots
+
+    # the mappings added during the last MAPFILE_SNAPSHOT_MARGIN seconds are
+    # left out
+    add_mappings(db.session, project.id, OLD, 1000)
+    date_added = int(time.time())
+    add_mappings(db.session, project.id, NEW, date_added)
+    snapshot = mapper_api.snapshots.rebuild(db.session, project.id)
+    assert snapshot.count == len(OLD)
+    assert gzip.decompress(snapshot.mapfile) == mapfile(OLD)
+    assert mapper_api.snapshots.delta(db.session, snapshot) == (len(NEW), date_added)
+
+    # the snapshot is replaced, and is the same for the same mappings
+    etag = snapshot.etag
+    snapshot = mapper_api.snapshots.rebuild(db.session, project.id)
+    assert snapshot.etag == etag
+    assert mapper_api.models.Snapshot.query.count() == 1
+
+
+def test_serve(client, snapshot, db):
+    response = client.get('/project/mapfile/full')
+    assert response.status_code == 200
+    assert response.data == mapfile(OLD)
+    assert response.headers['ETag'] == f'"{snapshot.etag}-0-0"'
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_serve_gzip(client, snapshot, db):
+    # the snapshot is sent as-is, with an ETag of its own
+    response = client.get('/project/mapfile/full', headers=[('Accept-Encoding', 'gzip')])
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['ETag'] == f'"{snapshot.etag}-0-0-gz"'
+    assert int(response.headers['Content-Length']) == len(snapshot.mapfile)
+    assert response.data == snapshot.mapfile
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_serve_delta(client, snapshot, db, monkeypatch, encoding):
+    import mapper_api.config
+    import mapper_api.snapshots
+
+    # the mappings added since the snapshot are merged into it, chunk by
+    # chunk
+    monkeypatch.setattr(mapper_api.snapshots, 'SNAPSHOT_READ_SIZE', 50)
+    monkeypatch.setattr(mapper_api.config, 'MAPFILE_CHUNK_SIZE', 1)
+    date_added = int(time.time())
+    add_mappings(db.session, snapshot.project_id, NEW, date_added)
+
+    response = client.get('/project/mapfile/full', headers=[('Accept-Encoding', encoding)])
+    assert response.status_code == 200
+    data = response.data
+    if encoding == 'gzip':
+        assert 'Content-Length' not in response.headers
+        data = gzip.decompress(data)
+    assert data == mapfile(OLD + NEW)
+    assert response.headers['ETag'].startswith(f'"{snapshot.etag}-{len(NEW)}-{date_added}')
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_serve_not_modified(client, snapshot, db, encoding):
+    headers = [('Accept-Encoding', encoding)]
+    etag = client.get('/project/mapfile/full', headers=headers).headers['ETag']
+
+    response = client.get('/project/mapfile/full', headers=headers + [('If-None-Match', etag)])
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    # the ETag changes when mappings are added
+    add_mappings(db.session, snapshot.project_id, NEW, int(time.time()))
+    response = client.get('/project/mapfile/full', headers=headers + [('If-None-Match', etag)])
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_serve_empty(client, project, db):
+    import mapper_api.snapshots
+
+    mapper_api.snapshots.rebuild(db.session, project.id)
+    assert client.get('/project/mapfile/full').status_code == 404
+
+
+def test_merge():
+    import mapper_api.snapshots
+
+    old = mapfile(OLD)
+    chunks = [old[i:i + 30] for i in range(0, len(old), 30)]
+    lines = mapfile(NEW).splitlines(keepends=True)
+    assert b''.join(mapper_api.snapshots._merge(chunks, lines)) == mapfile(OLD + NEW)
+    assert b''.join(mapper_api.snapshots._merge(chunks, [])) == old
+    assert b''.join(mapper_api.snapshots._merge([], lines)) == mapfile(NEW)
+
+
+def test_rebuild_snapshots_command(app, project, db, monkeypatch):
+    import mapper_api.cli
+    import mapper_api.config
+    import mapper_api.models
+
+    project_id = project.id
+    add_mappings(db.session, project_id, OLD, 1000)
+    runner = app.test_cli_runner()
+    assert runner.invoke(mapper_api.cli.cmd_rebuild_snapshots, []).exit_code == 0
+    snapshot = mapper_api.models.Snapshot.query.get(project_id)
+    assert snapshot.count == len(OLD)
+
+    # the snapshots are only rebuilt once enough mappings were added
+    monkeypatch.setattr(mapper_api.config, 'MAPFILE_SNAPSHOT_DELTA_THRESHOLD', 1)
+    add_mappings(db.session, project_id, NEW[:1], int(time.time()))
+    assert runner.invoke(mapper_api.cli.cmd_rebuild_snapshots, []).exit_code == 0
+    assert mapper_api.models.Snapshot.query.get(project_id).cutoff == snapshot.cutoff
+    assert runner.invoke(mapper_api.cli.cmd_rebuild_snapshots, ['--force']).exit_code == 0
+    db.session.expire_all()
+    assert mapper_api.models.Snapshot.query.get(project_id).cutoff >= snapshot.cutoff
+
+
+def test_snapshot_stream_results(project, db):
+    import mapper_api.snapshots
+
+    add_mappings(db.session, project.id, OLD, 1000)
+    options = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if 'releng_mapper_hashes' in statement and 'count' not in statement:
+            options.append(context.execution_options.get('stream_results', False))
+
+    sa.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        db.session.execute('SELECT 1')
+        mapper_api.snapshots.rebuild(db.session, project.id)
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert options == [True]
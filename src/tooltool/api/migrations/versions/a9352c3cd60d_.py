@@ -0,0 +1,26 @@
+"""Add the id of the multipart upload of pending uploads
+
+Revision ID: a9352c3cd60d
+Revises: d3ec90ac4f12
+Create Date: 2026-10-18 16:44:51.027735
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a9352c3cd60d'
+down_revision = 'd3ec90ac4f12'
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    # databases created by db.create_all() since the column was added have it
+    columns = sa.inspect(op.get_bind()).get_columns('releng_tooltool_pending_upload')
+    if 'multipart_upload_id' not in [column['name'] for column in columns]:
+        op.add_column('releng_tooltool_pending_upload',
+                      sa.Column('multipart_upload_id', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    op.drop_column('releng_tooltool_pending_upload', 'multipart_upload_id')
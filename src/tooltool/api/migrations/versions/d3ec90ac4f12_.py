@@ -0,0 +1,81 @@
+"""Initial tooltool schema, as created by db.create_all() before migrations
+
+Revision ID: d3ec90ac4f12
+Revises: None
+Create Date: 2026-10-18 16:40:12.381204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd3ec90ac4f12'
+down_revision = None
+
+import sqlalchemy as sa
+from alembic import op
+
+REGIONS = ('us-east-1', 'us-west-1', 'us-west-2')
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.has_table(bind, 'releng_tooltool_files'):
+        # the schema was created by db.create_all()
+        return
+
+    # the enum types are shared by several tables: bound to their own
+    # metadata, they are created once here rather than with each table
+    metadata = sa.MetaData()
+    visibility = sa.Enum('public', 'internal', name='visibility', metadata=metadata)
+    region = sa.Enum(*REGIONS, name='region', metadata=metadata)
+    visibility.create(bind, checkfirst=True)
+    region.create(bind, checkfirst=True)
+
+    op.create_table('releng_tooltool_files',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('size', sa.Integer(), nullable=False),
+    sa.Column('sha512', sa.String(length=128), nullable=False),
+    sa.Column('visibility', visibility, nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('sha512')
+    )
+    op.create_table('releng_tooltool_batches',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('uploaded', sa.DateTime(), nullable=False),
+    sa.Column('author', sa.Text(), nullable=False),
+    sa.Column('message', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_releng_tooltool_batches_uploaded', 'releng_tooltool_batches', ['uploaded'], unique=False)
+    op.create_table('releng_tooltool_file_instances',
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.Column('region', region, nullable=False),
+    sa.ForeignKeyConstraint(['file_id'], ['releng_tooltool_files.id'], ),
+    sa.PrimaryKeyConstraint('file_id', 'region')
+    )
+    op.create_table('releng_tooltool_batch_files',
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.Column('batch_id', sa.Integer(), nullable=False),
+    sa.Column('filename', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['batch_id'], ['releng_tooltool_batches.id'], ),
+    sa.ForeignKeyConstraint(['file_id'], ['releng_tooltool_files.id'], ),
+    sa.PrimaryKeyConstraint('file_id', 'batch_id')
+    )
+    op.create_table('releng_tooltool_pending_upload',
+    sa.Column('file_id', sa.Integer(), nullable=False),
+    sa.Column('expires', sa.DateTime(), nullable=False),
+    sa.Column('region', region, nullable=False),
+    sa.ForeignKeyConstraint(['file_id'], ['releng_tooltool_files.id'], ),
+    sa.PrimaryKeyConstraint('file_id')
+    )
+    op.create_index('ix_releng_tooltool_pending_upload_expires', 'releng_tooltool_pending_upload', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_table('releng_tooltool_pending_upload')
+    op.drop_table('releng_tooltool_batch_files')
+    op.drop_table('releng_tooltool_file_instances')
+    op.drop_table('releng_tooltool_batches')
+    op.drop_table('releng_tooltool_files')
+    bind = op.get_bind()
+    sa.Enum(*REGIONS, name='region').drop(bind, checkfirst=True)
+    sa.Enum('public', 'internal', name='visibility').drop(bind, checkfirst=True)
@@ -34,6 +34,10 @@ existing['ALLOW_ANONYMOUS_PUBLIC_DOWNLOAD'] = False
 # time has elapsed, otherwise a malicious uploader could alter a file
 # after it had been verified.
 existing['UPLOAD_EXPIRES_IN'] = 60
+# Large files are uploaded in parts of this size.  Part URLs can expire later,
+# since a multipart upload cannot be altered once the server completed it.
+existing['UPLOAD_PART_SIZE'] = 64 * 1024 * 1024
+existing['UPLOAD_PART_EXPIRES_IN'] = 3600
 existing['DOWLOAD_EXPIRES_IN'] = 60
 
 secrets = cli_common.taskcluster.get_secrets(
@@ -3,6 +3,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import unittest.mock
+
 import pytest
 
 import backend_common
@@ -17,7 +19,11 @@ def app():
     config = backend_common.testing.get_app_config({
         'SQLALCHEMY_DATABASE_URI': 'sqlite://',
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
-        'S3_REGIONS': dict(),
+        'S3_REGIONS': {'us-east-1': 'tooltool-bucket'},
+        'UPLOAD_EXPIRES_IN': 60,
+        'UPLOAD_PART_SIZE': 64 * 1024 * 1024,
+        'UPLOAD_PART_EXPIRES_IN': 3600,
+        'PULSE_USER': 'tooltool',
         'S3_REGIONS_ACCESS_KEY_ID': '123',
         'S3_REGIONS_SECRET_ACCESS_KEY': '123',
     })
@@ -26,3 +32,31 @@ def app():
     with app.app_context():
         backend_common.testing.configure_app(app)
         yield app
+
+
+@pytest.fixture
+def aws(app):
+    '''Mock the S3 connections of tooltool_api
+    '''
+    with unittest.mock.patch.object(app, 'aws') as aws:
+        s3 = aws.connect_to.return_value
+        s3.generate_url.side_effect = lambda method, bucket, key, **kwargs: f'https://s3/{bucket}/{key}?{method}'
+        yield aws
+
+
+@pytest.fixture
+def pulse(app):
+    '''Mock the pulse messages sent by tooltool_api
+    '''
+    with unittest.mock.patch.object(app, 'pulse') as pulse:
+        yield pulse
+
+
+@pytest.fixture
+def db(app):
+    '''Empty the database after a test
+    '''
+    yield app.db
+    app.db.session.rollback()
+    app.db.drop_all()
+    app.db.create_all()
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import hashlib
+import json
+import unittest.mock
+
+import backend_common.testing
+
+MB = 1024 * 1024
+DATA = b'tooltool\n'
+DIGEST = hashlib.sha512(DATA).hexdigest()
+BIG_DIGEST = '1' * 128
+
+
+def auth_header(*visibilities):
+    import tooltool_api.config
+
+    scopes = [f'{tooltool_api.config.SCOPE_PREFIX}/upload/{visibility}' for visibility in visibilities]
+    return [('Authorization', backend_common.testing.build_header('test/user@mozilla.com', dict(scopes=scopes)))]
+
+
+def upload(client, files, visibility='internal'):
+    body = dict(
+        message='an upload',
+        files={
+            filename: dict(algorithm='sha512', visibility=visibility, **info)
+            for filename, info in files.items()
+        },
+    )
+    response = client.post('/upload', data=json.dumps(body), content_type='application/json',
+                           headers=auth_header(visibility))
+    assert response.status_code == 200, response.data
+    return json.loads(response.data.decode('utf-8'))['result']
+
+
+def test_upload_batch_multipart(app, client, aws, db):
+    import tooltool_api.models
+    import tooltool_api.utils
+
+    aws.connect_to.return_value.get_bucket.return_value.initiate_multipart_upload.return_value.id = 'upload-id'
+
+    batch = upload(client, {
+        'big.tar': dict(digest=BIG_DIGEST, size=100 * MB, multipart=True),
+        'small.txt': dict(digest=DIGEST, size=len(DATA), multipart=True),
+    })
+
+    # only the files larger than a part are uploaded in parts
+    big = batch['files']['big.tar']
+    assert big['part_size'] == 64 * MB
+    assert len(big['part_urls']) == 2
+    assert 'put_url' not in big and 'multipart' not in big
+    small = batch['files']['small.txt']
+    assert 'part_urls' not in small
+    assert small['put_url'] == f'https://s3/tooltool-bucket/{tooltool_api.utils.keyname(DIGEST)}?PUT'
+
+    # the part URLs are signed with the upload id and part number, and expire
+    # later than single-part upload URLs
+    calls = aws.connect_to.return_value.generate_url.call_args_list
+    part_calls = [call[1] for call in calls if 'response_headers' in call[1]]
+    assert [call['response_headers'] for call in part_calls] == [
+        dict(partNumber='1', uploadId='upload-id'),
+        dict(partNumber='2', uploadId='upload-id'),
+    ]
+    assert all(call['expires_in'] == 3600 for call in part_calls)
+
+    pending_uploads = {
+        pending_upload.file.sha512: pending_upload
+        for pending_upload in tooltool_api.models.PendingUpload.query.all()
+    }
+    assert pending_uploads[BIG_DIGEST].multipart_upload_id == 'upload-id'
+    assert pending_uploads[DIGEST].multipart_upload_id is None
+
+    # the pending uploads expire along with their URLs
+    now = tooltool_api.utils.now()
+    for digest, expires_in in ((BIG_DIGEST, 3600), (DIGEST, 60)):
+        expires = pending_uploads[digest].expires.replace(tzinfo=now.tzinfo)
+        assert now < expires <= now + datetime.timedelta(seconds=expires_in)
+        assert expires > now + datetime.timedelta(seconds=expires_in - 10)
+
+
+def add_pending_upload(session, digest, size, multipart_upload_id, expired=True):
+    import tooltool_api.models
+    import tooltool_api.utils
+
+    file = tooltool_api.models.File(sha512=digest, visibility='internal', size=size)
+    session.add(file)
+    session.flush()
+    expires = tooltool_api.utils.now() + datetime.timedelta(seconds=-10 if expired else 10)
+    session.add(tooltool_api.models.PendingUpload(file_id=file.id, region='us-east-1', expires=expires,
+                                                  multipart_upload_id=multipart_upload_id))
+    session.commit()
+    return file
+
+
+def mock_key(bucket, data):
+    key = bucket.get_key.return_value
+    key.size = len(data)
+    key.__iter__.return_value = [data]
+    key.storage_class = 'STANDARD'
+    key.get_redirect.return_value = None
+    return key
+
+
+def mock_part(size):
+    return unittest.mock.Mock(size=size)
+
+
+def mock_multipart_upload(parts):
+    multipart_upload = unittest.mock.MagicMock()
+    multipart_upload.__iter__.return_value = parts
+    return unittest.mock.patch('tooltool_api.cli._multipart_upload', return_value=multipart_upload)
+
+
+def test_check_pending_upload_multipart_complete(app, aws, db):
+    import tooltool_api.cli
+    import tooltool_api.models
+
+    file = add_pending_upload(db.session, DIGEST, len(DATA), 'upload-id')
+    bucket = aws.connect_to.return_value.get_bucket.return_value
+    mock_key(bucket, DATA)
+    with mock_multipart_upload([mock_part(len(DATA))]) as _multipart_upload:
+        tooltool_api.cli.check_pending_upload(db.session, file.pending_uploads[0])
+    multipart_upload = _multipart_upload.return_value
+
+    # the parts are assembled, and the file verified
+    multipart_upload.complete_upload.assert_called_once_with()
+    assert [instance.region for instance in file.instances] == ['us-east-1']
+    assert tooltool_api.models.PendingUpload.query.count() == 0
+
+
+def test_check_pending_upload_multipart_incomplete(app, aws, db):
+    import tooltool_api.cli
+    import tooltool_api.models
+
+    file = add_pending_upload(db.session, DIGEST, len(DATA), 'upload-id')
+    with mock_multipart_upload([mock_part(len(DATA) - 1)]) as _multipart_upload:
+        tooltool_api.cli.check_pending_upload(db.session, file.pending_uploads[0])
+    multipart_upload = _multipart_upload.return_value
+
+    # some parts are missing, so the upload is checked again later
+    assert not multipart_upload.complete_upload.called
+    assert file.instances == []
+    assert tooltool_api.models.PendingUpload.query.count() == 1
+
+
+def test_check_pending_upload_multipart_not_expired(app, aws, db):
+    import tooltool_api.cli
+
+    file = add_pending_upload(db.session, DIGEST, len(DATA), 'upload-id', expired=False)
+    with mock_multipart_upload([mock_part(len(DATA))]) as _multipart_upload:
+        tooltool_api.cli.check_pending_upload(db.session, file.pending_uploads[0])
+
+    # parts can still be uploaded, so the upload can't be completed yet
+    assert not _multipart_upload.called
+    assert not aws.connect_to.called
+
+
+def test_batch_status_multipart_verify_after(app, client, aws, db):
+    import tooltool_api.utils
+
+    aws.connect_to.return_value.get_bucket.return_value.initiate_multipart_upload.return_value.id = 'upload-id'
+    batch = upload(client, {'big.tar': dict(digest=BIG_DIGEST, size=100 * MB, multipart=True)})
+    response = client.get(f'/upload/{batch["id"]}/status')
+    assert response.status_code == 200
+    status = json.loads(response.data.decode('utf-8'))['result']
+
+    # clients waiting for the upload to be verified need to wait until the
+    # part URLs expire
+    file = status['files']['big.tar']
+    assert file['state'] == 'pending'
+    now = tooltool_api.utils.now().timestamp()
+    assert now + 3600 - 10 < file['verify_after'] <= now + 3600 + 1
+
+
+def add_instance(session, file):
+    import tooltool_api.models
+
+    session.add(tooltool_api.models.FileInstance(file=file, region='us-east-1'))
+    session.commit()
+
+
+def test_upload_batch_complete(app, client, aws, pulse, db):
+    import tooltool_api.models
+
+    batch = upload(client, {
+        'a.txt': dict(digest=DIGEST, size=len(DATA)),
+        'b.txt': dict(digest=BIG_DIGEST, size=len(DATA)),
+    })
+    pending_upload = tooltool_api.models.PendingUpload.query.first()
+
+    response = client.post(f'/upload/{batch["id"]}/complete', data=json.dumps(dict(digests=[DIGEST])),
+                           content_type='application/json')
+    assert response.status_code == 202
+    status = json.loads(response.data.decode('utf-8'))['result']
+    assert status['complete'] is False
+    assert {file['state'] for file in status['files'].values()} == {'pending'}
+
+    # the worker is asked to check the files once their upload URLs expired
+    exchange, route, payload = pulse.publish.call_args[0]
+    assert route == 'check_file_pending_uploads'
+    assert payload['digests'] == [DIGEST]
+    assert payload['not_before'] == pending_upload.expires.timestamp() + 1
+
+    # without digests, all the files of the batch are checked
+    response = client.post(f'/upload/{batch["id"]}/complete', data='{}', content_type='application/json')
+    assert response.status_code == 202
+    assert sorted(pulse.publish.call_args[0][2]['digests']) == sorted([DIGEST, BIG_DIGEST])
+
+
+def test_upload_batch_complete_errors(app, client, aws, pulse, db):
+    batch = upload(client, {'a.txt': dict(digest=DIGEST, size=len(DATA))})
+
+    response = client.post(f'/upload/{batch["id"]}/complete', data=json.dumps(dict(digests=[BIG_DIGEST])),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+    response = client.post(f'/upload/{batch["id"] + 1}/complete', data='{}', content_type='application/json')
+    assert response.status_code == 404
+    assert not pulse.publish.called
+
+
+def test_get_batch_status(app, client, aws, db):
+    import tooltool_api.models
+
+    batch = upload(client, {
+        'verified.txt': dict(digest=DIGEST, size=len(DATA)),
+        'pending.txt': dict(digest=BIG_DIGEST, size=len(DATA)),
+        'failed.txt': dict(digest='2' * 128, size=len(DATA)),
+    })
+    files = {file.sha512: file for file in tooltool_api.models.File.query.all()}
+    add_instance(db.session, files[DIGEST])
+    db.session.delete(files[DIGEST].pending_uploads[0])
+    db.session.delete(files['2' * 128].pending_uploads[0])
+    db.session.commit()
+
+    response = client.get(f'/upload/{batch["id"]}/status')
+    assert response.status_code == 200
+    status = json.loads(response.data.decode('utf-8'))['result']
+    assert status['id'] == batch['id']
+    assert status['complete'] is False
+    assert {filename: file['state'] for filename, file in status['files'].items()} == {
+        'verified.txt': 'verified',
+        'pending.txt': 'pending',
+        'failed.txt': 'failed',
+    }
+    assert status['files']['pending.txt']['digest'] == BIG_DIGEST
+    assert 'verify_after' not in status['files']['verified.txt']
+
+    # once all the files are verified, the batch is complete
+    add_instance(db.session, files[BIG_DIGEST])
+    db.session.delete(files[BIG_DIGEST].pending_uploads[0])
+    add_instance(db.session, files['2' * 128])
+    status = json.loads(client.get(f'/upload/{batch["id"]}/status').data.decode('utf-8'))['result']
+    assert status['complete'] is True
+
+    assert client.get(f'/upload/{batch["id"] + 1}/status').status_code == 404
+
+
+def handle_message(payload):
+    import asyncio
+    import tooltool_api.cli
+
+    acked = []
+
+    async def basic_client_ack(delivery_tag):
+        acked.append(delivery_tag)
+
+    channel = unittest.mock.Mock(basic_client_ack=basic_client_ack)
+    body = json.dumps(dict(payload=payload)).encode('utf-8')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(tooltool_api.cli.check_file_pending_uploads(
+        channel, body, unittest.mock.Mock(delivery_tag=1), None))
+    # let the checks which are due run
+    loop.run_until_complete(asyncio.sleep(0.1))
+    return acked
+
+
+def test_check_file_pending_uploads(app):
+    with unittest.mock.patch('tooltool_api.cli.check_files_pending_uploads') as check:
+        assert handle_message(dict(digest=DIGEST)) == [1]
+    check.assert_called_once_with(app, [DIGEST])
+
+
+def test_check_file_pending_uploads_not_before(app):
+    import tooltool_api.utils
+
+    # the message is acknowledged right away, while the checks wait for the
+    # upload URLs to expire
+    not_before = tooltool_api.utils.now().timestamp() + 60
+    with unittest.mock.patch('tooltool_api.cli.check_files_pending_uploads') as check:
+        assert handle_message(dict(digests=[DIGEST], not_before=not_before)) == [1]
+    assert not check.called
+
+
+def test_check_files_pending_uploads_failure(app, db):
+    import tooltool_api.cli
+    import tooltool_api.models
+
+    add_pending_upload(db.session, DIGEST, len(DATA), None)
+    with unittest.mock.patch('tooltool_api.cli.check_pending_upload', side_effect=Exception('S3 is down')):
+        tooltool_api.cli.check_files_pending_uploads(app, [DIGEST])
+
+    # the session of the worker is still usable afterwards
+    with unittest.mock.patch('tooltool_api.cli.check_pending_upload') as check:
+        tooltool_api.cli.check_files_pending_uploads(app, [DIGEST])
+    assert check.called
+    assert tooltool_api.models.PendingUpload.query.count() == 1
@@ -28,3 +28,15 @@ def test_is_valid_sha512():
 
     assert tooltool_api.utils.is_valid_sha512('123') is None
     assert tooltool_api.utils.is_valid_sha512(VALID_SHA512).string == VALID_SHA512
+
+
+def test_multipart_part_size():
+    import tooltool_api.utils
+
+    MB = 1024 * 1024
+
+    assert tooltool_api.utils.multipart_part_size(100 * MB, 64 * MB) == 64 * MB
+    assert tooltool_api.utils.multipart_part_size(10000 * 100 * MB, 64 * MB) == 100 * MB
+    assert tooltool_api.utils.multipart_part_count(100 * MB, 64 * MB) == 2
+    assert tooltool_api.utils.multipart_part_count(128 * MB, 64 * MB) == 2
+    assert tooltool_api.utils.multipart_part_count(0, 64 * MB) == 1
@@ -55,6 +55,37 @@ def get_batch(id: int) -> dict:
     return row.to_dict()
 
 
+def _start_multipart_upload(s3, bucket: str, info: dict, part_size: int, expires_in: int) -> str:
+    '''Start a multipart upload of the file described by `info`, and add the
+       size of its parts and a signed PUT URL for each of them to `info`.
+
+       Returns the id of the multipart upload.
+    '''
+    key = tooltool_api.utils.keyname(info['digest'])
+    multipart_upload = s3.get_bucket(bucket, validate=False).initiate_multipart_upload(
+        key,
+        headers={'Content-Type': 'application/octet-stream'},
+    )
+    part_size = tooltool_api.utils.multipart_part_size(info['size'], part_size)
+    info['part_size'] = part_size
+    # boto has no explicit support for signing the query arguments of an
+    # UploadPart request, but it signs the ones passed as response headers
+    info['part_urls'] = [
+        s3.generate_url(
+            method='PUT',
+            expires_in=expires_in,
+            bucket=bucket,
+            key=key,
+            response_headers={
+                'partNumber': str(part_number),
+                'uploadId': multipart_upload.id,
+            },
+        )
+        for part_number in range(1, tooltool_api.utils.multipart_part_count(info['size'], part_size) + 1)
+    ]
+    return multipart_upload.id
+
+
 def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     if not body['message']:
         raise werkzeug.exceptions.BadRequest('message must be non-empty')
@@ -69,6 +100,14 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     if type(UPLOAD_EXPIRES_IN) is not int:
         raise werkzeug.exceptions.InternalServerError('UPLOAD_EXPIRES_IN should be of type int.')
 
+    UPLOAD_PART_SIZE = flask.current_app.config['UPLOAD_PART_SIZE']
+    if type(UPLOAD_PART_SIZE) is not int:
+        raise werkzeug.exceptions.InternalServerError('UPLOAD_PART_SIZE should be of type int.')
+
+    UPLOAD_PART_EXPIRES_IN = flask.current_app.config['UPLOAD_PART_EXPIRES_IN']
+    if type(UPLOAD_PART_EXPIRES_IN) is not int:
+        raise werkzeug.exceptions.InternalServerError('UPLOAD_PART_EXPIRES_IN should be of type int.')
+
     S3_REGIONS = flask.current_app.config['S3_REGIONS']  # type: typing.Dict[str, str]
     if type(S3_REGIONS) is not dict:
         raise werkzeug.exceptions.InternalServerError('S3_REGIONS should be of type dict.')
@@ -121,15 +160,22 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
                                                 size=info['size'])
                 session.add(file)
 
-            logger2.info(f'Generating signed S3 PUT URL to {info["digest"][:10]} for {flask_login.current_user}; expiring in {UPLOAD_EXPIRES_IN}s')
-
-            info['put_url'] = s3.generate_url(
-                method='PUT',
-                expires_in=UPLOAD_EXPIRES_IN,
-                bucket=bucket,
-                key=tooltool_api.utils.keyname(info['digest']),
-                headers={'Content-Type': 'application/octet-stream'},
-            )
+            multipart_upload_id = None
+            if info.get('multipart') and info['size'] > UPLOAD_PART_SIZE:
+                multipart_upload_id = _start_multipart_upload(s3, bucket, info, UPLOAD_PART_SIZE, UPLOAD_PART_EXPIRES_IN)
+                logger2.info(f'Generated {len(info["part_urls"])} signed S3 PUT URLs for the parts of {info["digest"][:10]} '
+                             f'for {flask_login.current_user}; expiring in {UPLOAD_PART_EXPIRES_IN}s')
+            else:
+                logger2.info(f'Generating signed S3 PUT URL to {info["digest"][:10]} for {flask_login.current_user}; expiring in {UPLOAD_EXPIRES_IN}s')
+
+                info['put_url'] = s3.generate_url(
+                    method='PUT',
+                    expires_in=UPLOAD_EXPIRES_IN,
+                    bucket=bucket,
+                    key=tooltool_api.utils.keyname(info['digest']),
+                    headers={'Content-Type': 'application/octet-stream'},
+                )
+            info.pop('multipart', None)
 
             # The PendingUpload row needs to reflect the updated expiration
             # time, even if there's an existing pending upload that expires
@@ -138,10 +184,14 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
             # rather than just a reference to the file object; and for that, we
             # need to flush the inserted file.
             session.flush()
-            expires = tooltool_api.utils.now() + datetime.timedelta(seconds=UPLOAD_EXPIRES_IN)
+            # the parts of a multipart upload can be uploaded as long as their
+            # URLs are valid, which is longer
+            expires_in = UPLOAD_PART_EXPIRES_IN if multipart_upload_id else UPLOAD_EXPIRES_IN
+            expires = tooltool_api.utils.now() + datetime.timedelta(seconds=expires_in)
             pu = tooltool_api.models.PendingUpload(file_id=file.id,
                                                    region=region,
-                                                   expires=expires)
+                                                   expires=expires,
+                                                   multipart_upload_id=multipart_upload_id)
             session.merge(pu)
 
         session.add(tooltool_api.models.BatchFile(filename=filename, file=file, batch=batch))
@@ -153,6 +203,83 @@ def upload_batch(body: dict, region: typing.Optional[str] = None) -> dict:
     return dict(result=body)
 
 
+def _publish_check_pending_uploads(payload: dict) -> None:
+    exchange = f'exchange/{flask.current_app.config["PULSE_USER"]}/{tooltool_api.config.PROJECT_NAME}'
+    logger.info(f'Sending {payload} to queue `{exchange}` for route `{tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS}`.')
+    try:
+        flask.current_app.pulse.publish(
+            exchange,
+            tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS,
+            payload,
+        )
+    except Exception as e:
+        import traceback
+        msg = 'Can\'t send notification to pulse.'
+        trace = traceback.format_exc()
+        logger.error(f'{msg}\nException:{e}\nTraceback: {trace}')
+
+
+def _verify_after(pending_uploads) -> datetime.datetime:
+    '''Return when pending uploads can be verified, once their URLs expired.
+    '''
+    # add 1 second to avoid rounding / skew errors
+    return max(pending_upload.expires.replace(tzinfo=pytz.UTC)
+               for pending_upload in pending_uploads) + datetime.timedelta(seconds=1)
+
+
+def _batch_status(batch: tooltool_api.models.Batch) -> dict:
+    files = {}
+    for filename, file in batch.files.items():
+        status = dict(digest=file.sha512)
+        if file.instances:
+            status['state'] = 'verified'
+        elif file.pending_uploads:
+            status['state'] = 'pending'
+            status['verify_after'] = _verify_after(file.pending_uploads).timestamp()
+        else:
+            # the upload was abandoned, or deleted because it was invalid
+            status['state'] = 'failed'
+        files[filename] = status
+    return dict(
+        id=batch.id,
+        complete=all(file['state'] == 'verified' for file in files.values()),
+        files=files,
+    )
+
+
+def get_batch_status(id: int) -> dict:
+    batch = tooltool_api.models.Batch.query.filter(tooltool_api.models.Batch.id == id).first()
+    if not batch:
+        raise werkzeug.exceptions.NotFound
+    return dict(result=_batch_status(batch))
+
+
+def upload_batch_complete(id: int, body: dict) -> typing.Tuple[dict, int]:
+    batch = tooltool_api.models.Batch.query.filter(tooltool_api.models.Batch.id == id).first()
+    if not batch:
+        raise werkzeug.exceptions.NotFound
+
+    files = {file.sha512: file for file in batch.files.values()}
+    digests = body.get('digests') or list(files)
+    for digest in digests:
+        if digest not in files:
+            raise werkzeug.exceptions.BadRequest(f'File {digest} is not part of batch {id}')
+
+    # uploads cannot be verified until their URLs expired, so the worker is
+    # asked to verify all of them once the last one expires
+    pending_digests = [digest for digest in digests if files[digest].pending_uploads]
+    if pending_digests:
+        not_before = _verify_after([
+            pending_upload
+            for digest in pending_digests
+            for pending_upload in files[digest].pending_uploads
+        ])
+        _publish_check_pending_uploads(dict(digests=pending_digests,
+                                            not_before=not_before.timestamp()))
+
+    return dict(result=_batch_status(batch)), 202
+
+
 def upload_complete(digest: str) -> typing.Union[werkzeug.Response,
                                                  typing.Tuple[str, int]]:
 
@@ -171,19 +298,7 @@ def upload_complete(digest: str) -> typing.Union[werkzeug.Response,
                 headers = {'X-Retry-After': str(1 + int(until.total_seconds()))}
                 return werkzeug.Response(status=409, headers=headers)
 
-    exchange = f'exchange/{flask.current_app.config["PULSE_USER"]}/{tooltool_api.config.PROJECT_NAME}'
-    logger.info(f'Sending digest `{digest}` to queue `{exchange}` for route `{tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS}`.')
-    try:
-        flask.current_app.pulse.publish(
-            exchange,
-            tooltool_api.config.PULSE_ROUTE_CHECK_FILE_PENDING_UPLOADS,
-            dict(digest=digest),
-        )
-    except Exception as e:
-        import traceback
-        msg = 'Can\'t send notification to pulse.'
-        trace = traceback.format_exc()
-        logger.error(f'{msg}\nException:{e}\nTraceback: {trace}')
+    _publish_check_pending_uploads(dict(digest=digest))
 
     return '{}', 202
 
@@ -8,6 +8,8 @@ import datetime
 import hashlib
 import json
 
+import boto.exception
+import boto.s3.multipart
 import click
 import flask
 import pytz
@@ -101,6 +103,47 @@ def verify_file_instance(sha512, size, key):
     return True
 
 
+def _multipart_upload(bucket, sha512, upload_id):
+    multipart_upload = boto.s3.multipart.MultiPartUpload(bucket)
+    multipart_upload.key_name = tooltool_api.utils.keyname(sha512)
+    multipart_upload.id = upload_id
+    return multipart_upload
+
+
+def complete_multipart_upload(bucket, sha512, size, upload_id):
+    '''Assemble the uploaded parts of a multipart upload into its key.  Returns
+       False if the parts uploaded so far don't add up to the file size yet.
+    '''
+    multipart_upload = _multipart_upload(bucket, sha512, upload_id)
+    try:
+        uploaded = sum(part.size for part in multipart_upload)
+    except boto.exception.S3ResponseError as e:
+        if e.status == 404:
+            # the upload was already completed
+            return True
+        raise
+    if uploaded < size:
+        return False
+    multipart_upload.complete_upload()
+    return True
+
+
+def abort_multipart_upload(pending_upload):
+    '''Abort the multipart upload of a pending upload, so that S3 deletes the
+       parts uploaded so far.
+    '''
+    sha512 = pending_upload.file.sha512
+    s3_regions = flask.current_app.config.get('S3_REGIONS') or {}
+    if pending_upload.region not in s3_regions:
+        return
+    s3 = flask.current_app.aws.connect_to('s3', pending_upload.region)
+    bucket = s3.get_bucket(s3_regions[pending_upload.region], validate=False)
+    try:
+        _multipart_upload(bucket, sha512, pending_upload.multipart_upload_id).cancel_upload()
+    except boto.exception.S3ResponseError:
+        logger.warning('Could not abort multipart upload of {}'.format(sha512), exc_info=True)
+
+
 def check_pending_upload(session, pending_upload):
     # we can check the upload any time between the expiration of the URL
     # (after which the user can't make any more changes, but the upload
@@ -117,6 +160,8 @@ def check_pending_upload(session, pending_upload):
     elif tooltool_api.utils.now() > (pending_upload.expires + datetime.timedelta(days=1)).replace(tzinfo=pytz.UTC):
         # Upload will probably never complete
         logger2.info('Deleting abandoned pending upload for {}'.format(sha512))
+        if pending_upload.multipart_upload_id:
+            abort_multipart_upload(pending_upload)
         session.delete(pending_upload)
         return
 
@@ -129,6 +174,10 @@ def check_pending_upload(session, pending_upload):
         return
 
     bucket = s3.get_bucket(s3_regions[pending_upload.region], validate=False)
+    if pending_upload.multipart_upload_id and \
+            not complete_multipart_upload(bucket, sha512, size, pending_upload.multipart_upload_id):
+        # not all parts uploaded yet
+        return
     key = bucket.get_key(tooltool_api.utils.keyname(sha512))
     if not key:
         # not uploaded yet
@@ -166,19 +215,48 @@ def check_pending_upload(session, pending_upload):
     # this one instance.
 
 
+def check_files_pending_uploads(app, digests):
+    '''Check for the pending uploads of the files with the given digests, in
+       a thread of the worker, with a session of its own.
+    '''
+    with app.app_context():
+        session = app.db.session
+        try:
+            for digest in digests:
+                file = tooltool_api.models.File.query.filter(
+                    tooltool_api.models.File.sha512 == digest).first()
+                if file:
+                    for pending_upload in file.pending_uploads:
+                        check_pending_upload(session, pending_upload)
+            session.commit()
+        except Exception as e:
+            # these are checked again by the check-pending-uploads command
+            logger.exception('Failed to check pending uploads', digests=digests, error=e)
+            session.rollback()
+        finally:
+            session.remove()
+
+
 async def check_file_pending_uploads(channel, body, envelope, properties):
-    '''Check for pending uploads for a single file.
+    '''Check for pending uploads for a single file, or for the files of an
+       upload batch once their upload URLs expired.
+
+       The message is acknowledged right away, and the checks, which hash the
+       uploaded files, are run in a thread, so that they don't hold the
+       consumer, which only gets one message at a time.  Those of a batch are
+       scheduled for when its URLs expire.  Those lost when the worker
+       restarts are done by the periodic `check-pending-uploads` command.
     '''
-    body = json.loads(body.decode('utf-8'))
-    digest = body['payload']['digest']
-    session = flask.current_app.db.session
-    file = tooltool_api.models.File.query.filter(
-        tooltool_api.models.File.sha512 == digest).first()
-    if file:
-        for pending_upload in file.pending_uploads:
-            check_pending_upload(session, pending_upload)
-    session.commit()
     await channel.basic_client_ack(delivery_tag=envelope.delivery_tag)
+    body = json.loads(body.decode('utf-8'))
+    payload = body['payload']
+    digests = payload['digests'] if 'digests' in payload else [payload['digest']]
+    delay = 0
+    if payload.get('not_before') is not None:
+        delay = payload['not_before'] - tooltool_api.utils.now().timestamp()
+    loop = asyncio.get_event_loop()
+    app = flask.current_app._get_current_object()
+    loop.call_later(max(delay, 0), loop.run_in_executor, None, check_files_pending_uploads, app, digests)
 
 
 @click.command()
@@ -167,5 +167,11 @@ class PendingUpload(db.Model):
         sa.Enum(*ALLOWED_REGIONS, name='region'),
         nullable=False,
     )
+    # set when the file is uploaded in parts, which S3 only assembles once
+    # the upload is completed
+    multipart_upload_id = sa.Column(
+        sa.String(255),
+        nullable=True,
+    )
 
     file = sa.orm.relationship('File', backref='pending_uploads')
@@ -4,6 +4,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import math
 import re
 import typing
 
@@ -20,3 +21,18 @@ def keyname(digest: str) -> str:
 
 def is_valid_sha512(sha512: str) -> typing.Optional[typing.Match[str]]:
     return re.compile(r'^[0-9a-f]{128}$').match(sha512)
+
+
+# S3 refuses multipart uploads with more parts than this
+S3_MAX_PARTS = 10000
+
+
+def multipart_part_size(size: int, part_size: int) -> int:
+    '''Return the size of the parts a file of `size` bytes is uploaded as,
+       which is `part_size` unless the file would then have too many parts.
+    '''
+    return max(part_size, int(math.ceil(size / S3_MAX_PARTS)))
+
+
+def multipart_part_count(size: int, part_size: int) -> int:
+    return max(1, int(math.ceil(size / part_size)))
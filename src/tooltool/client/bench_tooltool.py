@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmarks for the hot paths of the tooltool client.
+
+The harness generates synthetic artifacts, serves them from a local HTTP
+server laid out like a tooltool server, and times fetching (cold, from a
+warm cache and with the files already present), validation, unpacking and
+purging.  Each measurement runs in its own process so that its peak RSS can
+be reported, and the results are written as JSON, eg:
+
+    python bench_tooltool.py --size 64 --count 4 --output results.json
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+import tooltool
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+try:
+    from http.server import HTTPServer
+    from http.server import SimpleHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+log = logging.getLogger('bench_tooltool')
+
+ALGORITHM = 'sha512'
+# synthetic data is made of random blocks, each written twice, so that it
+# compresses to about half its size with all the supported formats
+BLOCK_SIZE = 16 * 1024
+ARCHIVE_FORMATS = ['tar.gz', 'tar.bz2', 'tar.xz', 'zip']
+CONTEXT_NAME = 'context.json'
+
+
+class _Handler(SimpleHTTPRequestHandler):
+
+    """I serve the files of the server folder, quietly."""
+
+    root = None
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        return os.path.join(self.root, *[p for p in path.split('/') if p])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(root):
+    handler = type('Handler', (_Handler,), {'root': root})
+    httpd = _Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd, 'http://127.0.0.1:%d/' % httpd.server_port
+
+
+def write_synthetic_file(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            block = os.urandom(min(BLOCK_SIZE, (size + 1) // 2))
+            data = (block * 2)[:size]
+            f.write(data)
+            size -= len(data)
+
+
+def make_archive(path, fmt, filenames):
+    if fmt == 'zip':
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            for filename in filenames:
+                z.write(filename, os.path.basename(filename))
+        return
+    mode = 'w:' + fmt.split('.')[1]
+    kwargs = {'preset': 1} if fmt == 'tar.xz' else {}
+    with tarfile.open(path, mode, **kwargs) as t:
+        for filename in filenames:
+            t.add(filename, os.path.basename(filename))
+
+
+def make_corpus(corpus, size, count):
+    """Generate `count` artifacts of `size` bytes, the tooltool server folder
+    and manifest to fetch them, and an archive of them in each format, in the
+    `corpus` folder."""
+    artifacts = os.path.join(corpus, 'artifacts')
+    server = os.path.join(corpus, 'server', ALGORITHM)
+    os.makedirs(artifacts)
+    os.makedirs(server)
+    manifest = tooltool.Manifest()
+    filenames = []
+    for n in range(count):
+        filename = os.path.join(artifacts, 'artifact-%d' % n)
+        write_synthetic_file(filename, size)
+        record = tooltool.create_file_record(filename, ALGORITHM)
+        record.filename = os.path.basename(filename)
+        manifest.file_records.append(record)
+        os.link(filename, os.path.join(server, record.digest))
+        filenames.append(filename)
+    with open(os.path.join(corpus, 'manifest.tt'), 'w') as f:
+        manifest.dump(f, fmt='json')
+
+    archives = {}
+    for fmt in ARCHIVE_FORMATS:
+        path = os.path.join(corpus, 'archive.' + fmt)
+        try:
+            make_archive(path, fmt, filenames)
+        except (tarfile.CompressionError, ImportError):
+            log.warning('cannot create %s archives with this python, skipping them' % fmt)
+            continue
+        archives[fmt] = path
+    return dict(archives=archives, files=filenames)
+
+
+def _copy_files(context, dest):
+    for filename in context['files']:
+        shutil.copy(filename, dest)
+    shutil.copy(os.path.join(context['corpus'], 'manifest.tt'), dest)
+
+
+def _fetch(context, cache_folder=None):
+    ok = tooltool.fetch_files('manifest.tt', [context['url']],
+                              cache_folder=cache_folder)
+    assert ok, 'fetch failed'
+    return context['size'] * context['count']
+
+
+# Each scenario is a pair of functions: the first one prepares the current
+# folder, and the second one, which is timed, does the work and returns the
+# number of bytes it processed.
+
+def setup_fetch(context):
+    shutil.copy(os.path.join(context['corpus'], 'manifest.tt'), '.')
+
+
+def setup_fetch_warm(context):
+    setup_fetch(context)
+    _fetch(context, cache_folder='cache')
+    for filename in context['files']:
+        os.remove(os.path.basename(filename))
+
+
+def run_digest(context):
+    for filename in context['files']:
+        with open(filename, 'rb') as f:
+            tooltool.digest_file(f, ALGORITHM)
+    return context['size'] * context['count']
+
+
+def run_validate(context):
+    assert tooltool.validate_manifest('manifest.tt'), 'validation failed'
+    return context['size'] * context['count']
+
+
+def setup_validate_indexed(context):
+    _copy_files(context, '.')
+    digest_index = tooltool.DigestIndex(tooltool.DIGEST_INDEX_NAME)
+    tooltool.validate_manifest('manifest.tt', digest_index=digest_index)
+    digest_index.save()
+
+
+def run_validate_indexed(context):
+    digest_index = tooltool.DigestIndex(tooltool.DIGEST_INDEX_NAME)
+    assert tooltool.validate_manifest('manifest.tt', digest_index=digest_index), \
+        'validation failed'
+    return context['size'] * context['count']
+
+
+def setup_purge(context):
+    os.mkdir('cache')
+    for filename in context['files']:
+        shutil.copy(filename, 'cache')
+
+
+def run_purge(context):
+    tooltool.purge('cache', 0)
+    assert not os.listdir('cache'), 'purge left files behind'
+    return context['size'] * context['count']
+
+
+def unpack_scenario(fmt):
+    def setup(context):
+        shutil.copy(context['archives'][fmt], '.')
+
+    def run(context):
+        assert tooltool.unpack_file('archive.' + fmt), 'unpack failed'
+        return context['size'] * context['count']
+    return setup, run
+
+
+SCENARIOS = [
+    ('digest', (None, run_digest)),
+    ('fetch_cold', (setup_fetch, lambda context: _fetch(context, 'cache'))),
+    ('fetch_warm_cache', (setup_fetch_warm, lambda context: _fetch(context, 'cache'))),
+    ('fetch_present', (lambda context: _copy_files(context, '.'), _fetch)),
+    ('validate', (lambda context: _copy_files(context, '.'), run_validate)),
+    ('validate_indexed', (setup_validate_indexed, run_validate_indexed)),
+    ('purge', (setup_purge, run_purge)),
+] + [('unpack_' + fmt, unpack_scenario(fmt)) for fmt in ARCHIVE_FORMATS]
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in bytes."""
+    if resource is None:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_scenario(name, workdir):
+    """Run the timed part of scenario `name` in `workdir`, in this process,
+    and print its measurements as JSON."""
+    with open(os.path.join(workdir, '..', CONTEXT_NAME)) as f:
+        context = json.load(f)
+    run = dict(SCENARIOS)[name][1]
+    os.chdir(workdir)
+    start = time.time()
+    processed = run(context)
+    elapsed = time.time() - start
+    print(json.dumps(dict(seconds=elapsed, bytes=processed, peak_rss=peak_rss())))
+
+
+def measure(name, context, root):
+    """Prepare a fresh folder for scenario `name`, and run it in a child
+    process."""
+    setup = dict(SCENARIOS)[name][0]
+    workdir = os.path.join(root, name)
+    os.mkdir(workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        if setup:
+            setup(context)
+    finally:
+        os.chdir(cwd)
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--run', name, workdir])
+    shutil.rmtree(workdir)
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['name'] = name
+    result['mb_per_s'] = result['bytes'] / (1024. * 1024) / max(result['seconds'], 1e-9)
+    return result
+
+
+def benchmark(scenarios, size, count, repeat=1, root=None):
+    """Run `scenarios` over `count` artifacts of `size` bytes, `repeat` times
+    each, and return the results, keeping the fastest run of each."""
+    root = tempfile.mkdtemp(prefix='tooltool-bench-', dir=root)
+    try:
+        corpus = os.path.join(root, 'corpus')
+        context = make_corpus(corpus, size, count)
+        context.update(corpus=corpus, size=size, count=count)
+        httpd, context['url'] = start_server(os.path.join(corpus, 'server'))
+        try:
+            with open(os.path.join(root, CONTEXT_NAME), 'w') as f:
+                json.dump(context, f)
+            results = []
+            for name in scenarios:
+                if name.startswith('unpack_') and name[len('unpack_'):] not in context['archives']:
+                    continue
+                log.info('running %s' % name)
+                runs = [measure(name, context, root) for _ in range(repeat)]
+                results.append(min(runs, key=lambda r: r['seconds']))
+            return results
+        finally:
+            httpd.shutdown()
+    finally:
+        shutil.rmtree(root)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--size', dest='size', type='float', default=32,
+                      help='Size of each synthetic artifact, in MB (default 32)')
+    parser.add_option('-n', '--count', dest='count', type='int', default=4,
+                      help='Number of synthetic artifacts (default 4)')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=1,
+                      help='Run each scenario this many times and keep the fastest run')
+    parser.add_option('--scenario', dest='scenarios', action='append',
+                      choices=[name for name, _ in SCENARIOS],
+                      help='Scenario to run; may be given several times (default: all)')
+    parser.add_option('-d', '--dir', dest='dir',
+                      help='Folder in which to create the temporary files')
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write the JSON results to this file rather than stdout')
+    parser.add_option('--run', dest='run', nargs=2, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+    # keep tooltool itself quiet, its logging would skew the timings
+    logging.getLogger('tooltool').setLevel(logging.ERROR)
+
+    if options.run:
+        run_scenario(*options.run)
+        return 0
+
+    size = int(options.size * 1024 * 1024)
+    results = benchmark(options.scenarios or [name for name, _ in SCENARIOS],
+                        size, options.count, options.repeat, options.dir)
+    report = dict(
+        tooltool_version=tooltool.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        size=size,
+        count=options.count,
+        results=results,
+    )
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
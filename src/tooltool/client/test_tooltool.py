@@ -2,6 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import bench_tooltool
 import contextlib
 import copy
 import hashlib
@@ -14,6 +15,7 @@ import shutil
 import sys
 import tempfile
 import threading
+import time
 import tooltool
 import unittest
 
@@ -85,6 +87,17 @@ class DigestTests(unittest.TestCase):
         self.assertEqual(test_digest, self.sample_digest)
 
 
+def test_read_chunks():
+    eq_([bytes(c) for c in tooltool.read_chunks(BytesIO(b'abcdefg'), 3)],
+        [b'abc', b'def', b'g'])
+
+
+def test_read_chunks_without_readinto():
+    f = mock.Mock(spec=['read'])
+    f.read.side_effect = [b'abc', b'def', b'']
+    eq_(list(tooltool.read_chunks(f, 3)), [b'abc', b'def'])
+
+
 class BaseFileRecordTest(unittest.TestCase):
 
     def setUp(self):
@@ -457,6 +470,83 @@ class TestManifestOperations(BaseManifestTest):
                           tooltool.open_manifest('no-such-file'))
 
 
+class DigestIndexTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        with open('a', 'wb') as f:
+            f.write(b'abcd')
+        self.record = tooltool.FileRecord('a', 4, get_hexdigest(b'abcd'), 'sha512')
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def reload_index(self, index):
+        index.save()
+        return tooltool.DigestIndex(index.filename)
+
+    def test_records_digest(self):
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(self.record.validate(index))
+        index = self.reload_index(index)
+        eq_(index.lookup('a', 'sha512'), self.record.digest)
+
+    def test_skips_hashing_unchanged(self):
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(self.record.validate(index))
+        index = self.reload_index(index)
+        with mock.patch('tooltool.digest_file') as digest_file:
+            self.assertTrue(self.record.validate(index))
+            assert not digest_file.called
+
+    def test_rehashes_changed(self):
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(self.record.validate(index))
+        with open('a', 'wb') as f:
+            f.write(b'dcba')
+        os.utime('a', (0, 0))
+        self.assertFalse(self.record.validate(index))
+
+    def test_wrong_algorithm(self):
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(self.record.validate(index))
+        eq_(index.lookup('a', 'sha256'), None)
+
+    def test_not_recorded_if_changed_while_hashing(self):
+        index = tooltool.DigestIndex('index')
+        signature = index.signature('a')
+        os.utime('a', (0, 0))
+        index.record('a', 'sha512', self.record.digest, signature)
+        eq_(index.lookup('a', 'sha512'), None)
+
+    def test_save_prunes_missing_files(self):
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(self.record.validate(index))
+        os.unlink('a')
+        index = self.reload_index(index)
+        eq_(index.entries, {})
+
+    def test_save_not_dirty(self):
+        index = tooltool.DigestIndex('index')
+        index.save()
+        self.assertFalse(os.path.exists('index'))
+
+    def test_corrupt_index(self):
+        with open('index', 'wb') as f:
+            f.write(b'{not json')
+        index = tooltool.DigestIndex('index')
+        eq_(index.entries, {})
+        self.assertTrue(self.record.validate(index))
+
+    def test_validate_manifest(self):
+        tooltool.Manifest([self.record]).dump(open('manifest.tt', 'w'))
+        index = tooltool.DigestIndex('index')
+        self.assertTrue(tooltool.validate_manifest('manifest.tt', digest_index=index))
+        with mock.patch('tooltool.digest_file') as digest_file:
+            self.assertTrue(tooltool.validate_manifest('manifest.tt', digest_index=index))
+            assert not digest_file.called
+
+
 def call_main(*args):
     try:
         old_stderr = sys.stderr
@@ -488,13 +578,27 @@ def test_main_bad_algorithm():
 def test_command_list():
     with mock.patch('tooltool.list_manifest') as list_manifest:
         eq_(call_main('tooltool', 'list', '--manifest', 'foo.tt'), 0)
-        list_manifest.assert_called_with('foo.tt')
+        list_manifest.assert_called_with('foo.tt', digest_index=mock.ANY)
 
 
 def test_command_validate():
     with mock.patch('tooltool.validate_manifest') as validate_manifest:
         eq_(call_main('tooltool', 'validate'), 0)
-        validate_manifest.assert_called_with('manifest.tt')
+        validate_manifest.assert_called_with('manifest.tt', digest_index=mock.ANY)
+
+
+def test_command_validate_digest_index():
+    with mock.patch('tooltool.validate_manifest') as validate_manifest:
+        eq_(call_main('tooltool', 'validate'), 0)
+        digest_index = validate_manifest.call_args[1]['digest_index']
+        assert isinstance(digest_index, tooltool.DigestIndex)
+        eq_(digest_index.filename, tooltool.DIGEST_INDEX_NAME)
+
+
+def test_command_validate_paranoid():
+    with mock.patch('tooltool.validate_manifest') as validate_manifest:
+        eq_(call_main('tooltool', 'validate', '--paranoid'), 0)
+        validate_manifest.assert_called_with('manifest.tt', digest_index=None)
 
 
 def test_command_add():
@@ -566,7 +670,9 @@ def test_command_fetch_no_url():
         fetch_files.assert_called_with('manifest.tt',
                                        ['https://tooltool.mozilla-releng.net/'],
                                        [], cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
 
 
 def test_command_fetch():
@@ -574,7 +680,9 @@ def test_command_fetch():
         eq_(call_main('tooltool', 'fetch', 'a', 'b', '--url', 'http://foo/bar/'), 0)
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
 
 
 def test_command_fetch_no_trailing_slash():
@@ -582,7 +690,9 @@ def test_command_fetch_no_trailing_slash():
         eq_(call_main('tooltool', 'fetch', 'a', 'b', '--url', 'http://foo/bar'), 0)
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region=None)
+                                       region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
 
 
 def test_command_fetch_region():
@@ -591,7 +701,66 @@ def test_command_fetch_region():
                       '--region', 'us-east-1'), 0)
         fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], ['a', 'b'],
                                        cache_folder=None, auth_file=None,
-                                       region='us-east-1')
+                                       region='us-east-1', jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
+
+
+def test_command_fetch_jobs():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        eq_(call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '--jobs', '4'), 0)
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=4,
+                                       link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
+
+
+def test_command_fetch_segments():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        eq_(call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '--segments', '4'), 0)
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=4)
+
+
+def test_command_fetch_segments_zero():
+    eq_(call_main('tooltool', 'fetch', '--segments', '0'), 'exit 2')
+
+
+def test_process_command_fetch_without_segments():
+    # callers of process_command may not set all the options
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        tooltool.process_command({'manifest': 'manifest.tt', 'base_url': ['http://foo/bar/'],
+                                  'cache_folder': None, 'paranoid': True}, ['fetch'])
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=1, link_cache=None,
+                                       digest_index=None,
+                                       unpack_cache=None, segments=1)
+
+
+def test_command_fetch_link():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        eq_(call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '--link'), 0)
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=1, link_cache=True,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
+
+
+def test_command_fetch_unpack_cache():
+    with mock.patch('tooltool.fetch_files') as fetch_files:
+        eq_(call_main('tooltool', 'fetch', '--url', 'http://foo/bar/', '--unpack-cache'), 0)
+        fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'], [],
+                                       cache_folder=None, auth_file=None,
+                                       region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=True, segments=1)
 
 
 def test_command_fetch_auth_file():
@@ -607,7 +776,9 @@ def test_command_fetch_auth_file():
             fetch_files.assert_called_with('manifest.tt', ['http://foo/bar/'],
                                            ['a', 'b'], cache_folder=None,
                                            auth_file="HOME/.tooltool-token",
-                                           region=None)
+                                           region=None, jobs=1, link_cache=False,
+                                       digest_index=mock.ANY,
+                                       unpack_cache=False, segments=1)
     finally:
         os.path.expanduser = old_expanduser
 
@@ -616,14 +787,26 @@ def test_command_upload():
     with mock.patch('tooltool.upload') as upload:
         eq_(call_main('tooltool', 'upload', '--url', 'http://foo/',
                       '--message', 'msg'), 0)
-        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None)
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None,
+                                  digest_index=mock.ANY, jobs=tooltool.UPLOAD_JOBS,
+                                  wait=False)
+
+
+def test_command_upload_jobs():
+    with mock.patch('tooltool.upload') as upload:
+        eq_(call_main('tooltool', 'upload', '--url', 'http://foo/',
+                      '--message', 'msg', '--jobs', '2'), 0)
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None,
+                                  digest_index=mock.ANY, jobs=2, wait=False)
 
 
 def test_command_upload_region():
     with mock.patch('tooltool.upload') as upload:
         eq_(call_main('tooltool', 'upload', '--url', 'http://foo/',
                       '--message', 'msg', '--region=us-west-3'), 0)
-        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, 'us-west-3')
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, 'us-west-3',
+                                  digest_index=mock.ANY, jobs=tooltool.UPLOAD_JOBS,
+                                  wait=False)
 
 
 def test_command_upload_no_message():
@@ -637,7 +820,17 @@ def test_command_upload_no_url():
         eq_(call_main('tooltool', 'upload', '--message', 'msg'), 0)
         upload.assert_called_with('manifest.tt', 'msg',
                                   ['https://tooltool.mozilla-releng.net/'],
-                                  None, None)
+                                  None, None, digest_index=mock.ANY,
+                                  jobs=tooltool.UPLOAD_JOBS, wait=False)
+
+
+def test_command_upload_wait():
+    with mock.patch('tooltool.upload') as upload:
+        eq_(call_main('tooltool', 'upload', '--url', 'http://foo/',
+                      '--message', 'msg', '--wait'), 0)
+        upload.assert_called_with('manifest.tt', 'msg', ['http://foo/'], None, None,
+                                  digest_index=mock.ANY, jobs=tooltool.UPLOAD_JOBS,
+                                  wait=True)
 
 
 class UploadTests(TestDirMixin, unittest.TestCase):
@@ -647,6 +840,14 @@ class UploadTests(TestDirMixin, unittest.TestCase):
         """A mini webserver for uploading.  This implements both the RelengAPI
         bits (POST and GET) and the S3 bits (PUT)."""
 
+        def send_json(self, code, msg, data):
+            self.send_response(code, msg)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(to_binary(json.dumps(data)))
+            if not PY3:
+                self.wfile.close()
+
         test_case = None
 
         def log_request(self, code=None, size=None):
@@ -666,6 +867,8 @@ class UploadTests(TestDirMixin, unittest.TestCase):
 
         def do_POST(self):
             cfg = self.test_case.server_config
+            if self.path.endswith('/complete'):
+                return self.do_POST_complete()
             if '?region=' in self.path:
                 self.path, self.test_case.server_got_region = self.path.split('?')
             eq_(self.path, '/tooltool/upload')
@@ -677,8 +880,17 @@ class UploadTests(TestDirMixin, unittest.TestCase):
             eq_(body['message'], 'hi mom')
 
             files_on_server = cfg.get('files_on_server', [])
+            part_size = cfg.get('part_size')
             for filename, file in body['files'].items():
-                if filename not in files_on_server:
+                if filename in files_on_server:
+                    continue
+                if file.get('multipart') and part_size:
+                    file['part_size'] = part_size
+                    file['part_urls'] = [
+                        self.test_case.s3url('/sha512/%s?partNumber=%d&uploadId=up'
+                                             % (file['digest'], n))
+                        for n in range(1, -(-file['size'] // part_size) + 1)]
+                else:
                     file['put_url'] = self.test_case.s3url('/sha512/' + file['digest'])
 
             if cfg.get('post_fails'):
@@ -686,25 +898,51 @@ class UploadTests(TestDirMixin, unittest.TestCase):
                 self.send_header('Content-Type', 'application/json')
                 self.end_headers()
                 self.wfile.write(to_binary(json.dumps({'error': {'name': 'uhoh', 'description': 'failed'}})))
+                if not PY3:
+                    self.wfile.close()
             else:
-                self.send_response(200, b'OK')
-                self.send_header('Content-Type', 'application/json')
+                body['id'] = 1
+                self.send_json(200, b'OK', {'result': body})
+
+        def do_POST_complete(self):
+            cfg = self.test_case.server_config
+            eq_(self.path, '/tooltool/upload/1/complete')
+            eq_(self.headers['content-type'], 'application/json')
+            if not self.verify_auth():
+                return
+            body = json.loads(self.rfile.read(int(self.headers['content-length'])))
+            self.test_case.server_requests.setdefault('POST complete', []).append(
+                body['digests'])
+            if cfg.get('old_server'):
+                self.send_response(404, b'Not Found')
+                self.send_header('Content-Type', 'text/plain')
                 self.end_headers()
-                self.wfile.write(to_binary(json.dumps({'result': body})))
-            if not PY3:
-                self.wfile.close()
+                if not PY3:
+                    self.wfile.close()
+            else:
+                self.send_json(202, b'Accepted', {'result': {}})
 
         def do_PUT(self):  # S3 upload
             cfg = self.test_case.server_config
             assert self.path.startswith('/sha512/'), self.path
-            eq_(self.headers['content-type'], 'application/octet-stream')
             content_length = int(self.headers.get('content-length', -1))
             data = self.rfile.read(content_length)
             digest = get_hexdigest(data)
-            self.test_case.server_requests.setdefault('PUT', []).append(digest)
-            assert self.path.endswith(digest)
+            if '?' in self.path:  # part of a multipart upload
+                self.path, query = self.path.split('?')
+                assert 'content-type' not in self.headers
+                part = int(query.split('&')[0].split('=')[1])
+                parts = self.test_case.server_requests.setdefault('PUT parts', {})
+                parts.setdefault(self.path[len('/sha512/'):], {})[part] = data
+            else:
+                eq_(self.headers['content-type'], 'application/octet-stream')
+                self.test_case.server_requests.setdefault('PUT', []).append(digest)
+                assert self.path.endswith(digest)
             if digest in cfg.get('upload_failures', []):
                 self.send_response(500, b'NOPE')
+            elif cfg.get('transient_upload_failures', 0):
+                cfg['transient_upload_failures'] -= 1
+                self.send_response(500, b'NOPE')
             else:
                 self.send_response(200, b'OK')
             self.send_header('Content-Type', 'text/plain')
@@ -714,6 +952,9 @@ class UploadTests(TestDirMixin, unittest.TestCase):
 
         def do_GET(self):  # notify
             cfg = self.test_case.server_config
+            if self.path == '/tooltool/upload/1/status':
+                self.test_case.server_requests.setdefault('GET status', []).append(1)
+                return self.send_json(200, b'OK', {'result': cfg['statuses'].pop(0)})
             assert self.path.startswith('/tooltool/upload/complete/sha512/')
             if not self.verify_auth():
                 return
@@ -734,6 +975,9 @@ class UploadTests(TestDirMixin, unittest.TestCase):
 
     def setUp(self):
         self.setUpTestDir()
+        patcher = mock.patch('tooltool.UPLOAD_RETRY_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def start_server(self):
         self.server_config = {}
@@ -802,9 +1046,86 @@ class UploadTests(TestDirMixin, unittest.TestCase):
                 'message': 'hi mom',
             }],
             'PUT': [bar_digest],
-            'GET': [bar_digest],
+            'POST complete': [[bar_digest]],
         })
 
+    def test_upload_old_server(self):
+        """When the server doesn't support batch notifications, each uploaded
+        file is notified on its own"""
+        self.start_server()
+        self.server_config['old_server'] = True
+        self.add_file("foo.txt", on_server=True)
+        bar_digest = self.add_file("bar.txt", on_server=False)
+        assert tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None)
+        eq_(self.server_requests['POST complete'], [[bar_digest]])
+        eq_(self.server_requests['GET'], [bar_digest])
+
+    def batch_status(self, digest, state):
+        return {'id': 1, 'complete': state == 'verified',
+                'files': {'foo.txt': {'digest': digest, 'state': state}}}
+
+    def test_upload_wait(self):
+        """With wait, the upload polls the batch status until the uploaded
+        files are verified"""
+        self.start_server()
+        foo_digest = self.add_file("foo.txt")
+        self.server_config['statuses'] = [
+            self.batch_status(foo_digest, 'pending'),
+            self.batch_status(foo_digest, 'verified'),
+        ]
+        with mock.patch('time.sleep') as fake_sleep:
+            assert tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None,
+                                   wait=True)
+        fake_sleep.assert_called_once_with(tooltool.UPLOAD_WAIT_INTERVAL)
+        eq_(self.server_requests['POST complete'], [[foo_digest]])
+        eq_(self.server_requests['GET status'], [1, 1])
+
+    def test_upload_wait_verify_after(self):
+        """With wait, the upload waits for files which can only be verified
+        later than the timeout, e.g. multipart uploads"""
+        self.start_server()
+        foo_digest = self.add_file("foo.txt")
+        pending = self.batch_status(foo_digest, 'pending')
+        pending['files']['foo.txt']['verify_after'] = time.time() + 3600
+        self.server_config['statuses'] = [
+            pending,
+            self.batch_status(foo_digest, 'verified'),
+        ]
+        with mock.patch('time.sleep'), mock.patch('tooltool.UPLOAD_WAIT_TIMEOUT', 0):
+            assert tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None,
+                                   wait=True)
+        eq_(self.server_requests['GET status'], [1, 1])
+
+    def test_upload_wait_timeout(self):
+        """With wait, the upload fails once the timeout is over"""
+        self.start_server()
+        foo_digest = self.add_file("foo.txt")
+        self.server_config['statuses'] = [self.batch_status(foo_digest, 'pending')]
+        with mock.patch('time.sleep'), mock.patch('tooltool.UPLOAD_WAIT_TIMEOUT', 0):
+            assert not tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None,
+                                       wait=True)
+
+    def test_upload_wait_failed(self):
+        """With wait, the upload fails when the server rejects an upload"""
+        self.start_server()
+        foo_digest = self.add_file("foo.txt")
+        self.server_config['statuses'] = [self.batch_status(foo_digest, 'failed')]
+        with BufferHandler.capture('tooltool') as logged:
+            assert not tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None,
+                                       wait=True)
+        assert (logging.ERROR, 'server failed to verify uploads: %s' % foo_digest) in logged
+
+    def test_upload_no_wait(self):
+        """Without wait, the upload doesn't wait for the server to verify the
+        uploaded files"""
+        self.start_server()
+        foo_digest = self.add_file("foo.txt")
+        with mock.patch('time.sleep') as fake_sleep:
+            assert tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None)
+        assert not fake_sleep.called
+        eq_(self.server_requests['POST complete'], [[foo_digest]])
+        assert 'GET status' not in self.server_requests
+
     def test_upload_success_auth(self):
         """An upload with authentication information succeeds when the server expects
         authentication."""
@@ -861,7 +1182,7 @@ class UploadTests(TestDirMixin, unittest.TestCase):
                 },
                 'message': 'hi mom',
             }],
-            'PUT': [foo_digest],
+            'PUT': [foo_digest] * tooltool.UPLOAD_ATTEMPTS,
         })
 
     def test_upload_send_batch_fails(self):
@@ -902,13 +1223,14 @@ class UploadTests(TestDirMixin, unittest.TestCase):
     def test_send_batch_success(self):
         self.start_server()
         batch = {'message': 'hi mom', 'files': {}}
-        eq_(tooltool._send_batch(self.mkurl(''), None, batch, None), batch)
+        eq_(tooltool._send_batch(self.mkurl(''), None, batch, None), dict(batch, id=1))
         eq_(self.server_requests, {'POST': [batch]})
 
     def test_send_batch_region(self):
         self.start_server()
         batch = {'message': 'hi mom', 'files': {}}
-        eq_(tooltool._send_batch(self.mkurl(''), None, batch, 'us-south-1'), batch)
+        eq_(tooltool._send_batch(self.mkurl(''), None, batch, 'us-south-1'),
+            dict(batch, id=1))
         eq_(self.server_requests, {'POST': [batch]})
         eq_(self.server_got_region, 'region=us-south-1')
 
@@ -921,20 +1243,70 @@ class UploadTests(TestDirMixin, unittest.TestCase):
 
     def test_s3_upload(self):
         self.start_server()
-        file = {'put_url': self.s3url('/sha512/' + self.digest)}
-        tooltool._s3_upload('testfile.txt', file)
+        files = {'testfile.txt': {'put_url': self.s3url('/sha512/' + self.digest)},
+                 'other.txt': {}}
+        tooltool._s3_upload(files)
         eq_(self.server_requests, {'PUT': [self.digest]})
-        assert file['upload_ok']
+        assert files['testfile.txt']['upload_ok']
+        assert 'upload_ok' not in files['other.txt']
 
     def test_s3_upload_fails(self):
         self.start_server()
         self.server_config['upload_failures'] = [self.digest]
         file = {'put_url': self.s3url('/sha512/' + self.digest)}
-        tooltool._s3_upload('testfile.txt', file)
-        eq_(self.server_requests, {'PUT': [self.digest]})
+        tooltool._s3_upload({'testfile.txt': file})
+        eq_(self.server_requests, {'PUT': [self.digest] * tooltool.UPLOAD_ATTEMPTS})
         assert not file['upload_ok'], file
         assert 'upload_exception' in file, file
 
+    def test_s3_upload_retried(self):
+        self.start_server()
+        self.server_config['transient_upload_failures'] = 1
+        file = {'put_url': self.s3url('/sha512/' + self.digest)}
+        tooltool._s3_upload({'testfile.txt': file})
+        eq_(self.server_requests, {'PUT': [self.digest] * 2})
+        assert file['upload_ok'], file
+
+    def test_s3_upload_parts(self):
+        self.start_server()
+        url = self.s3url('/sha512/%s?partNumber=%%d&uploadId=up' % self.digest)
+        file = {'part_size': 4, 'part_urls': [url % 1, url % 2, url % 3]}
+        tooltool._s3_upload({'testfile.txt': file}, jobs=2)
+        assert file['upload_ok'], file
+        eq_(self.server_requests, {'PUT parts': {self.digest: {
+            1: b'FILE', 2: b' DAT', 3: b'A'}}})
+
+    def test_s3_upload_parts_mismatch(self):
+        self.start_server()
+        url = self.s3url('/sha512/%s?partNumber=%%d&uploadId=up' % self.digest)
+        file = {'part_size': 4, 'part_urls': [url % 1, url % 2]}
+        tooltool._s3_upload({'testfile.txt': file})
+        assert not file['upload_ok'], file
+        eq_(self.server_requests, {})
+
+    def test_upload_multipart(self):
+        """Files large enough are uploaded in parts when the server agrees"""
+        self.start_server()
+        self.server_config['part_size'] = 300
+        foo_digest = self.add_file("foo.txt")
+        with mock.patch('tooltool.MULTIPART_MIN_SIZE', 1000):
+            assert tooltool.upload('manifest.tt', 'hi mom', [self.mkurl('')], None, None)
+        eq_(self.server_requests['POST'][0]['files']['foo.txt']['multipart'], True)
+        parts = self.server_requests['PUT parts'][foo_digest]
+        eq_(sorted(parts), [1, 2, 3, 4])
+        eq_(get_hexdigest(b''.join(parts[n] for n in sorted(parts))), foo_digest)
+        eq_(self.server_requests['POST complete'], [[foo_digest]])
+
+    def test_notify_batch_complete(self):
+        self.start_server()
+        assert tooltool._notify_batch_complete(self.mkurl(''), None, 1, [self.digest])
+        eq_(self.server_requests, {'POST complete': [[self.digest]]})
+
+    def test_notify_batch_complete_unsupported(self):
+        self.start_server()
+        self.server_config['old_server'] = True
+        assert not tooltool._notify_batch_complete(self.mkurl(''), None, 1, [self.digest])
+
     def test_notify_upload(self):
         self.start_server()
         file = {'algorithm': 'sha512', 'digest': self.digest}
@@ -1007,13 +1379,13 @@ class FetchTests(TestDirMixin, unittest.TestCase):
     def tearDown(self):
         self.tearDownTestDir()
 
-    def fake_fetch_file(self, urls, file_record, auth_file=None, region=None):
+    def fake_fetch_file(self, urls, file_record, auth_file=None, region=None, segments=1):
         eq_(urls, self.urls)
         if file_record.digest in self.server_files_by_hash:
             if self.server_corrupt:
-                content = 'XXX'
-            else:
-                content = self.server_files_by_hash[file_record.digest]
+                # fetch_file discards downloads that don't match the record
+                return None
+            content = self.server_files_by_hash[file_record.digest]
             fd, temp_path = tempfile.mkstemp(dir=self.test_dir)
             os.write(fd, to_binary(content))
             os.close(fd)
@@ -1146,6 +1518,58 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         self.assert_files('one')
         self.assert_cached_files('one')
 
+    def test_cached_verified(self):
+        """Cache entries marked as verified are trusted without validation"""
+        self.add_file_to_cache('one', corrupt=True)
+        os.chmod(os.path.join(self.cache_dir, get_hexdigest('one')), 0o444)
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = RuntimeError
+            eq_(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'),
+                True)
+        eq_(open('file-one', encoding='utf-8').read(), 'XXX')
+
+    def test_cached_verified_wrong_size(self):
+        """Verified cache entries of the wrong size are validated"""
+        self.add_file_to_cache('one')
+        cached = os.path.join(self.cache_dir, get_hexdigest('one'))
+        open(cached, **open_attrs).write('one!')
+        os.chmod(cached, 0o444)
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            eq_(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'),
+                True)
+        self.assert_files('one')
+        self.assert_cached_files('one')
+
+    def test_missing_marks_cache_verified(self):
+        """Files added to the cache after a fetch are marked as verified"""
+        self.make_manifest('manifest.tt', 'one')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            eq_(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache'),
+                True)
+        record = tooltool.FileRecord('file-one', 3, get_hexdigest('one'), 'sha512')
+        assert tooltool.is_verified_cache_entry(
+            os.path.join(self.cache_dir, record.digest), record)
+
+    def test_link_cache(self):
+        """With link_cache, files are hardlinked from and into the cache"""
+        self.add_file_to_cache('one')
+        self.make_manifest('manifest.tt', 'one', 'two')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            with mock.patch('tooltool._reflink') as reflink:
+                reflink.return_value = False
+                eq_(tooltool.fetch_files('manifest.tt', self.urls, cache_folder='cache',
+                                         link_cache=True),
+                    True)
+        self.assert_files('one', 'two')
+        self.assert_cached_files('one', 'two')
+        for f in 'one', 'two':
+            assert os.path.samefile('file-' + f, os.path.join(self.cache_dir, get_hexdigest(f)))
+
     def test_missing_unwritable_cache(self):
         """If fetch downloads files but can't write to the cache, it still succeeds"""
         self.make_manifest('manifest.tt', 'one')
@@ -1183,7 +1607,40 @@ class FetchTests(TestDirMixin, unittest.TestCase):
                                      region='ca-north-2'),
                 True)
             fetch_file.assert_called_with(self.urls, mock.ANY, auth_file=None,
-                                          region='ca-north-2')
+                                          region='ca-north-2', segments=1)
+        self.assert_files('one')
+        self.assert_cached_files('one')
+
+    def test_jobs(self):
+        """fetch with several jobs fetches and unpacks every file"""
+        self.add_file_to_dir('one', corrupt=True)
+        self.add_file_to_cache('two')
+        self.add_file_to_dir('four')
+        self.make_manifest('manifest.tt', 'one', 'two', 'three', 'four', unpack=True)
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            with mock.patch('tooltool.unpack_file') as unpack_file:
+                unpack_file.side_effect = lambda f: True
+                eq_(tooltool.fetch_files('manifest.tt', self.urls,
+                                         cache_folder='cache', jobs=3),
+                    True)
+                unpack_file.assert_has_calls([
+                    mock.call('file-one'),
+                    mock.call('file-two'),
+                    mock.call('file-three'),
+                    mock.call('file-four'),
+                ], any_order=True)
+        self.assert_files('one', 'two', 'three', 'four')
+        self.assert_cached_files('one', 'two', 'three')
+
+    def test_jobs_missing_not_on_server(self):
+        """When a file is missing everywhere, fetch with several jobs fails"""
+        self.make_manifest('manifest.tt', 'one', 'ninetynine')
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            eq_(tooltool.fetch_files('manifest.tt', self.urls,
+                                     cache_folder='cache', jobs=2),
+                False)
         self.assert_files('one')
         self.assert_cached_files('one')
 
@@ -1233,6 +1690,23 @@ class FetchTests(TestDirMixin, unittest.TestCase):
                 unpack_file.assert_called_with('file-one')
         self.assert_files('one')
 
+    def test_unpack_cache(self):
+        """When asked to use the unpack cache, fetch calls unpack_cached_file."""
+        self.add_file_to_dir('four')
+        self.make_manifest('manifest.tt', 'three', 'four', unpack=True)
+        with mock.patch('tooltool.fetch_file') as fetch_file:
+            fetch_file.side_effect = self.fake_fetch_file
+            with mock.patch('tooltool.unpack_cached_file') as unpack_cached_file:
+                unpack_cached_file.return_value = True
+                eq_(tooltool.fetch_files('manifest.tt', self.urls,
+                                         cache_folder='cache', unpack_cache=True),
+                    True)
+                eq_(sorted(c[0][0].filename for c in unpack_cached_file.call_args_list),
+                    ['file-four', 'file-three'])
+                for c in unpack_cached_file.call_args_list:
+                    eq_(c[0][1:], ('cache', False))
+        self.assert_files('three', 'four')
+
     def try_unpack_file(self, filename):
         os.mkdir('basename')
         open("basename/LEFTOVER.txt", **open_attrs).write("rm me")
@@ -1259,6 +1733,42 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         self.setup_archive('tar -cJf basename.tar.xz basename')
         self.try_unpack_file('basename.tar.xz')
 
+    def test_unpack_file_tar_xz_lzma(self):
+        self.setup_archive('tar -cJf basename.tar.xz basename')
+        with mock.patch('tooltool._find_executable') as find_executable:
+            find_executable.return_value = None
+            self.try_unpack_file('basename.tar.xz')
+
+    def test_unpack_file_invalid_xz_lzma(self):
+        self.setup_archive('echo BOGUS > basename.tar.xz')
+        with mock.patch('tooltool._find_executable') as find_executable:
+            find_executable.return_value = None
+            self.assertFalse(tooltool.unpack_file('basename.tar.xz'))
+
+    def test_xz_decompress_command_pixz(self):
+        with mock.patch('tooltool._find_executable') as find_executable:
+            find_executable.side_effect = lambda name: '/usr/bin/' + name
+            eq_(tooltool._xz_decompress_command(), ['pixz', '-d'])
+
+    def test_xz_decompress_command_xz(self):
+        with mock.patch('tooltool._find_executable') as find_executable:
+            find_executable.side_effect = lambda name: '/usr/bin/xz' if name == 'xz' else None
+            eq_(tooltool._xz_decompress_command(), ['xz', '-d', '-c', '-T0'])
+
+    def test_unpack_file_path(self):
+        self.setup_archive('tar -czf basename.tar.gz basename')
+        os.mkdir('elsewhere')
+        self.failUnless(tooltool.unpack_file('basename.tar.gz', 'elsewhere'))
+        self.failUnless(os.path.exists('elsewhere/basename/README.txt'))
+        self.failIf(os.path.exists('basename'))
+
+    def test_unpack_file_path_xz(self):
+        self.setup_archive('tar -cJf basename.tar.xz basename')
+        os.mkdir('elsewhere')
+        self.failUnless(tooltool.unpack_file('basename.tar.xz', 'elsewhere'))
+        self.failUnless(os.path.exists('elsewhere/basename/README.txt'))
+        self.failIf(os.path.exists('basename'))
+
     def test_unpack_file_tar_bz2(self):
         self.setup_archive('tar -cjf basename.tar.bz2 basename')
         self.try_unpack_file('basename.tar.bz2')
@@ -1280,18 +1790,88 @@ class FetchTests(TestDirMixin, unittest.TestCase):
         self.assertFalse(tooltool.unpack_file('basename.tar.shrink'))
 
 
+class UnpackCacheTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        os.mkdir('basename')
+        with open('basename/README.txt', 'wb') as f:
+            f.write(b'in tarball')
+        os.chmod('basename/README.txt', 0o755)
+        os.system('tar -czf basename.tar.gz basename')
+        shutil.rmtree('basename')
+        with open('basename.tar.gz', 'rb') as f:
+            digest = tooltool.digest_file(f, 'sha512')
+        self.record = tooltool.FileRecord('basename.tar.gz', os.path.getsize('basename.tar.gz'),
+                                          digest, 'sha512', unpack=True)
+        self.cached_tree = os.path.join('cache', tooltool.UNPACK_CACHE_FOLDER, digest)
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def assert_unpacked(self):
+        with open('basename/README.txt', 'rb') as f:
+            eq_(f.read(), b'in tarball')
+        eq_(os.stat('basename/README.txt').st_mode & 0o777, 0o755)
+
+    def test_miss(self):
+        self.failUnless(tooltool.unpack_cached_file(self.record, 'cache'))
+        self.assert_unpacked()
+        eq_(sorted(os.listdir(self.cached_tree)),
+            sorted([tooltool.UNPACK_CACHE_MARKER, 'basename']))
+        eq_(os.listdir(os.path.dirname(self.cached_tree)), [self.record.digest])
+
+    def test_hit(self):
+        self.failUnless(tooltool.unpack_cached_file(self.record, 'cache'))
+        with open('basename/LEFTOVER.txt', 'wb') as f:
+            f.write(b'rm me')
+        with mock.patch('tooltool.unpack_file') as unpack_file:
+            self.failUnless(tooltool.unpack_cached_file(self.record, 'cache'))
+            assert not unpack_file.called
+        self.assert_unpacked()
+        self.failIf(os.path.exists('basename/LEFTOVER.txt'))
+
+    def test_hit_link(self):
+        self.failUnless(tooltool.unpack_cached_file(self.record, 'cache', link_cache=True))
+        self.assert_unpacked()
+        self.failUnless(os.path.samefile(
+            'basename/README.txt', os.path.join(self.cached_tree, 'basename/README.txt')))
+
+    def test_incomplete_tree(self):
+        os.makedirs(os.path.join(self.cached_tree, 'basename'))
+        self.failUnless(tooltool.unpack_cached_file(self.record, 'cache'))
+        self.assert_unpacked()
+        self.failUnless(os.path.exists(
+            os.path.join(self.cached_tree, tooltool.UNPACK_CACHE_MARKER)))
+
+    def test_unpack_fails(self):
+        with open('basename.tar.gz', 'wb') as f:
+            f.write(b'BOGUS')
+        self.failIf(tooltool.unpack_cached_file(self.record, 'cache'))
+        self.failIf(os.path.exists(self.cached_tree))
+        eq_(os.listdir(os.path.dirname(self.cached_tree)), [])
+
+    def test_cache_unusable(self):
+        with open('cache', 'wb') as f:
+            f.write(b'not a folder')
+        self.failUnless(tooltool.unpack_cached_file(self.record, 'cache'))
+        self.assert_unpacked()
+
+
 class FetchFileTests(BaseFileRecordTest, TestDirMixin):
 
     def setUp(self):
         BaseFileRecordTest.setUp(self)
         self.setUpTestDir()
+        self.sample_hash = get_hexdigest(b'abcd')
+        self.test_record = tooltool.FileRecord('abcd.txt', 4, self.sample_hash, 'sha512')
 
     def tearDown(self):
         self.tearDownTestDir()
         BaseFileRecordTest.tearDown(self)
 
     @contextlib.contextmanager
-    def mocked_urllib2(self, data, exp_size=4096, exp_token=None):
+    def mocked_urllib2(self, data, exp_size=1024 * 1024, exp_token=None):
         with mock.patch(urlopen_module_as_str) as urlopen:
             def fake_read(url, size):
                 eq_(size, exp_size)
@@ -1315,7 +1895,7 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
                 url = req.get_full_url()
                 if url not in data:
                     raise URLError("bogus url")
-                m = mock.Mock(name='Response')
+                m = mock.Mock(name='Response', spec=['read'])
                 m.read = lambda size: fake_read(url, size)
                 return m
             urlopen.side_effect = replacement
@@ -1323,21 +1903,21 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
 
     def test_fetch_file(self):
         # note: the first URL doesn't match, so this loops twice
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: 'abcd'}):
+        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}):
             filename = tooltool.fetch_file(['http://a', 'http://b'], self.test_record)
             assert filename
             eq_(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_region(self):
-        with self.mocked_urllib2({'http://a/sha512/%s?region=us-west-1' % self.sample_hash: 'abcd'}):
+        with self.mocked_urllib2({'http://a/sha512/%s?region=us-west-1' % self.sample_hash: b'abcd'}):
             filename = tooltool.fetch_file(['http://a'], self.test_record, region='us-west-1')
             assert filename
             eq_(open(filename, encoding='utf-8').read(), 'abcd')
             os.unlink(filename)
 
     def test_fetch_file_size(self):
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: 'abcd'}, exp_size=1024):
+        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_size=1024):
             filename = tooltool.fetch_file(
                 ['http://a', 'http://b'], self.test_record, grabchunk=1024)
             assert filename
@@ -1345,7 +1925,7 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
             os.unlink(filename)
 
     def test_fetch_file_auth_file(self):
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: 'abcd'}, exp_token='TOKTOK'):
+        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_token='TOKTOK'):
             with open("auth", **open_attrs) as f:
                 f.write('TOKTOK')
             filename = tooltool.fetch_file(
@@ -1356,7 +1936,7 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
 
     def test_fetch_file_auth_file_taskcluster(self):
         credentials = json.dumps({'clientId': '123', 'accessToken': '456'})
-        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: 'abcd'}, exp_token=credentials):
+        with self.mocked_urllib2({'http://b/sha512/' + self.sample_hash: b'abcd'}, exp_token=credentials):
             with open("auth", **open_attrs) as f:
                 f.write(credentials)
             filename = tooltool.fetch_file(
@@ -1370,6 +1950,190 @@ class FetchFileTests(BaseFileRecordTest, TestDirMixin):
             filename = tooltool.fetch_file(['http://a'], self.test_record)
             assert filename is None
 
+    def test_fetch_file_readinto(self):
+        with mock.patch(urlopen_module_as_str) as urlopen:
+            urlopen.return_value = BytesIO(b'abcd')
+            filename = tooltool.fetch_file(['http://a'], self.test_record, grabchunk=3)
+            assert filename
+            eq_(open(filename, 'rb').read(), b'abcd')
+            os.unlink(filename)
+
+    def test_fetch_file_invalid(self):
+        # the first URL serves corrupt data, so the file is fetched from the second
+        with self.mocked_urllib2({'http://a/sha512/' + self.sample_hash: b'abce',
+                                  'http://b/sha512/' + self.sample_hash: b'abcd'}):
+            filename = tooltool.fetch_file(['http://a', 'http://b'], self.test_record)
+            assert filename
+            eq_(open(filename, 'rb').read(), b'abcd')
+            os.unlink(filename)
+
+    def test_fetch_file_invalid_size(self):
+        with self.mocked_urllib2({'http://a/sha512/' + self.sample_hash: b'abcdabcd'}):
+            filename = tooltool.fetch_file(['http://a'], self.test_record)
+            assert filename is None
+        eq_(os.listdir(self.test_dir), [])
+
+
+class FakeResponse(BytesIO):
+
+    def __init__(self, data, url, code=200, content_range=None, fail_after=None):
+        BytesIO.__init__(self, data)
+        self.url = url
+        self.code = code
+        self.headers = {'Content-Range': content_range} if content_range else {}
+        self.fail_after = fail_after
+
+    def readinto(self, b):
+        if self.fail_after is not None:
+            remaining = self.fail_after - self.tell()
+            if remaining <= 0:
+                raise IOError('connection reset by peer')
+            b = b[:remaining]
+        return BytesIO.readinto(self, b)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+
+class ResumableFetchTests(TestDirMixin, unittest.TestCase):
+
+    content = b'abcdefghijkl'
+
+    def setUp(self):
+        self.setUpTestDir()
+        self.record = tooltool.FileRecord('abc.txt', len(self.content),
+                                          get_hexdigest(self.content), 'sha512')
+        self.requests = []
+        # by server: the offset transfers fail at, and whether ranges are supported
+        self.fail_after = {}
+        self.ranges = {'http://a': True, 'http://b': True}
+        self.expired = False
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def serve(self, req):
+        url = req.get_full_url()
+        range_header = req.get_header('Range')
+        self.requests.append((url, range_header))
+        if url.startswith('https://s3/'):
+            server = url[len('https://s3/'):url.index('?')].replace('/', '://', 1)
+            if self.expired:
+                raise HTTPError(url, 403, 'Forbidden', {}, None)
+        else:
+            server = url[:url.index('/sha512/')]
+        signed_url = 'https://s3/%s?signature=1' % server.replace('://', '/')
+        fail_after = self.fail_after.get(server)
+        if range_header and self.ranges[server]:
+            start, end = range_header[len('bytes='):].split('-')
+            start = int(start)
+            end = int(end) + 1 if end else len(self.content)
+            return FakeResponse(self.content[start:end], signed_url, 206,
+                                'bytes %d-%d/%d' % (start, end - 1, len(self.content)))
+        self.fail_after.pop(server, None)
+        return FakeResponse(self.content, signed_url, fail_after=fail_after)
+
+    def fetch(self, base_urls, **kwargs):
+        with mock.patch(urlopen_module_as_str) as urlopen:
+            urlopen.side_effect = self.serve
+            filename = tooltool.fetch_file(base_urls, self.record, grabchunk=4, **kwargs)
+        if filename:
+            with open(filename, 'rb') as f:
+                return f.read()
+
+    def test_resume(self):
+        self.fail_after['http://a'] = 5
+        eq_(self.fetch(['http://a']), self.content)
+        eq_(self.requests, [('http://a/sha512/' + self.record.digest, None),
+                            ('https://s3/http/a?signature=1', 'bytes=5-11')])
+
+    def test_resume_next_server(self):
+        self.fail_after['http://a'] = 5
+        self.expired = True
+        eq_(self.fetch(['http://a', 'http://b']), self.content)
+        eq_(self.requests[-1], ('http://b/sha512/' + self.record.digest, 'bytes=5-'))
+
+    def test_resume_not_supported(self):
+        self.fail_after['http://a'] = 5
+        self.ranges['http://a'] = self.ranges['http://b'] = False
+        eq_(self.fetch(['http://a', 'http://b']), self.content)
+        eq_(self.requests[-1], ('http://b/sha512/' + self.record.digest, 'bytes=5-'))
+
+    def test_resume_gives_up(self):
+        self.fail_after['http://a'] = 5
+        self.ranges['http://a'] = False
+        eq_(self.fetch(['http://a']), None)
+        eq_(os.listdir(self.test_dir), [])
+
+    def test_segments(self):
+        with mock.patch('tooltool.SEGMENT_MIN_SIZE', 4):
+            eq_(self.fetch(['http://a'], segments=3), self.content)
+        eq_(sorted(self.requests), [
+            ('http://a/sha512/' + self.record.digest, 'bytes=0-3'),
+            ('https://s3/http/a?signature=1', 'bytes=4-7'),
+            ('https://s3/http/a?signature=1', 'bytes=8-11'),
+        ])
+
+    def test_segments_small_file(self):
+        eq_(self.fetch(['http://a'], segments=3), self.content)
+        eq_(self.requests, [('http://a/sha512/' + self.record.digest, None)])
+
+    def test_segments_not_supported(self):
+        self.ranges['http://a'] = False
+        with mock.patch('tooltool.SEGMENT_MIN_SIZE', 4):
+            eq_(self.fetch(['http://a'], segments=3), self.content)
+        eq_(len(self.requests), 1)
+
+    def test_segments_fail(self):
+        self.expired = True
+        with mock.patch('tooltool.SEGMENT_MIN_SIZE', 4):
+            eq_(self.fetch(['http://a'], segments=3), None)
+        eq_(os.listdir(self.test_dir), [])
+
+
+class CopyOrLinkTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+        open('src', 'wb').write(b'data')
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def test_copy(self):
+        tooltool.copy_or_link('src', 'dst')
+        eq_(open('dst', 'rb').read(), b'data')
+        assert not os.path.samefile('src', 'dst')
+
+    def test_link(self):
+        with mock.patch('tooltool._reflink') as reflink:
+            reflink.return_value = False
+            tooltool.copy_or_link('src', 'dst', link=True)
+        assert os.path.samefile('src', 'dst')
+
+    def test_link_across_devices(self):
+        with mock.patch('tooltool._reflink') as reflink:
+            reflink.return_value = False
+            with mock.patch('os.link') as link:
+                link.side_effect = OSError(18, 'Invalid cross-device link')
+                tooltool.copy_or_link('src', 'dst', link=True)
+        eq_(open('dst', 'rb').read(), b'data')
+        assert not os.path.samefile('src', 'dst')
+
+    def test_reflink_unsupported(self):
+        # whatever the filesystem supports, the result has the same content
+        # and no partial clone is left behind when reflinks are unsupported
+        if not tooltool._reflink('src', 'dst'):
+            assert not os.path.exists('dst')
+            tooltool.copy_or_link('src', 'dst', link=True)
+        eq_(open('dst', 'rb').read(), b'data')
+
 
 def test_touch():
     open("testfile", 'wb')
@@ -1445,6 +2209,36 @@ class PurgeTests(TestDirMixin, unittest.TestCase):
         tooltool.purge(self.test_dir, 0)
         eq_(os.listdir(self.test_dir), [])
 
+    def add_unpacked_tree(self, digest, mtime):
+        path = os.path.join(self.test_dir, tooltool.UNPACK_CACHE_FOLDER, digest)
+        os.makedirs(os.path.join(path, 'basename'))
+        marker = os.path.join(path, tooltool.UNPACK_CACHE_MARKER)
+        open(marker, 'wb')
+        os.utime(marker, (mtime, mtime))
+
+    def test_purge_zero_unpacked(self):
+        self.add_files("one")
+        self.add_unpacked_tree('abcd', 1426127031)
+        tooltool.purge(self.test_dir, 0)
+        eq_(os.listdir(self.test_dir), [tooltool.UNPACK_CACHE_FOLDER])
+        eq_(os.listdir(os.path.join(self.test_dir, tooltool.UNPACK_CACHE_FOLDER)), [])
+
+    def test_purge_nonzero_unpacked(self):
+        # the unpacked tree was used before "two", so it goes right after "one"
+        self.add_files("one", "two", "three")
+        self.add_unpacked_tree('abcd', 1426127031 + 5)
+        unpacked = os.path.join(self.test_dir, tooltool.UNPACK_CACHE_FOLDER)
+
+        def fake_freespace(p):
+            used = len(os.listdir(self.test_dir)) - 1 + len(os.listdir(unpacked))
+            return 1024 ** 3 * (10 - used)
+        with mock.patch('tooltool.freespace') as freespace:
+            freespace.side_effect = fake_freespace
+            tooltool.purge(self.test_dir, 8)
+        eq_(sorted(os.listdir(self.test_dir)),
+            sorted(['two', 'three', tooltool.UNPACK_CACHE_FOLDER]))
+        eq_(os.listdir(unpacked), [])
+
     def test_freespace(self):
         # we can't set up a dedicated partition for this test, so just assume
         # the disk isn't full (other tests assume this too, really)
@@ -1579,3 +2373,25 @@ class ListManifest(BaseManifestTest):
     def test_list_invalid_manifest(self):
         open("manifest.tt", **open_attrs).write("BOGUS")
         assert not tooltool.list_manifest("manifest.tt")
+
+
+class BenchmarkTests(TestDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpTestDir()
+
+    def tearDown(self):
+        self.tearDownTestDir()
+
+    def test_benchmark(self):
+        """The benchmarks run over a tiny corpus, and report their throughput
+        and peak RSS"""
+        results = bench_tooltool.benchmark(
+            ['fetch_cold', 'validate_indexed', 'unpack_tar.gz'], 4096, 2,
+            root=self.test_dir)
+        eq_([r['name'] for r in results], ['fetch_cold', 'validate_indexed', 'unpack_tar.gz'])
+        for result in results:
+            eq_(result['bytes'], 8192)
+            assert result['mb_per_s'] > 0, result
+            assert result['peak_rss'] > 0, result
+        eq_(os.listdir(self.test_dir), [])
@@ -36,6 +36,7 @@ import os
 import pprint
 import re
 import shutil
+import stat
 import sys
 import tarfile
 import tempfile
@@ -44,10 +45,15 @@ import time
 import zipfile
 
 from io import open
-from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from subprocess import PIPE
 from subprocess import Popen
 
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
 __version__ = '1'
 
 # Allowed request header characters:
@@ -55,8 +61,32 @@ __version__ = '1'
 REQUEST_HEADER_ATTRIBUTE_CHARS = re.compile(
     r"^[ a-zA-Z0-9_\!#\$%&'\(\)\*\+,\-\./\:;<\=>\?@\[\]\^`\{\|\}~]*$")
 DEFAULT_MANIFEST_NAME = 'manifest.tt'
+DIGEST_INDEX_NAME = '.tooltool-digests'
+# FICLONE ioctl request from linux/fs.h, used to make reflinks
+FICLONE = 0x40049409
 TOOLTOOL_PACKAGE_SUFFIX = '.TOOLTOOL-PACKAGE'
+# subfolder of the cache folder holding the trees extracted from archives,
+# and the file marking a complete extraction in each of them
+UNPACK_CACHE_FOLDER = 'unpacked'
+UNPACK_CACHE_MARKER = '.tooltool-unpacked'
 HAWK_VER = 1
+# how many times an interrupted download is resumed from the same server
+RESUME_ATTEMPTS = 3
+# downloads split into segments are split in segments of at least this size
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+# files of at least this size are uploaded in parts, if the server agrees
+MULTIPART_MIN_SIZE = 64 * 1024 * 1024
+# how many times the upload of a file or part is attempted, and the delay
+# before the first retry, which doubles with each retry
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 2
+# default number of files or parts uploaded in parallel
+UPLOAD_JOBS = 8
+# with --wait, how often the server is asked whether the uploads are verified,
+# and for how long after they can be verified, which is only once their upload
+# URLs expired
+UPLOAD_WAIT_INTERVAL = 10
+UPLOAD_WAIT_TIMEOUT = 60 * 60
 PY3 = sys.version_info[0] == 3
 
 if PY3:
@@ -65,7 +95,7 @@ if PY3:
     six_text_type = str
     unicode = str  # Silence `pyflakes` from reporting `undefined name 'unicode'` in Python 3.
     import urllib.request as urllib2
-    from http.client import HTTPSConnection, HTTPConnection
+    from http.client import HTTPSConnection, HTTPConnection, HTTPException
     from urllib.parse import urlparse, urljoin
     from urllib.request import Request
     from urllib.error import HTTPError, URLError
@@ -74,7 +104,7 @@ else:
     six_binary_type = str
     six_text_type = unicode
     import urllib2
-    from httplib import HTTPSConnection, HTTPConnection
+    from httplib import HTTPSConnection, HTTPConnection, HTTPException
     from urllib2 import Request, HTTPError, URLError
     from urlparse import urlparse, urljoin
 
@@ -381,23 +411,31 @@ class FileRecord(object):
                 "trying to validate size on a missing file, %s", self.filename)
             raise MissingFileException(filename=self.filename)
 
-    def validate_digest(self):
+    def validate_digest(self, digest_index=None):
         if self.present():
-            with open(self.filename, 'rb') as f:
-                return self.digest == digest_file(f, self.algorithm)
+            if digest_index is None:
+                with open(self.filename, 'rb') as f:
+                    return self.digest == digest_file(f, self.algorithm)
+            digest = digest_index.lookup(self.filename, self.algorithm)
+            if digest is None:
+                signature = digest_index.signature(self.filename)
+                with open(self.filename, 'rb') as f:
+                    digest = digest_file(f, self.algorithm)
+                digest_index.record(self.filename, self.algorithm, digest, signature)
+            return self.digest == digest
         else:
             log.debug(
                 "trying to validate digest on a missing file, %s', self.filename")
             raise MissingFileException(filename=self.filename)
 
-    def validate(self):
+    def validate(self, digest_index=None):
         if self.size is None or self.validate_size():
-            if self.validate_digest():
+            if self.validate_digest(digest_index):
                 return True
         return False
 
-    def describe(self):
-        if self.present() and self.validate():
+    def describe(self, digest_index=None):
+        if self.present() and self.validate(digest_index):
             return "'%s' is present and valid" % self.filename
         elif self.present():
             return "'%s' is present and invalid" % self.filename
@@ -405,6 +443,81 @@ class FileRecord(object):
             return "'%s' is absent" % self.filename
 
 
+class DigestIndex(object):
+
+    """I remember the digests of files which have already been hashed, keyed
+    by their path, size, mtime and inode, so that validating a file which
+    hasn't changed since only costs a stat.  I am safe to use from several
+    threads; call save() to persist me."""
+
+    def __init__(self, filename):
+        object.__init__(self)
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(filename, 'rb') as f:
+                self.entries = json.loads(f.read().decode('utf-8'))
+            log.debug("loaded digest index from '%s'" % filename)
+        except (IOError, OSError, ValueError):
+            log.debug("no usable digest index at '%s'" % filename)
+
+    def signature(self, filename):
+        st = os.stat(filename)
+        mtime_ns = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+        return [st.st_size, mtime_ns, st.st_ino]
+
+    def lookup(self, filename, algorithm):
+        """Return the digest of `filename`, or None if it isn't known or the
+        file changed since it was recorded."""
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(filename))
+        if entry is None or entry['algorithm'] != algorithm:
+            return None
+        if entry['signature'] != self.signature(filename):
+            return None
+        log.debug("found digest of %s in digest index" % filename)
+        return entry['digest']
+
+    def record(self, filename, algorithm, digest, signature=None):
+        """Remember the digest of `filename`.  If `signature` is given, it is
+        the signature of the file before it was hashed, and nothing is
+        recorded if the file changed in the meantime."""
+        current = self.signature(filename)
+        if signature is not None and signature != current:
+            return
+        with self.lock:
+            self.entries[os.path.abspath(filename)] = {
+                'algorithm': algorithm,
+                'digest': digest,
+                'signature': current,
+            }
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with self.lock:
+            # forget about files which don't exist anymore
+            entries = dict((path, entry) for path, entry in self.entries.items()
+                           if os.path.exists(path))
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(to_binary(json.dumps(entries)))
+            if sys.platform == 'win32':  # pragma: no cover
+                # os.rename doesn't replace existing files on Windows
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+            os.rename(temp_path, self.filename)
+            self.dirty = False
+        except (IOError, OSError):
+            log.warning("Impossible to save digest index to '%s'" % self.filename,
+                        exc_info=True)
+
+
 def create_file_record(filename, algorithm):
     fo = open(filename, 'rb')
     stored_filename = os.path.split(filename)[1]
@@ -530,11 +643,11 @@ class Manifest(object):
     def validate_sizes(self):
         return all(i.validate_size() for i in self.file_records)
 
-    def validate_digests(self):
-        return all(i.validate_digest() for i in self.file_records)
+    def validate_digests(self, digest_index=None):
+        return all(i.validate_digest(digest_index) for i in self.file_records)
 
-    def validate(self):
-        return all(i.validate() for i in self.file_records)
+    def validate(self, digest_index=None):
+        return all(i.validate(digest_index) for i in self.file_records)
 
     def load(self, data_file, fmt='json'):
         assert fmt in self.valid_formats
@@ -573,15 +686,31 @@ class Manifest(object):
             )
 
 
+def read_chunks(f, chunk_size=1024 * 1024):
+    """I take a file like object 'f' and yield its content in chunks of at
+    most 'chunk_size' bytes.  If 'f' supports readinto, a single buffer is
+    reused for all chunks, so each chunk is only valid until the next one is
+    requested."""
+    readinto = getattr(f, 'readinto', None)
+    if readinto is None:
+        data = f.read(chunk_size)
+        while data:
+            yield data
+            data = f.read(chunk_size)
+        return
+    view = memoryview(bytearray(chunk_size))
+    size = readinto(view)
+    while size:
+        yield view[:size]
+        size = readinto(view)
+
+
 def digest_file(f, a):
     """I take a file like object 'f' and return a hex-string containing
     of the result of the algorithm 'a' applied to 'f'."""
     h = hashlib.new(a)
-    chunk_size = 1024 * 10
-    data = f.read(chunk_size)
-    while data:
+    for data in read_chunks(f):
         h.update(data)
-        data = f.read(chunk_size)
     name = repr(f.name) if hasattr(f, 'name') else 'a file'
     log.debug('hashed %s with %s to be %s', name, a, h.hexdigest())
     return h.hexdigest()
@@ -612,7 +741,7 @@ def open_manifest(manifest_file):
             "manifest file '%s' does not exist" % manifest_file)
 
 
-def list_manifest(manifest_file):
+def list_manifest(manifest_file, digest_index=None):
     """I know how print all the files in a location"""
     try:
         manifest = open_manifest(manifest_file)
@@ -624,12 +753,12 @@ def list_manifest(manifest_file):
         return False
     for f in manifest.file_records:
         print("{}\t{}\t{}".format("P" if f.present() else "-",
-                                  "V" if f.present() and f.validate() else "-",
+                                  "V" if f.present() and f.validate(digest_index) else "-",
                                   f.filename))
     return True
 
 
-def validate_manifest(manifest_file):
+def validate_manifest(manifest_file, digest_index=None):
     """I validate that all files in a manifest are present and valid but
     don't fetch or delete them if they aren't"""
     try:
@@ -646,7 +775,7 @@ def validate_manifest(manifest_file):
         if not f.present():
             absent_files.append(f)
         else:
-            if not f.validate():
+            if not f.validate(digest_index):
                 invalid_files.append(f)
     if len(invalid_files + absent_files) == 0:
         return True
@@ -700,6 +829,60 @@ def add_files(manifest_file, algorithm, filenames, version, visibility, unpack):
     return all_files_added
 
 
+def _reflink(src, dst):
+    """Make `dst` a copy-on-write clone of `src`.  Returns False if this is
+    not supported by the platform or by the filesystem."""
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    try:
+        with open(src, 'rb') as s:
+            with open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+    return True
+
+
+def copy_or_link(src, dst, link=False):
+    """Materialise `src` as `dst`.  If `link` is set, `dst` is a reflink of
+    `src` where the filesystem supports it, or else a hardlink to it; the
+    file is only copied when neither is possible, e.g. across devices."""
+    if link:
+        if _reflink(src, dst):
+            log.debug("reflinked %s to %s" % (src, dst))
+            return
+        try:
+            os.link(src, dst)
+            log.debug("hardlinked %s to %s" % (src, dst))
+            return
+        except (AttributeError, OSError):
+            log.debug("impossible to link %s to %s, copying it" % (src, dst), exc_info=True)
+    shutil.copyfile(src, dst)
+
+
+def is_verified_cache_entry(path, file_record):
+    """Cache entries are made read-only once their content has been verified;
+    such entries are trusted as long as their size matches `file_record`."""
+    st = os.stat(path)
+    writable = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    return not (st.st_mode & writable) and st.st_size == file_record.size
+
+
+def mark_verified_cache_entry(path):
+    os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+def remove_file(path):
+    """Remove `path`, even if it is a read-only (verified) cache entry."""
+    if sys.platform == 'win32':  # pragma: no cover
+        # read-only files can't be removed on Windows
+        os.chmod(path, stat.S_IWRITE)
+    os.remove(path)
+
+
 def touch(f):
     """Used to modify mtime in cached files;
     mtime is used by the purge command"""
@@ -709,50 +892,191 @@ def touch(f):
         log.warn('impossible to update utime of file %s' % f)
 
 
-def fetch_file(base_urls, file_record, grabchunk=1024 * 4, auth_file=None, region=None):
+def _open_range(url, start, end=None):
+    """Open `url` for reading the bytes from offset `start` up to offset `end`
+    (excluded) or to the end of the file, raising ValueError if the server
+    doesn't honour the range."""
+    req = Request(url)
+    if end is None:
+        req.add_header('Range', 'bytes=%d-' % start)
+    else:
+        req.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+    f = urllib2.urlopen(req)
+    if not _is_range_response(f, start):
+        f.close()
+        raise ValueError("%s doesn't support range requests" % url)
+    return f
+
+
+def _is_range_response(f, start):
+    content_range = f.info().get('Content-Range') or ''
+    return f.getcode() == 206 and content_range.startswith('bytes %d-' % start)
+
+
+def _read_resumable(f, write, start, end, grabchunk, attempts=RESUME_ATTEMPTS):
+    """Pass the data read from the response `f` to `write`, `f` starting at
+    offset `start` of the file.  If the transfer is interrupted before offset
+    `end`, it is resumed with a range request against the URL `f` was
+    finally served from, e.g. the signed S3 URL the server redirects to.
+    Return the offset reached."""
+    offset = start
+    url = None
+    while True:
+        try:
+            for data in read_chunks(f, grabchunk):
+                write(data)
+                offset += len(data)
+        except (IOError, HTTPException):
+            if not attempts:
+                raise
+            log.info("transfer interrupted at offset %d" % offset, exc_info=True)
+        else:
+            if end is None or offset >= end or not attempts:
+                return offset
+            log.info("transfer interrupted at offset %d" % offset)
+        attempts -= 1
+        url = url or f.geturl()
+        log.info("resuming transfer from %s at offset %d" % (url.split('?')[0], offset))
+        f = _open_range(url, offset, end)
+
+
+class _Download(object):
+
+    """I am a download being written to `out`, hashed as it is written, so
+    that it can be resumed where it stopped."""
+
+    def __init__(self, out, algorithm):
+        object.__init__(self)
+        self.out = out
+        self.algorithm = algorithm
+        self.restart()
+
+    def restart(self):
+        self.hash = hashlib.new(self.algorithm)
+        self.out.seek(0)
+        self.out.truncate()
+
+    @property
+    def size(self):
+        return self.out.tell()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.out.write(data)
+
+
+def _fetch_segments(req, file_record, out, segments, grabchunk):
+    """Fetch `file_record` into `out` as `segments` byte ranges downloaded
+    concurrently, and return its digest."""
+    size = file_record.size
+    bounds = [(i * size // segments, (i + 1) * size // segments) for i in range(segments)]
+    req.add_header('Range', 'bytes=%d-%d' % (0, bounds[0][1] - 1))
+    first = urllib2.urlopen(req)
+    if not _is_range_response(first, 0):
+        log.info("server doesn't support range requests, fetching in one piece")
+        bounds = [(0, size)]
+    url = first.geturl()
+
+    # preallocate the file, so that each segment is written in place
+    out.truncate(size)
+    out.flush()
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(out.fileno(), 0, size)
+        except OSError:  # pragma: no cover
+            log.debug("impossible to preallocate %s" % out.name, exc_info=True)
+
+    def fetch_segment(segment):
+        start, end = bounds[segment]
+        f = first if segment == 0 else _open_range(url, start, end)
+        with open(out.name, 'r+b') as segment_out:
+            segment_out.seek(start)
+            offset = _read_resumable(f, segment_out.write, start, end, grabchunk)
+        if offset != end:
+            raise ValueError("segment %d of %s is %d bytes long instead of %d" %
+                             (segment, file_record.filename, offset - start, end - start))
+
+    log.info("fetching %s in %d segments" % (file_record.filename, len(bounds)))
+    for _ in _imap_unordered(fetch_segment, range(len(bounds)), len(bounds)):
+        pass
+    # the segments can't be hashed as they arrive, as they arrive out of order
+    with open(out.name, 'rb') as f:
+        return digest_file(f, file_record.algorithm)
+
+
+def fetch_file(base_urls, file_record, grabchunk=1024 * 1024, auth_file=None, region=None,
+               segments=1):
     # A file which is requested to be fetched that exists locally will be
-    # overwritten by this function
+    # overwritten by this function.  The size and digest of the file are
+    # computed while it is downloaded, and a download which doesn't match
+    # `file_record` is discarded, so the returned file needs no further
+    # validation.  Interrupted transfers are resumed, and files large enough
+    # are fetched as up to `segments` concurrent byte ranges.
+    if file_record.size is not None:
+        segments = min(segments, file_record.size // SEGMENT_MIN_SIZE)
+    else:
+        segments = 1
     fd, temp_path = tempfile.mkstemp(dir=os.getcwd())
     os.close(fd)
     fetched_path = None
-    for base_url in base_urls:
-        # Generate the URL for the file on the server side
-        url = urljoin(base_url,
-                      '%s/%s' % (file_record.algorithm, file_record.digest))
-        if region is not None:
-            url += '?region=' + region
-
-        log.info("Attempting to fetch from '%s'..." % base_url)
-
-        # Well, the file doesn't exist locally.  Let's fetch it.
-        try:
-            req = Request(url)
-            _authorize(req, auth_file)
-            f = urllib2.urlopen(req)
-            log.debug("opened %s for reading" % url)
-            with open(temp_path, **open_attrs) as out:
-                k = True
-                size = 0
-                while k:
-                    # TODO: print statistics as file transfers happen both for info and to stop
-                    # buildbot timeouts
-                    indata = f.read(grabchunk)
-                    if PY3:
-                        indata = to_text(indata)
-                    out.write(indata)
-                    size += len(indata)
-                    if len(indata) == 0:
-                        k = False
+    with open(temp_path, 'wb') as out:
+        download = _Download(out, file_record.algorithm)
+        for base_url in base_urls:
+            # Generate the URL for the file on the server side
+            url = urljoin(base_url,
+                          '%s/%s' % (file_record.algorithm, file_record.digest))
+            if region is not None:
+                url += '?region=' + region
+
+            log.info("Attempting to fetch from '%s'..." % base_url)
+
+            # Well, the file doesn't exist locally.  Let's fetch it.
+            try:
+                req = Request(url)
+                _authorize(req, auth_file)
+                if download.size:
+                    # resume the transfer which failed with the previous server
+                    req.add_header('Range', 'bytes=%d-' % download.size)
+                elif segments > 1:
+                    digest = _fetch_segments(req, file_record, out, segments, grabchunk)
+                    if digest != file_record.digest:
+                        log.info("...fetched '%s' from %s, but it is invalid (digest %s)" %
+                                 (file_record.filename, base_url, digest))
+                        download.restart()
+                        continue
+                    log.info("File %s fetched from %s as %s" %
+                             (file_record.filename, base_url, temp_path))
+                    fetched_path = temp_path
+                    break
+                f = urllib2.urlopen(req)
+                log.debug("opened %s for reading" % url)
+                if download.size and not _is_range_response(f, download.size):
+                    log.info("...%s can't resume the transfer, restarting it" % base_url)
+                    download.restart()
+                # TODO: print statistics as file transfers happen both for info and to stop
+                # buildbot timeouts
+                _read_resumable(f, download.write, download.size, file_record.size, grabchunk)
+                size = download.size
+                digest = download.hash.hexdigest()
+                if (file_record.size is not None and size != file_record.size) or \
+                        digest != file_record.digest:
+                    log.info("...fetched '%s' from %s, but it is invalid (size %d, digest %s)" %
+                             (file_record.filename, base_url, size, digest))
+                    download.restart()
+                    continue
                 log.info("File %s fetched from %s as %s" %
                          (file_record.filename, base_url, temp_path))
                 fetched_path = temp_path
                 break
-        except (URLError, HTTPError, ValueError):
-            log.info("...failed to fetch '%s' from %s" %
-                     (file_record.filename, base_url), exc_info=True)
-        except IOError:  # pragma: no cover
-            log.info("failed to write to temporary file for '%s'" %
-                     file_record.filename, exc_info=True)
+            except (URLError, HTTPError, HTTPException, ValueError):
+                log.info("...failed to fetch '%s' from %s" %
+                         (file_record.filename, base_url), exc_info=True)
+            except IOError:
+                log.info("...transfer of '%s' from %s failed" %
+                         (file_record.filename, base_url), exc_info=True)
+            if segments > 1:
+                # segments don't leave a contiguous prefix to resume from
+                download.restart()
 
     # cleanup temp file in case of issues
     if fetched_path:
@@ -775,40 +1099,101 @@ def clean_path(dirname):
 CHECKSUM_SUFFIX = ".checksum"
 
 
-def unpack_file(filename):
+def _find_executable(name):
+    """Return the path of executable `name` if it is found in PATH."""
+    if hasattr(shutil, 'which'):
+        return shutil.which(name)
+    for path in os.environ.get('PATH', '').split(os.pathsep):  # pragma: no cover
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+
+
+def _xz_decompress_command():
+    """Return the command decompressing xz data from stdin to stdout, using
+    several threads when possible, or None if no decompressor is found."""
+    if _find_executable('pixz'):
+        return ['pixz', '-d']
+    if _find_executable('xz'):
+        # -T is ignored by versions of xz which can't decompress in parallel
+        return ['xz', '-d', '-c', '-T0']
+    return None
+
+
+def _untar_stream(fileobj, path):
+    """Extract the tar stream read from `fileobj` into `path`, without ever
+    seeking backwards, so that it only needs to be read once."""
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        tar.extractall(path)
+    finally:
+        tar.close()
+
+
+def _untar_xz(filename, path):
+    """Untar the xz compressed `filename` into `path`.  The decompressed data is piped
+    straight into tarfile, so memory use doesn't depend on the archive size."""
+    command = _xz_decompress_command()
+    if command is None:
+        if lzma is None:
+            log.error('unable to decompress "%s": xz is not available' % filename)
+            return False
+        try:
+            tar = tarfile.open(filename, mode='r|xz')
+            try:
+                tar.extractall(path)
+            finally:
+                tar.close()
+        except (tarfile.TarError, lzma.LZMAError):
+            log.error('failed to untar "%s"' % filename, exc_info=True)
+            return False
+        return True
+    with open(filename, 'rb') as f:
+        # Not using tar -Jxf because it fails on Windows for some reason.
+        process = Popen(command, stdin=f, stdout=PIPE)
+        try:
+            _untar_stream(process.stdout, path)
+            untarred = True
+        except tarfile.TarError:
+            log.error('failed to untar "%s"' % filename, exc_info=True)
+            untarred = False
+        finally:
+            process.stdout.close()
+            process.wait()
+    if process.returncode != 0:
+        log.error('%s failed to decompress "%s"' % (command[0], filename))
+        return False
+    return untarred
+
+
+def unpack_file(filename, path=None):
     """Untar `filename`, assuming it is uncompressed or compressed with bzip2,
     xz, gzip, or unzip a zip file. The file is assumed to contain a single
     directory with a name matching the base of the given filename.
-    Xz support is handled by shelling out to 'tar'."""
-    if os.path.isfile(filename) and tarfile.is_tarfile(filename):
-        tar_file, zip_ext = os.path.splitext(filename)
-        base_file, tar_ext = os.path.splitext(tar_file)
-        clean_path(base_file)
-        log.info('untarring "%s"' % filename)
-        tar = tarfile.open(filename)
-        tar.extractall()
-        tar.close()
-    elif os.path.isfile(filename) and filename.endswith('.tar.xz'):
+    It is extracted in the current directory, or in `path` if given.
+    Archives are unpacked as streams so that memory use stays bounded. Xz
+    support is handled by piping the output of 'pixz' or 'xz' into tarfile,
+    falling back to the lzma module."""
+    if os.path.isfile(filename) and filename.endswith('.tar.xz'):
         base_file = filename.replace('.tar.xz', '')
         clean_path(base_file)
         log.info('untarring "%s"' % filename)
-        # Not using tar -Jxf because it fails on Windows for some reason.
-        process = Popen(['xz', '-d', '-c', filename], stdout=PIPE)
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
+        if not _untar_xz(filename, path or os.curdir):
             return False
-        fileobj = BytesIO()
-        fileobj.write(stdout)
-        fileobj.seek(0)
-        tar = tarfile.open(fileobj=fileobj, mode='r|')
-        tar.extractall()
+    elif os.path.isfile(filename) and tarfile.is_tarfile(filename):
+        tar_file, zip_ext = os.path.splitext(filename)
+        base_file, tar_ext = os.path.splitext(tar_file)
+        clean_path(base_file)
+        log.info('untarring "%s"' % filename)
+        tar = tarfile.open(filename, mode='r|*')
+        tar.extractall(path or os.curdir)
         tar.close()
     elif os.path.isfile(filename) and zipfile.is_zipfile(filename):
         base_file = filename.replace('.zip', '')
         clean_path(base_file)
         log.info('unzipping "%s"' % filename)
         z = zipfile.ZipFile(filename)
-        z.extractall()
+        z.extractall(path)
         z.close()
     else:
         log.error("Unknown archive extension for filename '%s'" % filename)
@@ -816,8 +1201,147 @@ def unpack_file(filename):
     return True
 
 
+def _link_tree(src, dst, link=False):
+    """Recreate the file or directory tree `src` as `dst`, materialising each
+    file with copy_or_link."""
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    elif os.path.isdir(src):
+        os.mkdir(dst)
+        for name in os.listdir(src):
+            _link_tree(os.path.join(src, name), os.path.join(dst, name), link)
+        shutil.copymode(src, dst)
+    else:
+        copy_or_link(src, dst, link)
+        if not os.path.samefile(src, dst):
+            shutil.copymode(src, dst)
+
+
+def unpack_cached_file(file_record, cache_folder, link_cache=False):
+    """Unpack `file_record` like unpack_file, reusing the tree extracted from
+    the same archive by a previous run if `cache_folder` has one.  Trees are
+    kept in the UNPACK_CACHE_FOLDER subfolder, one per archive digest, and are
+    only used once they contain the UNPACK_CACHE_MARKER file written after a
+    complete extraction."""
+    unpack_cache = os.path.join(cache_folder, UNPACK_CACHE_FOLDER)
+    cached_tree = os.path.join(unpack_cache, file_record.digest)
+    marker = os.path.join(cached_tree, UNPACK_CACHE_MARKER)
+    try:
+        if not os.path.exists(marker):
+            if os.path.exists(cached_tree):
+                log.info("Removing incomplete unpacked tree %s" % cached_tree)
+                shutil.rmtree(cached_tree)
+            if not os.path.isdir(unpack_cache):
+                try:
+                    os.makedirs(unpack_cache, 0o0700)
+                except OSError:
+                    # another job may have created it in the meantime
+                    if not os.path.isdir(unpack_cache):
+                        raise
+            # the tree is extracted under a temporary name and only renamed
+            # into place once complete
+            temp_path = tempfile.mkdtemp(dir=unpack_cache, prefix='.tmp')
+            try:
+                if not unpack_file(os.path.abspath(file_record.filename), temp_path):
+                    return False
+                with open(os.path.join(temp_path, UNPACK_CACHE_MARKER), 'wb') as f:
+                    f.write(to_binary(file_record.filename))
+                try:
+                    os.rename(temp_path, cached_tree)
+                except OSError:
+                    # another job may have unpacked the same archive
+                    if not os.path.exists(marker):
+                        raise
+            finally:
+                if os.path.exists(temp_path):
+                    shutil.rmtree(temp_path)
+            log.info("Local cache %s updated with unpacked %s" %
+                     (cache_folder, file_record.filename))
+        else:
+            log.info("File %s retrieved unpacked from local cache %s" %
+                     (file_record.filename, cache_folder))
+        touch(marker)
+
+        for name in os.listdir(cached_tree):
+            if name == UNPACK_CACHE_MARKER:
+                continue
+            dst = os.path.join(os.getcwd(), name)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                clean_path(dst)
+            elif os.path.lexists(dst):
+                remove_file(dst)
+            _link_tree(os.path.join(cached_tree, name), dst, link_cache)
+        return True
+    except (OSError, IOError):
+        log.warning('Impossible to use the unpacked tree of %s from cache folder %s, '
+                    'unpacking it in place' % (file_record.filename, cache_folder),
+                    exc_info=True)
+        return unpack_file(file_record.filename)
+
+
+def _imap_unordered(func, iterable, jobs=1):
+    """Apply `func` to each item of `iterable` and yield the results.  When
+    `jobs` is larger than one, items are processed by a bounded pool of
+    worker threads and results are yielded as soon as they are available."""
+    if jobs <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(func, iterable):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _store_fetched_file(file_record, temp_file_name, cache_folder=None, link_cache=False):
+    """Move a file downloaded and verified by fetch_file as `temp_file_name`
+    into place, and add it to the cache."""
+    log.info("File integrity verified, renaming %s to %s" %
+             (temp_file_name, file_record.filename))
+    os.rename(os.path.join(os.getcwd(), temp_file_name),
+              os.path.join(os.getcwd(), file_record.filename))
+
+    # if I am using a cache and a new file has just been retrieved from a
+    # remote location, I need to update the cache as well
+    if cache_folder:
+        log.info("Updating local cache %s..." % cache_folder)
+        cached_path = os.path.join(cache_folder, file_record.digest)
+        try:
+            if not os.path.exists(cache_folder):
+                log.info("Creating cache in %s..." % cache_folder)
+                try:
+                    os.makedirs(cache_folder, 0o0700)
+                except OSError:
+                    # another job may have created it in the meantime
+                    if not os.path.isdir(cache_folder):
+                        raise
+            # the entry is written under a temporary name and only renamed
+            # into place once complete and marked as verified
+            fd, temp_path = tempfile.mkstemp(dir=cache_folder, prefix='.tmp')
+            os.close(fd)
+            os.remove(temp_path)
+            try:
+                copy_or_link(os.path.join(os.getcwd(), file_record.filename),
+                             temp_path, link_cache)
+                mark_verified_cache_entry(temp_path)
+                os.rename(temp_path, cached_path)
+            finally:
+                if os.path.exists(temp_path):
+                    remove_file(temp_path)
+            log.info("Local cache %s updated with %s" % (cache_folder,
+                                                         file_record.filename))
+            touch(cached_path)
+        except (OSError, IOError):
+            log.warning('Impossible to add file %s to cache folder %s' %
+                        (file_record.filename, cache_folder), exc_info=True)
+
+
 def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
-                auth_file=None, region=None):
+                auth_file=None, region=None, jobs=1, link_cache=False,
+                digest_index=None, unpack_cache=False, segments=1):
     # Lets load the manifest file
     try:
         manifest = open_manifest(manifest_file)
@@ -833,18 +1357,18 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
     present_files = []
 
     # We want to track files that fail to be fetched as well as
-    # files that are fetched
+    # files that have to be fetched
     failed_files = []
-    fetched_files = []
+    fetch_records = []
 
-    # Files that we want to unpack.
+    # Files already present that we want to unpack.
     unpack_files = []
 
-    # Lets go through the manifest and fetch the files that we want
+    # Lets go through the manifest and find the files that we want
     for f in manifest.file_records:
         # case 1: files are already present
         if f.present():
-            if f.validate():
+            if f.validate(digest_index):
                 present_files.append(f.filename)
                 if f.unpack:
                     unpack_files.append(f.filename)
@@ -854,20 +1378,29 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
                 # from the local cash or fetched from a tooltool server
                 log.info("File %s is present locally but it is invalid, so I will remove it "
                          "and try to fetch it" % f.filename)
-                os.remove(os.path.join(os.getcwd(), f.filename))
+                remove_file(os.path.join(os.getcwd(), f.filename))
 
         # check if file is already in cache
         if cache_folder and f.filename not in present_files:
+            cached_path = os.path.join(cache_folder, f.digest)
             try:
-                shutil.copy(os.path.join(cache_folder, f.digest),
-                            os.path.join(os.getcwd(), f.filename))
+                verified = is_verified_cache_entry(cached_path, f)
+                copy_or_link(cached_path, os.path.join(os.getcwd(), f.filename), link_cache)
                 log.info("File %s retrieved from local cache %s" %
                          (f.filename, cache_folder))
-                touch(os.path.join(cache_folder, f.digest))
+                touch(cached_path)
 
                 filerecord_for_validation = FileRecord(
                     f.filename, f.size, f.digest, f.algorithm)
-                if filerecord_for_validation.validate():
+                if verified:
+                    log.debug("File %s was verified when added to the cache" % f.filename)
+                    if digest_index is not None:
+                        digest_index.record(f.filename, f.algorithm, f.digest)
+                    present_files.append(f.filename)
+                    if f.unpack:
+                        unpack_files.append(f.filename)
+                elif filerecord_for_validation.validate(digest_index):
+                    mark_verified_cache_entry(cached_path)
                     present_files.append(f.filename)
                     if f.unpack:
                         unpack_files.append(f.filename)
@@ -876,73 +1409,52 @@ def fetch_files(manifest_file, base_urls, filenames=[], cache_folder=None,
                     # clean up the cache version itself as well
                     log.warn("File %s retrieved from cache is invalid! I am deleting it from the "
                              "cache as well" % f.filename)
-                    os.remove(os.path.join(os.getcwd(), f.filename))
-                    os.remove(os.path.join(cache_folder, f.digest))
-            except IOError:
+                    remove_file(os.path.join(os.getcwd(), f.filename))
+                    remove_file(cached_path)
+            except (OSError, IOError):
                 log.info("File %s not present in local cache folder %s" %
                          (f.filename, cache_folder))
 
-        # now I will try to fetch all files which are not already present and
-        # valid, appending a suffix to avoid race conditions
-        temp_file_name = None
+        # now I will collect all files which are not already present and
+        # valid; they are fetched below.
         # 'filenames' is the list of filenames to be managed, if this variable
         # is a non empty list it can be used to filter if filename is in
         # present_files, it means that I have it already because it was already
         # either in the working dir or in the cache
         if (f.filename in filenames or len(filenames) == 0) and f.filename not in present_files:
-            log.debug("fetching %s" % f.filename)
-            temp_file_name = fetch_file(base_urls, f, auth_file=auth_file, region=region)
-            if temp_file_name:
-                fetched_files.append((f, temp_file_name))
-            else:
-                failed_files.append(f.filename)
+            fetch_records.append(f)
         else:
             log.debug("skipping %s" % f.filename)
 
-    # lets ensure that fetched files match what the manifest specified
-    for localfile, temp_file_name in fetched_files:
-        # since I downloaded to a temp file, I need to perform all validations on the temp file
-        # this is why filerecord_for_validation is created
-
-        filerecord_for_validation = FileRecord(
-            temp_file_name, localfile.size, localfile.digest, localfile.algorithm)
-
-        if filerecord_for_validation.validate():
-            # great!
-            # I can rename the temp file
-            log.info("File integrity verified, renaming %s to %s" %
-                     (temp_file_name, localfile.filename))
-            os.rename(os.path.join(os.getcwd(), temp_file_name),
-                      os.path.join(os.getcwd(), localfile.filename))
-
-            if localfile.unpack:
-                unpack_files.append(localfile.filename)
-
-            # if I am using a cache and a new file has just been retrieved from a
-            # remote location, I need to update the cache as well
-            if cache_folder:
-                log.info("Updating local cache %s..." % cache_folder)
-                try:
-                    if not os.path.exists(cache_folder):
-                        log.info("Creating cache in %s..." % cache_folder)
-                        os.makedirs(cache_folder, 0o0700)
-                    shutil.copy(os.path.join(os.getcwd(), localfile.filename),
-                                os.path.join(cache_folder, localfile.digest))
-                    log.info("Local cache %s updated with %s" % (cache_folder,
-                                                                 localfile.filename))
-                    touch(os.path.join(cache_folder, localfile.digest))
-                except (OSError, IOError):
-                    log.warning('Impossible to add file %s to cache folder %s' %
-                                (localfile.filename, cache_folder), exc_info=True)
-        else:
-            failed_files.append(localfile.filename)
-            log.error("'%s'" % filerecord_for_validation.describe())
-            os.remove(temp_file_name)
+    # Each task either unpacks a file which is already present, or fetches a
+    # file that matches what the manifest specified and unpacks it right
+    # away.  With more than one job, tasks run concurrently so that
+    # downloads overlap with each other and with unpacking.
+    def process(task):
+        f, needs_fetch = task
+        if needs_fetch:
+            log.debug("fetching %s" % f.filename)
+            # fetch_file validates the file while downloading it
+            temp_file_name = fetch_file(base_urls, f, auth_file=auth_file, region=region,
+                                        segments=segments)
+            if not temp_file_name:
+                return [f.filename]
+            _store_fetched_file(f, temp_file_name, cache_folder, link_cache)
+            if digest_index is not None:
+                digest_index.record(f.filename, f.algorithm, f.digest)
+        if f.unpack:
+            if cache_folder and unpack_cache:
+                unpacked = unpack_cached_file(f, cache_folder, link_cache)
+            else:
+                unpacked = unpack_file(f.filename)
+            if not unpacked:
+                return [f.filename]
+        return []
 
-    # Unpack files that need to be unpacked.
-    for filename in unpack_files:
-        if not unpack_file(filename):
-            failed_files.append(filename)
+    tasks = [(f, False) for f in manifest.file_records if f.filename in unpack_files]
+    tasks.extend((f, True) for f in fetch_records)
+    for failed in _imap_unordered(process, tasks, jobs):
+        failed_files.extend(failed)
 
     # If we failed to fetch or validate a file, we need to fail
     if len(failed_files) > 0:
@@ -969,7 +1481,8 @@ def freespace(p):
 def purge(folder, gigs):
     """If gigs is non 0, it deletes files in `folder` until `gigs` GB are free,
     starting from older files.  If gigs is 0, a full purge will be performed.
-    No recursive deletion of files in subfolder is performed."""
+    No recursive deletion of files in subfolder is performed, except for the
+    trees in the UNPACK_CACHE_FOLDER subfolder, which are deleted as a whole."""
 
     full_purge = bool(gigs == 0)
     gigs *= 1024 * 1024 * 1024
@@ -988,11 +1501,23 @@ def purge(folder, gigs):
         mtime = os.path.getmtime(p)
         files.append((mtime, p))
 
+    # unpacked trees are touched through their marker when they are used
+    unpack_cache = os.path.join(folder, UNPACK_CACHE_FOLDER)
+    if os.path.isdir(unpack_cache):
+        for d in os.listdir(unpack_cache):
+            p = os.path.join(unpack_cache, d)
+            marker = os.path.join(p, UNPACK_CACHE_MARKER)
+            mtime = os.path.getmtime(marker if os.path.exists(marker) else p)
+            files.append((mtime, p))
+
     # iterate files sorted by mtime
     for _, f in sorted(files):
         log.info("removing %s to free up space" % f)
         try:
-            os.remove(f)
+            if os.path.isdir(f):
+                shutil.rmtree(f)
+            else:
+                remove_file(f)
         except OSError:
             log.info("Impossible to remove %s" % f, exc_info=True)
         if not full_purge and freespace(folder) >= gigs:
@@ -1048,39 +1573,112 @@ def _send_batch(base_url, auth_file, batch, region):
     return json.load(resp)['result']
 
 
-def _s3_upload(filename, file):
+class _FileSlice(object):
+
+    """I am a read-only view of `length` bytes of the file `f`, starting at
+    `offset`, which httplib streams when sending a request body."""
+
+    def __init__(self, f, offset, length):
+        object.__init__(self)
+        f.seek(offset)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _s3_put(url, f, offset, length, content_type=None):
     # urllib2 does not support streaming, so we fall back to good old httplib
-    url = urlparse(file['put_url'])
+    url = urlparse(url)
     cls = HTTPSConnection if url.scheme == 'https' else HTTPConnection
     host, port = url.netloc.split(':') if ':' in url.netloc else (url.netloc, 443)
     port = int(port)
     conn = cls(host, port)
     try:
         req_path = "%s?%s" % (url.path, url.query) if url.query else url.path
-        with open(filename, 'rb') as f:
-            content = f.read()
-            content_length = len(content)
-            f.seek(0)
-            conn.request(
-                'PUT',
-                req_path,
-                f,
-                {
-                    'Content-Type': 'application/octet-stream',
-                    'Content-Length': str(content_length),
-                },
-            )
-            resp = conn.getresponse()
-            resp_body = resp.read()
-            conn.close()
-        if resp.status != 200:
-            raise RuntimeError("Non-200 return from AWS: %s %s\n%s" %
-                               (resp.status, resp.reason, resp_body))
-    except Exception:
-        file['upload_exception'] = sys.exc_info()
-        file['upload_ok'] = False
-    else:
-        file['upload_ok'] = True
+        headers = {'Content-Length': str(length)}
+        if content_type:
+            headers['Content-Type'] = content_type
+        conn.request('PUT', req_path, _FileSlice(f, offset, length), headers)
+        resp = conn.getresponse()
+        resp_body = resp.read()
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise RuntimeError("Non-200 return from AWS: %s %s\n%s" %
+                           (resp.status, resp.reason, resp_body))
+
+
+def _s3_upload_part(filename, url, offset=0, length=None, content_type=None):
+    """Upload `length` bytes of `filename` from `offset`, or the whole file,
+    to the signed S3 `url`.  The data is streamed from disk, and the upload is
+    attempted up to UPLOAD_ATTEMPTS times."""
+    with open(filename, 'rb') as f:
+        if length is None:
+            length = os.fstat(f.fileno()).st_size - offset
+        delay = UPLOAD_RETRY_DELAY
+        for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+            try:
+                _s3_put(url, f, offset, length, content_type)
+                return
+            except Exception:
+                if attempt == UPLOAD_ATTEMPTS:
+                    raise
+                log.warning("%s: upload of %d bytes at offset %d failed, retrying in %d "
+                            "seconds" % (filename, length, offset, delay), exc_info=True)
+                time.sleep(delay)
+                delay *= 2
+
+
+def _upload_parts(filename, file):
+    """Return the arguments of the _s3_upload_part calls uploading `filename`
+    as described by the server in `file`."""
+    if 'part_urls' not in file:
+        return [(filename, file['put_url'], 0, None, 'application/octet-stream')]
+    size = os.path.getsize(filename)
+    part_size = file['part_size']
+    if len(file['part_urls']) != max(1, int(math.ceil(size / float(part_size)))):
+        raise ValueError("%s: the server expects %d parts of %d bytes, for %d bytes" %
+                         (filename, len(file['part_urls']), part_size, size))
+    return [(filename, url, i * part_size, min(part_size, size - i * part_size), None)
+            for i, url in enumerate(file['part_urls'])]
+
+
+def _s3_upload(files, jobs=UPLOAD_JOBS):
+    """Upload the files which the server gave upload URLs for in `files`, as
+    returned by the server for an upload batch, with up to `jobs` files or
+    parts of files being uploaded at a time.  Each file is annotated with the
+    result of its upload."""
+    parts = []
+    for filename, file in files.items():
+        if 'put_url' in file or 'part_urls' in file:
+            log.info("%s: starting upload" % (filename,))
+            file['upload_ok'] = True
+            try:
+                parts.extend(_upload_parts(filename, file))
+            except Exception:
+                file['upload_ok'] = False
+                file['upload_exception'] = sys.exc_info()
+        else:
+            log.info("%s: already exists on server" % (filename,))
+
+    def upload_part(part):
+        try:
+            _s3_upload_part(*part)
+        except Exception:
+            return part[0], sys.exc_info()
+        return part[0], None
+
+    for filename, exc_info in _imap_unordered(upload_part, parts, jobs):
+        file = files[filename]
+        if exc_info and file['upload_ok']:
+            file['upload_ok'] = False
+            file['upload_exception'] = exc_info
 
 
 def _notify_upload_complete(base_url, auth_file, file):
@@ -1105,7 +1703,70 @@ def _notify_upload_complete(base_url, auth_file, file):
         log.exception("While notifying server of upload completion:")
 
 
-def upload(manifest, message, base_urls, auth_file, region):
+def _notify_batch_complete(base_url, auth_file, batch_id, digests):
+    """Ask the server to verify the uploaded files with `digests` of the
+    batch `batch_id` as soon as their upload URLs expire, without waiting
+    for it.  Return False if the server doesn't support it."""
+    url = urljoin(base_url, 'upload/%d/complete' % batch_id)
+    if PY3:
+        data = to_binary(json.dumps({'digests': digests}))
+    else:
+        data = json.dumps({'digests': digests})
+    req = Request(url, data, {'Content-Type': 'application/json'})
+    _authorize(req, auth_file)
+    try:
+        urllib2.urlopen(req)
+    except HTTPError as e:
+        if e.code in (404, 405):
+            return False
+        _log_api_error(e)
+    except Exception:
+        log.exception("While notifying server of upload completion:")
+    return True
+
+
+def _get_batch_status(base_url, auth_file, batch_id):
+    req = Request(urljoin(base_url, 'upload/%d/status' % batch_id))
+    _authorize(req, auth_file)
+    try:
+        resp = urllib2.urlopen(req)
+    except (URLError, HTTPError) as e:
+        _log_api_error(e)
+        return None
+    return json.load(resp)['result']
+
+
+def _wait_for_batch(base_url, auth_file, batch_id, digests):
+    """Poll the server until the uploaded files with `digests` of the batch
+    `batch_id` are verified, returning False if any of them fails."""
+    deadline = time.time() + UPLOAD_WAIT_TIMEOUT
+    while True:
+        status = _get_batch_status(base_url, auth_file, batch_id)
+        if status is None:
+            return False
+        states = dict((file['digest'], file['state'])
+                      for file in status['files'].values())
+        # the files can't be verified before their upload URLs expire, which
+        # for multipart uploads can be later than the timeout
+        for file in status['files'].values():
+            if file['digest'] in digests and file.get('verify_after'):
+                deadline = max(deadline, file['verify_after'] + UPLOAD_WAIT_TIMEOUT)
+        failed = [d for d in digests if states.get(d) == 'failed']
+        if failed:
+            log.error("server failed to verify uploads: %s" % ', '.join(failed))
+            return False
+        if all(states.get(d) == 'verified' for d in digests):
+            log.info("server verified all uploads")
+            return True
+        if time.time() >= deadline:
+            log.error("timed out waiting for the server to verify uploads")
+            return False
+        log.info("waiting for the server to verify uploads")
+        time.sleep(UPLOAD_WAIT_INTERVAL)
+
+
+def upload(manifest, message, base_urls, auth_file, region, digest_index=None,
+           jobs=UPLOAD_JOBS, wait=False):
     try:
         manifest = open_manifest(manifest)
     except InvalidManifest:
@@ -1113,7 +1774,7 @@ def upload(manifest, message, base_urls, auth_file, region):
         return False
 
     # verify the manifest, since we'll need the files present to upload
-    if not manifest.validate():
+    if not manifest.validate(digest_index):
         log.error('manifest is invalid')
         return False
 
@@ -1132,6 +1793,8 @@ def upload(manifest, message, base_urls, auth_file, region):
             'algorithm': fr.algorithm,
             'visibility': fr.visibility,
         }
+        if fr.size is not None and fr.size >= MULTIPART_MIN_SIZE:
+            batch['files'][fr.filename]['multipart'] = True
 
     # make the upload request
     resp = _send_batch(base_urls[0], auth_file, batch, region)
@@ -1139,43 +1802,43 @@ def upload(manifest, message, base_urls, auth_file, region):
         return None
     files = resp['files']
 
-    # Upload the files, each in a thread.  This allows us to start all of the
-    # uploads before any of the URLs expire.
-    threads = {}
-    for filename, file in files.items():
-        if 'put_url' in file:
-            log.info("%s: starting upload" % (filename,))
-            thd = threading.Thread(target=_s3_upload,
-                                   args=(filename, file))
-            thd.daemon = 1
-            thd.start()
-            threads[filename] = thd
-        else:
-            log.info("%s: already exists on server" % (filename,))
-
-    # re-join all of those threads as they exit
+    # Upload the files, or their parts, through a bounded pool of threads.
+    # Single-part upload URLs expire quickly, so files large enough to be at
+    # risk of being queued past their expiration are uploaded in parts.
+    _s3_upload(files, jobs)
     success = True
-    while threads:
-        for filename, thread in list(threads.items()):
-            if not thread.is_alive():
-                # _s3_upload has annotated file with result information
-                file = files[filename]
-                thread.join()
-                if file['upload_ok']:
-                    log.info("%s: uploaded" % filename)
-                else:
-                    log.error("%s: failed" % filename,
-                              exc_info=file['upload_exception'])
-                    success = False
-                del threads[filename]
-
-    # notify the server that the uploads are completed.  If the notification
-    # fails, we don't consider that an error (the server will notice
-    # eventually)
     for filename, file in files.items():
-        if 'put_url' in file and file['upload_ok']:
-            log.info("notifying server of upload completion for %s" % (filename,))
-            _notify_upload_complete(base_urls[0], auth_file, file)
+        if 'upload_ok' not in file:
+            continue
+        if file['upload_ok']:
+            log.info("%s: uploaded" % filename)
+        else:
+            log.error("%s: failed" % filename,
+                      exc_info=file['upload_exception'])
+            success = False
+
+    # notify the server that the uploads are completed, once for the whole
+    # batch; it verifies them in the background once their upload URLs
+    # expire.  Servers without batch notifications are notified per file.
+    # If the notification fails, we don't consider that an error (the server
+    # will notice eventually)
+    uploaded = [file['digest'] for file in files.values() if file.get('upload_ok')]
+    if not uploaded:
+        return success
+    batch_id = resp.get('id')
+    log.info("notifying server of upload completion")
+    if batch_id is None or \
+            not _notify_batch_complete(base_urls[0], auth_file, batch_id, uploaded):
+        for filename, file in files.items():
+            if file.get('upload_ok'):
+                log.info("notifying server of upload completion for %s" % (filename,))
+                _notify_upload_complete(base_urls[0], auth_file, file)
+
+    if wait and success:
+        if batch_id is None:
+            log.error("the server doesn't report the upload status")
+            return False
+        success = _wait_for_batch(base_urls[0], auth_file, batch_id, uploaded)
 
     return success
 
@@ -1189,10 +1852,23 @@ def process_command(options, args):
               (cmd, '", "'.join(cmd_args)))
     log.debug("using options: %s" % options)
 
+    # the digest index lets validations skip hashing files which haven't
+    # changed since they were last hashed
+    digest_index = None
+    if not options.get('paranoid'):
+        digest_index = DigestIndex(DIGEST_INDEX_NAME)
+    try:
+        return _process_command(options, cmd, cmd_args, digest_index)
+    finally:
+        if digest_index is not None:
+            digest_index.save()
+
+
+def _process_command(options, cmd, cmd_args, digest_index):
     if cmd == 'list':
-        return list_manifest(options['manifest'])
+        return list_manifest(options['manifest'], digest_index=digest_index)
     if cmd == 'validate':
-        return validate_manifest(options['manifest'])
+        return validate_manifest(options['manifest'], digest_index=digest_index)
     elif cmd == 'add':
         return add_files(options['manifest'], options['algorithm'], cmd_args,
                          options['version'], options['visibility'],
@@ -1210,7 +1886,12 @@ def process_command(options, args):
             cmd_args,
             cache_folder=options['cache_folder'],
             auth_file=options.get("auth_file"),
-            region=options.get('region'))
+            region=options.get('region'),
+            jobs=options.get('jobs') or 1,
+            link_cache=options.get('link_cache'),
+            digest_index=digest_index,
+            unpack_cache=options.get('unpack_cache'),
+            segments=options.get('segments') or 1)
     elif cmd == 'upload':
         if not options.get('message'):
             log.critical('upload command requires a message')
@@ -1220,7 +1901,10 @@ def process_command(options, args):
             options.get('message'),
             options.get('base_url'),
             options.get('auth_file'),
-            options.get('region'))
+            options.get('region'),
+            digest_index=digest_index,
+            jobs=options.get('jobs') or UPLOAD_JOBS,
+            wait=options.get('wait'))
     else:
         log.critical('command "%s" is not implemented' % cmd)
         return False
@@ -1262,15 +1946,43 @@ def main(argv, _skip_logging=False):
                       'is appropriate for Mozilla')
     parser.add_option('-c', '--cache-folder', dest='cache_folder',
                       help='Local cache folder')
+    parser.add_option('--segments', dest='segments', type='int', default=1,
+                      help='Fetch large files as up to this many byte ranges '
+                           'downloaded concurrently')
+    parser.add_option('--link', dest='link_cache', default=False,
+                      action='store_true',
+                      help='Materialise files from and into the cache folder with '
+                           'reflinks or hardlinks rather than copies, falling back '
+                           'to a copy across devices. Fetched files are then '
+                           'read-only.')
+    parser.add_option('--unpack-cache', dest='unpack_cache', default=False,
+                      action='store_true',
+                      help='Keep the trees extracted from archives in the cache folder '
+                           'and reuse them rather than unpacking the same archive '
+                           'again. With --link, unpacked files are shared with the '
+                           'cache and must not be modified in place.')
+    parser.add_option('--paranoid', dest='paranoid', default=False,
+                      action='store_true',
+                      help='Hash every file when validating it, instead of trusting '
+                           'the digests recorded in %s for files which have not '
+                           'changed' % DIGEST_INDEX_NAME)
     parser.add_option('-s', '--size',
                       help='free space required (in GB)', dest='size',
                       type='float', default=0.)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int',
+                      help='Number of files to fetch and unpack in parallel (default 1), '
+                           'or of files or parts of files to upload in parallel '
+                           '(default %d)' % UPLOAD_JOBS)
     parser.add_option('-r', '--region', help='Preferred AWS region for upload or fetch; '
                       'example: --region=us-west-2')
     parser.add_option('--message',
                       help='The "commit message" for an upload; format with a bug number '
                            'and brief comment',
                       dest='message')
+    parser.add_option('--wait', dest='wait', default=False,
+                      action='store_true',
+                      help='After an upload, wait until the server has verified the '
+                           'uploaded files, and fail if it rejects any of them')
     parser.add_option('--authentication-file',
                       help='Use the RelengAPI token found in the given file to '
                            'authenticate to the RelengAPI server.',
@@ -1306,6 +2018,11 @@ def main(argv, _skip_logging=False):
     if options['algorithm'] != 'sha512':
         parser.error('only --algorithm sha512 is supported')
 
+    if options['jobs'] is not None and options['jobs'] < 1:
+        parser.error('--jobs must be at least 1')
+    if options['segments'] < 1:
+        parser.error('--segments must be at least 1')
+
     if len(args) < 1:
         parser.error('You must specify a command')
 
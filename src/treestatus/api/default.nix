@@ -3,8 +3,8 @@
 
 let
 
-  inherit (releng_pkgs.lib) mkBackend fromRequirementsFile filterSource mysql2postgresql;
-  inherit (releng_pkgs.pkgs) writeScript;
+  inherit (releng_pkgs.lib) mkBackend mkTaskclusterHook fromRequirementsFile filterSource mysql2postgresql;
+  inherit (releng_pkgs.pkgs) writeScript writeText;
   inherit (releng_pkgs.pkgs.lib) fileContents;
   inherit (releng_pkgs.tools) pypi2nix;
 
@@ -28,6 +28,37 @@ let
   python = import ./requirements.nix { inherit (releng_pkgs) pkgs; };
   project_name = "treestatus/api";
 
+  mkCronJob = { schedule, command }:
+    builtins.listToAttrs (
+      map (channel:
+        { name = channel;
+          value =
+            let
+              hook_name = "${self.name}_${command}_${channel}";
+              hook = mkTaskclusterHook {
+                name = hook_name;
+                owner = "rgarbas@mozilla.com";
+                inherit schedule;
+                scopes =
+                  [ "secrets:get:repo:github.com/mozilla-releng/services:branch:${channel}"
+                    "queue:create-task:aws-provisioner-v1/releng-svc"
+                  ];
+                taskImage = self.docker;
+                taskEnv = {
+                  TASKCLUSTER_SECRET = "repo:github.com/mozilla-releng/services:branch:${channel}";
+                };
+                taskCapabilities = {};
+                taskCommand = [
+                  "flask"
+                  command
+                ];
+                deadline = "4 hours";
+                maxRunTime = 4 * 60 * 60;
+              };
+            in
+              writeText "taskcluster-hook-${hook_name}.json" (builtins.toJSON hook);
+        }) ["testing" "staging" "production"]);
+
   self = mkBackend {
     inherit python project_name;
     inProduction = true;
@@ -39,7 +70,25 @@ let
       (fromRequirementsFile ./requirements-dev.txt python.packages);
     propagatedBuildInputs =
       (fromRequirementsFile ./requirements.txt python.packages);
+    # the streams of tree status changes are long requests, which would
+    # each hold a sync worker
+    dockerCmd = [
+      "gunicorn"
+      "${self.dirname}.flask:app"
+      "--worker-class" "gthread"
+      "--threads" "100"
+      "--log-file"
+      "-"
+    ];
     passthru = {
+      # the notifications left in the outbox, e.g. by a worker which was
+      # restarted, are sent by the next tree status change of any process,
+      # or by this job
+      cron = {
+        drain_notifications = mkCronJob { schedule = [ "*/5 * * * *" ];  # every 5 min;
+                                          command = "drain-notifications";
+                                        };
+      };
       migrate = mysql2postgresql {
         inherit beforeSQL afterSQL;
         inherit(self) name;
@@ -0,0 +1,29 @@
+"""Index the treestatus log by (tree, when, id), for its keyset pagination
+
+The log of a tree is paginated from the most recent entries, ordered by
+(when, id) descending, which this index serves.  The index on tree alone is
+a prefix of it.
+
+Revision ID: 1fb1e60c6b99
+Revises: 62fbfc3bef7f
+Create Date: 2026-10-18 14:26:02.184517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1fb1e60c6b99'
+down_revision = '62fbfc3bef7f'
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    op.create_index('releng_treestatus_log_tree_when_id', 'releng_treestatus_log',
+                    ['tree', sa.text('"when" DESC'), sa.text('id DESC')], unique=False)
+    op.drop_index('ix_releng_treestatus_log_tree', table_name='releng_treestatus_log')
+
+
+def downgrade():
+    op.create_index('ix_releng_treestatus_log_tree', 'releng_treestatus_log', ['tree'], unique=False)
+    op.drop_index('releng_treestatus_log_tree_when_id', table_name='releng_treestatus_log')
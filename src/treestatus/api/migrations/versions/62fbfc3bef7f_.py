@@ -0,0 +1,87 @@
+"""Initial treestatus schema, as created by db.create_all() before migrations
+
+Revision ID: 62fbfc3bef7f
+Revises: None
+Create Date: 2026-10-18 14:21:37.512903
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '62fbfc3bef7f'
+down_revision = None
+
+import sqlalchemy as sa
+from alembic import op
+
+
+def upgrade():
+    # the tables exist already in databases created by db.create_all()
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'releng_treestatus_trees' not in tables:
+        op.create_table('releng_treestatus_trees',
+        sa.Column('tree', sa.String(length=32), nullable=False),
+        sa.Column('status', sa.String(length=64), nullable=False),
+        sa.Column('reason', sa.Text(), nullable=False),
+        sa.Column('message_of_the_day', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('tree')
+        )
+    if 'releng_treestatus_log' not in tables:
+        op.create_table('releng_treestatus_log',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tree', sa.String(length=32), nullable=False),
+        sa.Column('when', sa.DateTime(), nullable=False),
+        sa.Column('who', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=64), nullable=False),
+        sa.Column('reason', sa.Text(), nullable=False),
+        sa.Column('tags', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'releng_treestatus_changes' not in tables:
+        op.create_table('releng_treestatus_changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('who', sa.Text(), nullable=False),
+        sa.Column('reason', sa.Text(), nullable=False),
+        sa.Column('when', sa.DateTime(), nullable=False),
+        sa.Column('status', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'releng_treestatus_change_trees' not in tables:
+        op.create_table('releng_treestatus_change_trees',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('stack_id', sa.Integer(), nullable=True),
+        sa.Column('tree', sa.String(length=32), nullable=False),
+        sa.Column('last_state', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['stack_id'], ['releng_treestatus_changes.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'releng_treestatus_notifications' not in tables:
+        op.create_table('releng_treestatus_notifications',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('target', sa.String(length=32), nullable=False),
+        sa.Column('tree', sa.String(length=32), nullable=False),
+        sa.Column('status_from', sa.String(length=64), nullable=False),
+        sa.Column('status_to', sa.String(length=64), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    # the indexes exist already in databases created by db.create_all()
+    for table, column in [
+            ('releng_treestatus_log', 'tree'),
+            ('releng_treestatus_log', 'when'),
+            ('releng_treestatus_changes', 'when'),
+            ('releng_treestatus_change_trees', 'stack_id'),
+            ('releng_treestatus_change_trees', 'tree'),
+            ('releng_treestatus_notifications', 'next_attempt'),
+            ]:
+        op.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ("{1}")'.format(table, column))
+
+
+def downgrade():
+    op.drop_table('releng_treestatus_notifications')
+    op.drop_table('releng_treestatus_change_trees')
+    op.drop_table('releng_treestatus_changes')
+    op.drop_table('releng_treestatus_log')
+    op.drop_table('releng_treestatus_trees')
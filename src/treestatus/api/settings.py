@@ -119,6 +119,16 @@ if not DEBUG:
     PULSE_VIRTUAL_HOST = secrets['PULSE_VIRTUAL_HOST']
 
 
+# -- NOTIFICATIONS ------------------------------------------------------------
+#
+# Statuspage and pulse notifications are sent from an outbox table by a
+# background worker in each process, unless it is disabled, in which case
+# `flask drain-notifications` has to be run periodically.
+#
+
+NOTIFICATIONS_WORKER = not bool(os.environ.get('DISABLE_NOTIFICATIONS_WORKER', False))
+
+
 # -- STATUSPAGE  --------------------------------------------------------------
 
 STATUSPAGE_ENABLE = True
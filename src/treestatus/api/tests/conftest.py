@@ -19,9 +19,33 @@ def app():
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'TASKCLUSTER_CLIENT_ID': 'something',
         'TASKCLUSTER_ACCESS_TOKEN': 'something',
+        'NOTIFICATIONS_WORKER': False,
     })
     app = treestatus_api.create_app(config)
 
     with app.app_context():
         backend_common.testing.configure_app(app)
         yield app
+
+
+@pytest.fixture
+def db(app):
+    '''Empty the database, and the cache, after a test
+    '''
+    yield app.db
+    app.db.session.remove()
+    app.db.drop_all()
+    app.db.create_all()
+    app.cache.clear()
+
+
+@pytest.fixture
+def trees(db):
+    '''Create the `mozilla-central` and `autoland` trees, both open
+    '''
+    import treestatus_api.models
+
+    for name in ('mozilla-central', 'autoland'):
+        db.session.add(treestatus_api.models.Tree(tree=name, status='open', reason='', message_of_the_day=''))
+    db.session.commit()
+    return ['mozilla-central', 'autoland']
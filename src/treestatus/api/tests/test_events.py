@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import threading
+
+import pytest
+
+
+def change(tree, status_from='open', status_to='closed'):
+    return dict(tree=dict(tree=tree, status=status_to), status_from=status_from, status_to=status_to, tags=[])
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    '''An event bus keeping the 3 latest events, in memory
+    '''
+    import treestatus_api.events
+
+    bus = treestatus_api.events.EventBus(size=3)
+    monkeypatch.setattr(treestatus_api.events, 'bus', bus)
+    return bus
+
+
+def test_wait(bus):
+    bus.publish([change('autoland'), change('mozilla-central')])
+    assert bus.version() == 2
+
+    events = bus.wait(0, 0)
+    assert [(event['version'], event['tree']['tree']) for event in events] == [(1, 'autoland'), (2, 'mozilla-central')]
+    assert [event['version'] for event in bus.wait(1, 0)] == [2]
+    assert bus.wait(2, 0) == []
+
+
+def test_wait_blocks(bus):
+    # waits for the next event, as it is published
+    timer = threading.Timer(0.1, bus.publish, [[change('autoland')]])
+    timer.start()
+    try:
+        events = bus.wait(0, 10)
+    finally:
+        timer.join()
+    assert [event['version'] for event in events] == [1]
+
+
+def test_wait_history_lost(bus):
+    bus.publish([change('autoland', 'open', 'closed'),
+                 change('autoland', 'closed', 'open'),
+                 change('autoland', 'open', 'closed'),
+                 change('autoland', 'closed', 'open'),
+                 change('autoland', 'open', 'closed')])
+
+    # only the 3 latest events are kept: a client which missed the others
+    # has to start over
+    assert [event['version'] for event in bus.wait(2, 0)] == [3, 4, 5]
+    assert bus.wait(1, 0) is None
+    assert bus.wait(0, 0) is None
+    assert bus.wait(5, 0) == []
+
+
+def test_events_stream_reset(app, bus, monkeypatch):
+    import treestatus_api.api
+
+    bus.publish([change('autoland')] * 5)
+
+    # the client is told to reset its last event id, and to get all the trees
+    # again once it reconnects
+    stream = treestatus_api.api._tree_events_stream(1, None)
+    assert next(stream).startswith('retry: ')
+    assert next(stream) == 'id\nevent: reset\ndata: {}\n\n'
+    assert list(stream) == []
+
+
+def test_events_stream(app, bus, monkeypatch):
+    import treestatus_api.api
+    import treestatus_api.config
+
+    monkeypatch.setattr(treestatus_api.config, 'EVENTS_HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(treestatus_api.config, 'EVENTS_STREAM_DURATION', 0.2)
+    bus.publish([change('autoland')])
+
+    stream = list(treestatus_api.api._tree_events_stream(0, [dict(tree='autoland')]))
+    assert stream[0].startswith('retry: ')
+    assert stream[1] == 'id: 0\nevent: trees\ndata: [{"tree": "autoland"}]\n\n'
+    id, event, data = stream[2].splitlines()[:3]
+    assert (id, event) == ('id: 1', 'event: change')
+    assert json.loads(data[len('data: '):])['tree']['tree'] == 'autoland'
+    assert set(stream[3:]) == {': heartbeat\n\n'}
+
+
+def test_get_tree_events_lost(app, client, trees, bus):
+    bus.publish([change('autoland')] * 5)
+
+    # with an event id which is too old, the stream starts with all the trees
+    response = client.get('/events/trees', headers=[('Last-Event-ID', '1')], buffered=False)
+    try:
+        assert response.status_code == 200
+        chunks = iter(response.response)
+        assert next(chunks).decode('utf-8').startswith('retry: ')
+        trees_event = next(chunks).decode('utf-8')
+        assert trees_event.startswith('id: 5\nevent: trees\n')
+    finally:
+        response.close()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import json
+
+import pytest
+import pytz
+
+START = datetime.datetime(2019, 3, 1, tzinfo=pytz.UTC)
+
+
+@pytest.fixture
+def logs(db, trees):
+    '''Log 7 changes of autoland, a few of them at the same date, and one of
+       mozilla-central; return the reasons of the autoland ones, most recent
+       first
+    '''
+    import treestatus_api.models
+
+    for i, minutes in enumerate([0, 1, 1, 1, 2, 3, 3]):
+        db.session.add(treestatus_api.models.Log(
+            tree='autoland', when=START + datetime.timedelta(minutes=minutes), who='test/user@mozilla.com',
+            status='closed' if i % 2 else 'open', reason=f'reason {i}', tags=['bustage'] if i % 2 else []))
+    db.session.add(treestatus_api.models.Log(
+        tree='mozilla-central', when=START, who='test/user@mozilla.com', status='closed', reason='other tree', tags=[]))
+    db.session.commit()
+
+    # by date, then by id for the same date
+    return ['reason 6', 'reason 5', 'reason 4', 'reason 3', 'reason 2', 'reason 1', 'reason 0']
+
+
+def get_logs(client, tree='autoland', **params):
+    response = client.get(f'/trees/{tree}/logs', query_string=dict(dict(all=0), **params))
+    assert response.status_code == 200, response.data
+    return json.loads(response.data.decode('utf-8'))
+
+
+def reasons(response):
+    return [log['reason'] for log in response['result']]
+
+
+def test_get_logs_summary(client, logs):
+    import treestatus_api.api
+
+    response = get_logs(client)
+    assert reasons(response) == logs[:treestatus_api.api.TREE_SUMMARY_LOG_LIMIT]
+    assert response['next'] is not None
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 10])
+def test_get_logs_pages(client, logs, limit):
+    pages = [get_logs(client, limit=limit)]
+    while pages[-1]['next'] is not None:
+        assert len(pages[-1]['result']) == limit
+        pages.append(get_logs(client, limit=limit, before=pages[-1]['next']))
+
+    # the changes logged at the same date are neither lost nor repeated
+    assert sum([reasons(page) for page in pages], []) == logs
+    assert len(pages) == max(1, -(-len(logs) // limit))
+
+
+def test_get_logs_before_new_log(client, db, logs):
+    import treestatus_api.models
+
+    first = get_logs(client, limit=4)
+
+    # the cursor is still valid when more changes are logged
+    db.session.add(treestatus_api.models.Log(
+        tree='autoland', when=START + datetime.timedelta(days=1), who='test/user@mozilla.com',
+        status='open', reason='later', tags=[]))
+    db.session.commit()
+
+    assert reasons(get_logs(client, limit=4, before=first['next'])) == logs[4:]
+    assert reasons(get_logs(client, limit=1)) == ['later']
+
+
+@pytest.mark.parametrize('before', ['garbage', '12-ab', '-', '1' * 40 + '-1'])
+def test_get_logs_invalid_cursor(client, logs, before):
+    response = client.get('/trees/autoland/logs', query_string=dict(all=0, before=before))
+    assert response.status_code == 400
+
+
+def test_get_logs_unknown_tree(client, logs):
+    assert client.get('/trees/unknown/logs?all=0').status_code == 404
+
+
+def test_get_logs_all(client, logs):
+    import flask
+    import treestatus_api.models
+
+    response = client.get('/trees/autoland/logs', query_string={'all': 1})
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'application/json'
+
+    # the same document as the JSON of all the logs at once
+    Log = treestatus_api.models.Log
+    all_logs = Log.query.filter_by(tree='autoland').order_by(Log.when.desc(), Log.id.desc())
+    expected = flask.json.dumps(dict(result=[log.to_dict() for log in all_logs], next=None))
+    assert json.loads(response.data.decode('utf-8')) == json.loads(expected)
+    assert reasons(json.loads(expected)) == logs
+
+
+def test_get_logs_all_empty(client, trees):
+    response = client.get('/trees/autoland/logs', query_string={'all': 1})
+    assert json.loads(response.data.decode('utf-8')) == dict(result=[], next=None)
+
+
+def test_get_logs_all_paged(client, logs):
+    # a page is returned as usual when one is asked along with all the logs
+    response = get_logs(client, all=1, limit=2)
+    assert reasons(response) == logs[:2]
+    assert response['next'] is not None
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest.mock
+
+import pytest
+
+
+class Notified(list):
+    '''The changes notified, in order, and how many times those of a target
+       and tree fail before they're sent.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.failures = dict()
+
+
+@pytest.fixture
+def notified(app, trees, monkeypatch):
+    '''Record the notifications sent to statuspage and pulse, in order
+    '''
+    import treestatus_api.notifications
+
+    for key, value in (('STATUSPAGE_ENABLE', True),
+                       ('PULSE_TREESTATUS_ENABLE', True),
+                       ('STATUSPAGE_COMPONENTS', {tree: f'{tree}-component' for tree in trees}),
+                       ('STATUSPAGE_TOKEN', 'token'),
+                       ('STATUSPAGE_PAGE_ID', 'page'),
+                       ('STATUSPAGE_NOTIFY_ON_ERROR', 'sheriffs@mozilla.com')):
+        monkeypatch.setitem(app.config, key, value)
+
+    notified = Notified()
+    failures = notified.failures
+
+    def notify(target):
+        def notify(self, tree, status_from, status_to, tags):
+            if failures.get((target, tree['tree'])):
+                failures[(target, tree['tree'])] -= 1
+                raise Exception(f'{target} is down')
+            notified.append((target, tree['tree'], status_from, status_to))
+        return notify
+
+    monkeypatch.setattr(treestatus_api.notifications._Batch, 'notify_statuspage', notify('statuspage'))
+    monkeypatch.setattr(treestatus_api.notifications._Batch, 'notify_pulse', notify('pulse'))
+    monkeypatch.setattr(app, 'notify', unittest.mock.Mock())
+    return notified
+
+
+@pytest.fixture
+def now(monkeypatch):
+    '''Let a test move the time of the notifications forward
+    '''
+    import treestatus_api.notifications
+
+    class Clock(object):
+        value = datetime.datetime(2019, 1, 1, tzinfo=datetime.timezone.utc)
+
+        def advance(self, seconds):
+            self.value += datetime.timedelta(seconds=seconds)
+
+    clock = Clock()
+    monkeypatch.setattr(treestatus_api.notifications, '_now', lambda: clock.value)
+    return clock
+
+
+def queue(db, tree, *statuses):
+    import treestatus_api.models
+    import treestatus_api.notifications
+
+    tree = db.session.query(treestatus_api.models.Tree).get(tree)
+    changes = []
+    for status_from, status_to in zip(statuses, statuses[1:]):
+        tree.status = status_to
+        changes.append((tree, status_from, status_to))
+    treestatus_api.notifications.queue(db.session, changes, ['tag'])
+    db.session.commit()
+
+
+def outbox(db):
+    import treestatus_api.models
+
+    Notification = treestatus_api.models.Notification
+    return [(n.target, n.tree, n.status_from, n.status_to, n.attempts)
+            for n in db.session.query(Notification).order_by(Notification.id)]
+
+
+def test_drain(db, notified, now):
+    import treestatus_api.notifications
+
+    # each change is sent to pulse, while statuspage only gets the status
+    # the tree ends up in
+    queue(db, 'autoland', 'open', 'closed', 'open', 'closed')
+    queue(db, 'mozilla-central', 'open', 'closed', 'open')
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert [n for n in notified if n[0] == 'pulse'] == [
+        ('pulse', 'autoland', 'open', 'closed'),
+        ('pulse', 'autoland', 'closed', 'open'),
+        ('pulse', 'autoland', 'open', 'closed'),
+        ('pulse', 'mozilla-central', 'open', 'closed'),
+        ('pulse', 'mozilla-central', 'closed', 'open'),
+    ]
+    # not at all when the tree ends up in the status it started from
+    assert [n for n in notified if n[0] == 'statuspage'] == [
+        ('statuspage', 'autoland', 'open', 'closed'),
+    ]
+    assert outbox(db) == []
+    assert treestatus_api.notifications.drain(db.session) is None
+
+
+def test_drain_batches(db, notified, now):
+    import treestatus_api.notifications
+
+    queue(db, 'autoland', 'open', 'closed', 'open', 'closed')
+    while treestatus_api.notifications.drain(db.session, batch_size=2) == 0:
+        pass
+    assert [n for n in notified if n[0] == 'pulse'] == [
+        ('pulse', 'autoland', 'open', 'closed'),
+        ('pulse', 'autoland', 'closed', 'open'),
+        ('pulse', 'autoland', 'open', 'closed'),
+    ]
+    assert outbox(db) == []
+
+
+def test_drain_retry(db, notified, now):
+    import treestatus_api.config
+    import treestatus_api.notifications
+
+    delay = treestatus_api.config.NOTIFICATIONS_RETRY_DELAY
+    notified.failures[('pulse', 'autoland')] = 3
+    queue(db, 'autoland', 'open', 'closed', 'open')
+    queue(db, 'mozilla-central', 'open', 'closed')
+
+    # the failed notification is retried with an exponential backoff, along
+    # with the following ones of the tree, while the others are sent
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert ('pulse', 'mozilla-central', 'open', 'closed') in notified
+    assert [n for n in outbox(db) if n[0] == 'pulse'] == [
+        ('pulse', 'autoland', 'open', 'closed', 1),
+        ('pulse', 'autoland', 'closed', 'open', 1),
+    ]
+    for attempt in (1, 2):
+        assert treestatus_api.notifications.drain(db.session) == delay * 2 ** (attempt - 1)
+        now.advance(delay * 2 ** (attempt - 1))
+        assert treestatus_api.notifications.drain(db.session) == 0
+    assert outbox(db)[0][4] == 3
+    assert not [n for n in notified if n[:2] == ('pulse', 'autoland')]
+
+    now.advance(delay * 4)
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert [n for n in notified if n[:2] == ('pulse', 'autoland')] == [
+        ('pulse', 'autoland', 'open', 'closed'),
+        ('pulse', 'autoland', 'closed', 'open'),
+    ]
+    assert outbox(db) == []
+
+
+def test_drain_retry_order(db, notified, now):
+    import treestatus_api.config
+    import treestatus_api.notifications
+
+    # the notifications of a tree queued after one which awaits a retry wait
+    # for it, even in another batch
+    notified.failures[('pulse', 'autoland')] = 1
+    queue(db, 'autoland', 'open', 'closed')
+    assert treestatus_api.notifications.drain(db.session) == 0
+    queue(db, 'autoland', 'closed', 'open')
+    queue(db, 'mozilla-central', 'open', 'closed')
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert [n for n in notified if n[0] == 'pulse'] == [('pulse', 'mozilla-central', 'open', 'closed')]
+
+    now.advance(treestatus_api.config.NOTIFICATIONS_RETRY_DELAY)
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert [n for n in notified if n[:2] == ('pulse', 'autoland')] == [
+        ('pulse', 'autoland', 'open', 'closed'),
+        ('pulse', 'autoland', 'closed', 'open'),
+    ]
+
+
+def test_drain_give_up(app, db, notified, now, monkeypatch):
+    import treestatus_api.config
+    import treestatus_api.notifications
+
+    # the sheriffs are told about the statuspage incidents which couldn't be
+    # created
+    monkeypatch.setattr(treestatus_api.config, 'NOTIFICATIONS_MAX_ATTEMPTS', 2)
+    notified.failures[('statuspage', 'autoland')] = 2
+    queue(db, 'autoland', 'open', 'closed')
+    assert treestatus_api.notifications.drain(db.session) == 0
+    assert not app.notify.email.called
+
+    now.advance(treestatus_api.config.NOTIFICATIONS_RETRY_DELAY)
+    assert treestatus_api.notifications.drain(db.session) == 0
+    app.notify.email.assert_called_once()
+    email = app.notify.email.call_args[0][0]
+    assert email['address'] == 'sheriffs@mozilla.com'
+    assert email['subject'] == '[treestatus] Error when creating statuspage incident'
+    assert 'autoland' in email['content']
+    assert outbox(db) == []
+
+
+def test_drain_notifications_command(app, db, notified, now):
+    import treestatus_api.cli
+
+    queue(db, 'autoland', 'open', 'closed')
+    result = app.test_cli_runner().invoke(treestatus_api.cli.cmd_drain_notifications, [])
+    assert result.exit_code == 0
+    assert ('statuspage', 'autoland', 'open', 'closed') in notified
+    assert outbox(db) == []
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import datetime
+import json
+
+import pytest
+import pytz
+
+import backend_common.testing
+
+START = datetime.datetime(2019, 3, 1, tzinfo=pytz.UTC)
+
+
+@pytest.fixture
+def changes(db, trees):
+    '''Remember 7 changes of the trees, a few of them at the same date;
+       return their reasons, most recent first
+    '''
+    import treestatus_api.models
+
+    for i, minutes in enumerate([0, 1, 1, 1, 2, 3, 3]):
+        change = treestatus_api.models.StatusChange(
+            who='test/user@mozilla.com', reason=f'reason {i}', status='closed',
+            when=START + datetime.timedelta(minutes=minutes))
+        for tree in trees[:i % 2 + 1]:
+            change.trees.append(treestatus_api.models.StatusChangeTree(
+                tree=tree, last_state=json.dumps(dict(status='open', reason=''))))
+        db.session.add(change)
+    db.session.commit()
+
+    # by date, then by id for the same date
+    return ['reason 6', 'reason 5', 'reason 4', 'reason 3', 'reason 2', 'reason 1', 'reason 0']
+
+
+@contextlib.contextmanager
+def statements(db):
+    '''Record the SQL statements run in the block
+    '''
+    import sqlalchemy as sa
+
+    recorded = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append(statement)
+
+    sa.event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield recorded
+    finally:
+        sa.event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def get_stack(client, **params):
+    response = client.get('/stack', query_string=params)
+    assert response.status_code == 200, response.data
+    return json.loads(response.data.decode('utf-8'))
+
+
+def reasons(response):
+    return [change['reason'] for change in response['result']]
+
+
+def test_get_stack(client, trees, changes):
+    response = get_stack(client)
+    assert reasons(response) == changes
+    assert response['next'] is None
+    assert response['result'][0]['trees'] == trees[:1]
+    assert response['result'][1]['trees'] == trees
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 7, 10])
+def test_get_stack_pages(client, changes, limit):
+    pages = [get_stack(client, limit=limit)]
+    while pages[-1]['next'] is not None:
+        assert len(pages[-1]['result']) == limit
+        pages.append(get_stack(client, limit=limit, before=pages[-1]['next']))
+
+    # the changes at the same date are neither lost nor repeated
+    assert sum([reasons(page) for page in pages], []) == changes
+    assert len(pages) == max(1, -(-len(changes) // limit))
+
+
+def test_get_stack_before(client, changes):
+    cursor = get_stack(client, limit=2)['next']
+    assert reasons(get_stack(client, before=cursor)) == changes[2:]
+
+
+@pytest.mark.parametrize('before', ['garbage', '12-ab', '-', '1' * 40 + '-1'])
+def test_get_stack_invalid_cursor(client, changes, before):
+    assert client.get('/stack', query_string=dict(before=before)).status_code == 400
+
+
+def test_get_stack_page_queries(client, db, changes):
+    # a page is read with a limit, and the trees of its changes at once
+    with statements(db) as recorded:
+        get_stack(client, limit=2, before=get_stack(client, limit=2)['next'])
+    changes_statements = [s for s in recorded if 'FROM releng_treestatus_changes' in s]
+    assert len(changes_statements) == 2
+    assert all('LIMIT' in s for s in changes_statements)
+    assert len([s for s in recorded if 'FROM releng_treestatus_change_trees' in s]) == 2
+
+
+def test_get_stack_cache(client, db, trees, changes, monkeypatch):
+    import treestatus_api.api
+    import treestatus_api.config
+
+    monkeypatch.setattr(treestatus_api.api, '_shared_cache', lambda: True)
+
+    # only the whole stack is cached
+    assert reasons(get_stack(client)) == changes
+    with statements(db) as recorded:
+        assert reasons(get_stack(client)) == changes
+        assert not [s for s in recorded if 'FROM releng_treestatus_changes' in s]
+        assert reasons(get_stack(client, limit=2)) == changes[:2]
+        assert [s for s in recorded if 'FROM releng_treestatus_changes' in s]
+
+    # and it changes along with the trees
+    body = dict(trees=['autoland'], status='closed', reason='later', tags=['bustage'], remember=True)
+    headers = [('Authorization', backend_common.testing.build_header(
+        'test/user@mozilla.com', dict(scopes=[treestatus_api.config.SCOPE_TREES_UPDATE])))]
+    response = client.patch('/trees', data=json.dumps(body), content_type='application/json', headers=headers)
+    assert response.status_code == 204, response.data
+    assert reasons(get_stack(client)) == ['later'] + changes
+    assert reasons(get_stack(client, limit=1)) == ['later']
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+import backend_common.testing
+
+
+def auth_header(*scopes):
+    return [('Authorization', backend_common.testing.build_header('test/user@mozilla.com', dict(scopes=list(scopes))))]
+
+
+@pytest.fixture(params=[False, True], ids=['local cache', 'shared cache'])
+def shared_cache(request, monkeypatch):
+    '''Run a test with and without a cache shared by the workers
+    '''
+    import treestatus_api.api
+
+    monkeypatch.setattr(treestatus_api.api, '_shared_cache', lambda: request.param)
+    return request.param
+
+
+def get_trees(client, etag=None):
+    headers = [('If-None-Match', etag)] if etag else []
+    return client.get('/trees', headers=headers)
+
+
+def update_trees(client, **body):
+    import treestatus_api.config
+
+    response = client.patch('/trees', data=json.dumps(body), content_type='application/json',
+                            headers=auth_header(treestatus_api.config.SCOPE_TREES_UPDATE))
+    assert response.status_code == 204, response.data
+
+
+def test_get_trees(client, trees, shared_cache):
+    response = get_trees(client)
+    assert response.status_code == 200
+    result = json.loads(response.data.decode('utf-8'))['result']
+    assert sorted(result) == sorted(trees)
+    assert result['autoland']['status'] == 'open'
+
+    response = client.get('/trees2')
+    assert sorted(tree['tree'] for tree in json.loads(response.data.decode('utf-8'))['result']) == sorted(trees)
+
+
+def test_get_trees_not_modified(client, trees, shared_cache):
+    etag = get_trees(client).headers['ETag']
+    assert etag
+    assert client.get('/trees2').headers['ETag'] == etag
+
+    response = get_trees(client, etag)
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    assert get_trees(client, '"something-else"').status_code == 200
+
+
+def test_get_trees_etag_update(client, trees, shared_cache):
+    etag = get_trees(client).headers['ETag']
+    update_trees(client, trees=['autoland'], status='closed', reason='bustage', tags=['bustage'])
+
+    response = get_trees(client, etag)
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    result = json.loads(response.data.decode('utf-8'))['result']
+    assert result['autoland']['status'] == 'closed'
+    assert result['autoland']['reason'] == 'bustage'
+
+
+def test_get_trees_etag_make_kill(client, trees, shared_cache):
+    import treestatus_api.config
+
+    etag = get_trees(client).headers['ETag']
+    tree = dict(tree='try', status='open', reason='', message_of_the_day='')
+    response = client.put('/trees/try', data=json.dumps(tree), content_type='application/json',
+                          headers=auth_header(treestatus_api.config.SCOPE_TREES_CREATE))
+    assert response.status_code == 204
+
+    response = get_trees(client, etag)
+    assert response.status_code == 200
+    assert 'try' in json.loads(response.data.decode('utf-8'))['result']
+    made = response.headers['ETag']
+    assert made != etag
+
+    response = client.delete('/trees/try', headers=auth_header(treestatus_api.config.SCOPE_TREES_DELETE))
+    assert response.status_code == 204
+    response = get_trees(client, made)
+    assert response.status_code == 200
+    assert 'try' not in json.loads(response.data.decode('utf-8'))['result']
+    assert response.headers['ETag'] != made
+
+
+def test_trees_snapshot_cache(app, client, trees, monkeypatch):
+    import treestatus_api.api
+
+    # only kept in a cache shared by the workers, where the changes of any of
+    # them make it stale
+    for shared, cached in ((False, False), (True, True)):
+        app.cache.clear()
+        monkeypatch.setattr(treestatus_api.api, '_shared_cache', lambda: shared)
+        get_trees(client)
+        assert (app.cache.get(treestatus_api.api.TREES_SNAPSHOT_KEY) is not None) == cached
+
+    version = treestatus_api.api._trees_version()
+    update_trees(client, trees=['autoland'], message_of_the_day='hello')
+    assert treestatus_api.api._trees_version() > version
+
+
+def test_shared_cache(app, monkeypatch):
+    import treestatus_api.api
+
+    assert not treestatus_api.api._shared_cache()
+    monkeypatch.setitem(app.config, 'CACHE', dict(CACHE_TYPE='redis'))
+    assert treestatus_api.api._shared_cache()
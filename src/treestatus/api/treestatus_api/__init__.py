@@ -7,7 +7,9 @@ import os
 
 import backend_common
 import cli_common.taskcluster
+import treestatus_api.cli
 import treestatus_api.config
+import treestatus_api.events
 import treestatus_api.models  # noqa
 
 
@@ -34,6 +36,10 @@ def create_app(config=None):
         os.environ.get('TASKCLUSTER_ACCESS_TOKEN', app.config.get('TASKCLUSTER_ACCESS_TOKEN')),
     )
 
+    treestatus_api.events.bus.init_app(app)
+
     app.api.register(os.path.join(os.path.dirname(__file__), 'api.yml'))
 
+    app.cli.add_command(treestatus_api.cli.cmd_drain_notifications, 'drain-notifications')
+
     return app
@@ -4,12 +4,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import hashlib
 import json
+import time
 
 import flask
 import flask_login
 import pytz
-import requests
 import sqlalchemy as sa
 import werkzeug.exceptions
 
@@ -17,23 +18,18 @@ import backend_common.auth
 import backend_common.cache
 import cli_common.log
 import treestatus_api.config
+import treestatus_api.events
 import treestatus_api.models
+import treestatus_api.notifications
 
 UNSET = object()
 TREE_SUMMARY_LOG_LIMIT = 5
-STATUSPAGE_URL = 'https://api.statuspage.io/v1'
-STATUSPAGE_ERROR_ON_CREATE = '''Hi,
-
-For some reason we weren't able to create an incident for tree `{tree}`.
-
-Please make sure that an incident is open for every closed tree.
-'''
-STATUSPAGE_ERROR_ON_CLOSE = '''Hi,
-
-For some reason we weren't able to close an incident for tree `{tree}`.
-
-Please make sure that an incident is closed for every open (or under approval) tree.
-'''
+TREE_LOG_MAX_LIMIT = 1000
+TREE_LOG_EXPORT_CHUNK_SIZE = 1000
+TREES_VERSION_KEY = 'treestatus:trees:version'
+TREES_SNAPSHOT_KEY = 'treestatus:trees:snapshot'
+STACK_SNAPSHOT_KEY = 'treestatus:stack:snapshot'
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
 
 
 log = cli_common.log.get_logger(__name__)
@@ -51,223 +47,6 @@ def _now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
 
 
-def _statuspage_data(
-    resolved,
-    component_id,
-    tree,
-    status_from,
-    status_to,
-):
-    data = {
-        'status': resolved and 'resolved' or 'investigating',
-        'components': {
-            component_id: resolved and 'operational' or 'major_outage',
-        }
-    }
-    if not resolved:
-        data['name'] = f'Tree {tree.tree} closed'
-        data['component_ids'] = [component_id]
-        data['metadata'] = {
-            'treestatus': {
-                'tree': tree.tree,
-                'status_from': status_from,
-                'status_to': status_to,
-            },
-        }
-        data['body'] = (
-            f'Message of the day: {tree.message_of_the_day}\n'
-            f'Reason: {tree.reason}\n'
-        )
-    return dict(incident=data)
-
-
-def _statuspage_send_email_on_error(subject, content, incident_id=None):
-    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
-    address = flask.current_app.config.get('STATUSPAGE_NOTIFY_ON_ERROR')
-    if not address or not page_id:
-        log.error('STATUSPAGE_NOTIFY_ON_ERROR and/or STATUSPAGE_PAGE_ID not defined in app config.')
-        return
-
-    link = {
-        'href': f'https://manage.statuspage.io/pages/{page_id}',
-        'text': 'Visit statuspage',
-    }
-    if incident_id:
-        link = {
-            'href': f'https://manage.statuspage.io/pages/{page_id}/incidents/{incident_id}',
-            'text': 'Visit statuspage incident',
-        }
-    flask.current_app.notify.email({
-        'address': address,
-        'subject': subject,
-        'content': content,
-        'link': link,
-    })
-
-
-def _statuspage_create_incident(
-    headers,
-    component_id,
-    tree,
-    status_from,
-    status_to,
-):
-    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
-    if not page_id:
-        log.error('STATUSPAGE_PAGE_ID not defined in app config.')
-        return
-
-    data = _statuspage_data(False,
-                            component_id,
-                            tree,
-                            status_from,
-                            status_to,
-                            )
-    log.debug(f'Create statuspage incident for tree `{tree.tree}` under page `{page_id}`', data=data)
-    response = requests.post(
-        f'{STATUSPAGE_URL}/pages/{page_id}/incidents',
-        headers=headers,
-        json=data,
-    )
-    try:
-        response.raise_for_status()
-    except Exception as e:
-        log.exception(e)
-        _statuspage_send_email_on_error(
-            subject=f'[treestatus] Error when creating statuspage incident',
-            content=STATUSPAGE_ERROR_ON_CREATE.format(tree=tree.tree),
-        )
-
-
-def _statuspage_resolve_incident(
-    headers,
-    component_id,
-    tree,
-    status_from,
-    status_to,
-):
-    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
-    response = requests.get(
-        f'{STATUSPAGE_URL}/pages/{page_id}/incidents/unresolved',
-        headers=headers,
-    )
-    try:
-        response.raise_for_status()
-    except Exception as e:
-        log.exception(e)
-        _statuspage_send_email_on_error(
-            subject=f'[treestatus] Error when closing statuspage incident',
-            content=STATUSPAGE_ERROR_ON_CLOSE.format(tree=tree.tree),
-        )
-        return
-
-    # last incident with meta.treestatus.tree == tree.tree
-    incident_id = None
-    incidents = sorted(response.json(), key=lambda x: x['created_at'])
-    for incident in incidents:
-        if 'id' in incident and \
-                'metadata' in incident and \
-                'treestatus' in incident['metadata'] and \
-                'tree' in incident['metadata']['treestatus'] and \
-                incident['metadata']['treestatus']['tree'] == tree.tree:
-            incident_id = incident['id']
-            break
-
-    if incident_id is None:
-        log.error(f'No incident found when closing tree `{tree.tree}`')
-        _statuspage_send_email_on_error(
-            subject=f'[treestatus] Error when closing statuspage incident',
-            content=STATUSPAGE_ERROR_ON_CLOSE.format(tree=tree.tree),
-        )
-        return
-
-    response = requests.patch(
-        f'{STATUSPAGE_URL}/pages/{page_id}/incidents/{incident_id}',
-        headers=headers,
-        json=_statuspage_data(True,
-                              component_id,
-                              tree,
-                              status_from,
-                              status_to,
-                              ),
-    )
-    try:
-        response.raise_for_status()
-    except Exception as e:
-        log.exception(e)
-        _statuspage_send_email_on_error(
-            subject=f'[treestatus] Error when closing statuspage incident',
-            content=STATUSPAGE_ERROR_ON_CLOSE.format(tree=tree.tree),
-            incident_id=incident_id,
-        )
-
-
-def _notify_status_change(trees_changes, tags=[]):
-    if flask.current_app.config.get('STATUSPAGE_ENABLE'):
-        log.debug('Notify statuspage about trees changes.')
-
-        components = flask.current_app.config.get('STATUSPAGE_COMPONENTS', {})
-        token = flask.current_app.config.get('STATUSPAGE_TOKEN')
-        if not token:
-            log.error('STATUSPAGE_PAGE_ID not defined in app config.')
-        else:
-            headers = {'Authorization': f'OAuth {token}'}
-
-            for tree_change in trees_changes:
-                tree, status_from, status_to = tree_change
-
-                if tree.tree not in components.keys():
-                    continue
-
-                log.debug(f'Notify statuspage about: {tree.tree}')
-                component_id = components[tree.tree]
-
-                # create an accident
-                if status_from in ['open', 'approval required'] and status_to == 'closed':
-                    _statuspage_create_incident(headers,
-                                                component_id,
-                                                tree,
-                                                status_from,
-                                                status_to,
-                                                )
-
-                # close an accident
-                elif status_from == 'closed' and status_to in ['open', 'approval required']:
-                    _statuspage_resolve_incident(headers,
-                                                 component_id,
-                                                 tree,
-                                                 status_from,
-                                                 status_to,
-                                                 )
-
-    if flask.current_app.config.get('PULSE_TREESTATUS_ENABLE'):
-        routing_key_pattern = 'tree/{0}/status_change'
-        exchange = flask.current_app.config.get('PULSE_TREESTATUS_EXCHANGE')
-
-        for tree_change in trees_changes:
-            tree, status_from, status_to = tree_change
-
-            payload = {'status_from': status_from,
-                       'status_to': status_to,
-                       'tree': tree.to_dict(),
-                       'tags': tags}
-            routing_key = routing_key_pattern.format(tree.tree)
-
-            log.info(
-                'Sending pulse to {} for tree: {}'.format(
-                    exchange,
-                    tree.tree,
-                ))
-
-            try:
-                flask.current_app.pulse.publish(exchange, routing_key, payload)
-            except Exception as e:
-                import traceback
-                msg = 'Can\'t send notification to pulse.'
-                trace = traceback.format_exc()
-                log.error('{0}\nException:{1}\nTraceback: {2}'.format(msg, e, trace))  # noqa
-
-
 def _update_tree_status(session, tree, status=None, reason=None, tags=[],
                         message_of_the_day=None):
     '''Update the given tree's status; note that this does not commit
@@ -296,6 +75,140 @@ def _update_tree_status(session, tree, status=None, reason=None, tags=[],
         session.add(log)
 
     backend_common.cache.cache.delete_memoized(v0_get_tree, tree.tree)
+    # callers invalidate the snapshot again once the session is committed,
+    # so that one built from the database in between isn't kept
+    _invalidate_trees_snapshot()
+
+
+def _shared_cache():
+    '''Whether the cache is shared by all the workers, which the snapshots of
+       the trees and of the change stack are only kept in: with caches of
+       their own, e.g. the simple cache, workers would each have a version of
+       the trees, and keep snapshots which the others made stale.
+    '''
+    return flask.current_app.config.get('CACHE', {}).get('CACHE_TYPE') == 'redis'
+
+
+def _trees_version():
+    return backend_common.cache.cache.get(TREES_VERSION_KEY) or 0
+
+
+def _invalidate_trees_snapshot():
+    '''Bump the version of the trees, which makes the cached snapshot stale.
+    '''
+    if _shared_cache():
+        # flask-caching only exposes inc() on its backend
+        backend_common.cache.cache.cache.inc(TREES_VERSION_KEY)
+
+
+def _get_trees_snapshot():
+    '''Return the snapshot of all the trees, a dict with the list of the trees
+       and their version, building it if the cached one is stale, or if there
+       is no shared cache.
+    '''
+    shared = _shared_cache()
+    version = _trees_version() if shared else 0
+    snapshot = backend_common.cache.cache.get(TREES_SNAPSHOT_KEY) if shared else None
+    if snapshot is not None and snapshot['version'] == version:
+        return snapshot
+
+    # the version is read before the trees, so that the snapshot is stale
+    # if they are changed while it is being built
+    session = flask.current_app.db.session
+    trees = [t.to_dict() for t in session.query(treestatus_api.models.Tree)]
+    digest = hashlib.md5(json.dumps(trees, sort_keys=True).encode('utf-8')).hexdigest()
+    snapshot = dict(
+        version=version,
+        # the digest keeps the etag unique if the version is reset, e.g.
+        # when the cache is flushed, or without a shared cache
+        etag=f'{version}-{digest[:16]}',
+        trees=trees,
+    )
+    if shared:
+        backend_common.cache.cache.set(TREES_SNAPSHOT_KEY, snapshot)
+    return snapshot
+
+
+def _trees_response(result):
+    '''Serve the trees built by `result` from the snapshot, or an empty 304
+       response if the client already has its version.
+    '''
+    snapshot = _get_trees_snapshot()
+    headers = {'ETag': f'"{snapshot["etag"]}"'}
+    if flask.request.if_none_match.contains(snapshot['etag']):
+        return None, 304, headers
+    return result(snapshot['trees']), 200, headers
+
+
+def _tree_event(tree, status_from, tags=[]):
+    return dict(
+        tree=tree.to_dict(),
+        status_from=status_from,
+        status_to=tree.status,
+        tags=tags,
+    )
+
+
+def _publish_tree_events(trees_events):
+    try:
+        treestatus_api.events.bus.publish(trees_events)
+    except Exception as e:
+        log.exception('Failed to publish tree status changes', error=e)
+
+
+def _server_sent_event(event, version, data):
+    return f'id: {version}\nevent: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def _tree_events_stream(version, trees):
+    yield f'retry: {treestatus_api.config.EVENTS_RETRY}\n\n'
+    if trees is not None:
+        yield _server_sent_event('trees', version, trees)
+
+    deadline = time.monotonic() + treestatus_api.config.EVENTS_STREAM_DURATION
+    while time.monotonic() < deadline:
+        events = treestatus_api.events.bus.wait(version, treestatus_api.config.EVENTS_HEARTBEAT_INTERVAL)
+        if events is None:
+            # some events were missed: reset the last event id of the client,
+            # which gets all the trees again once it reconnects
+            yield 'id\nevent: reset\ndata: {}\n\n'
+            return
+        if not events:
+            yield ': heartbeat\n\n'
+        for event in events:
+            version = event['version']
+            yield _server_sent_event('change', version, event)
+
+
+def get_tree_events(since=None):
+    '''Stream the tree status changes as server-sent events, starting with
+       all the trees unless the client gives the version of the last event it
+       got, with `since` or the Last-Event-ID header.
+    '''
+    if since is None:
+        try:
+            since = int(flask.request.headers.get('Last-Event-ID'))
+        except (TypeError, ValueError):
+            pass
+
+    bus = treestatus_api.events.bus
+    trees = None
+    if since is None or since > bus.version() or bus.wait(since, 0) is None:
+        # the version is read before the trees, so that no change is missed
+        since = bus.version()
+        trees = _get_trees_snapshot()['trees']
+        # don't hold a database connection for the whole stream
+        flask.current_app.db.session.remove()
+
+    return flask.Response(
+        _tree_events_stream(since, trees),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # don't let nginx buffer the events
+            'X-Accel-Buffering': 'no',
+        },
+    )
 
 
 @backend_common.cache.cache.memoize()
@@ -307,15 +220,11 @@ def v0_get_tree(tree, format=None):
 
 
 def get_trees():
-    session = flask.current_app.db.session
-    return dict(result={
-        t.tree: t.to_dict()
-        for t in session.query(treestatus_api.models.Tree)
-    })
+    return _trees_response(lambda trees: dict(result={t['tree']: t for t in trees}))
 
 
 def get_trees2():
-    return dict(result=[i for i in get_trees()['result'].values()])
+    return _trees_response(lambda trees: dict(result=trees))
 
 
 @backend_common.auth.auth.require_permissions([treestatus_api.config.SCOPE_TREES_UPDATE])
@@ -359,6 +268,7 @@ def update_trees(body):
     new_tags = _get(body, 'tags', [])
 
     trees_status_change = []
+    trees_events = []
 
     for tree in trees:
         current_status = tree.status
@@ -370,10 +280,13 @@ def update_trees(body):
                             )
         if new_status and current_status != new_status:
             trees_status_change.append((tree, current_status, new_status))
+        trees_events.append(_tree_event(tree, current_status, new_tags))
 
+    treestatus_api.notifications.queue(session, trees_status_change, new_tags)
     session.commit()
-
-    _notify_status_change(trees_status_change, new_tags)
+    _invalidate_trees_snapshot()
+    treestatus_api.notifications.wake()
+    _publish_tree_events(trees_events)
 
     return None, 204
 
@@ -393,6 +306,7 @@ def make_tree(tree, body):
         session.commit()
     except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
         raise werkzeug.exceptions.BadRequest('tree already exists')
+    _invalidate_trees_snapshot()
     return None, 204
 
 
@@ -407,6 +321,7 @@ def _kill_tree(tree):
     treestatus_api.models.StatusChangeTree.query.filter_by(tree=tree).delete()
     session.commit()
     backend_common.cache.cache.delete_memoized(v0_get_tree, tree)
+    _invalidate_trees_snapshot()
 
 
 @backend_common.auth.auth.require_permissions([treestatus_api.config.SCOPE_TREES_DELETE])
@@ -422,22 +337,82 @@ def kill_trees(trees):
     return None, 204
 
 
-def get_logs(tree, all=0):
+def _utc(when):
+    '''Return a datetime in UTC, assuming naive ones already are, as the
+       dates of the cursors are.
+    '''
+    if when.tzinfo is None:
+        return when.replace(tzinfo=pytz.UTC)
+    return when.astimezone(pytz.UTC)
+
+
+def _cursor(when, id):
+    '''Return the cursor of a log or change, which is URL-safe: the number of
+       microseconds since the epoch of its date, a dash, and its id.
+    '''
+    return f'{(_utc(when) - EPOCH) // datetime.timedelta(microseconds=1)}-{id}'
+
+
+def _parse_cursor(cursor):
+    '''Return the date, in UTC, and the id of a cursor.
+    '''
+    try:
+        when, id = cursor.rsplit('-', 1)
+        return EPOCH + datetime.timedelta(microseconds=int(when)), int(id)
+    except (ValueError, OverflowError):
+        raise werkzeug.exceptions.BadRequest(f'Invalid cursor {cursor}')
+
+
+def _export_logs(q):
+    '''Stream all the logs of a query as the JSON response of get_logs,
+       without loading them all in memory.
+    '''
+    Log = treestatus_api.models.Log
+    q = q.with_entities(Log.tree, Log.when, Log.who, Log.status, Log.reason, Log._tags)
+
+    yield '{"result": ['
+    separator = ''
+    for tree, when, who, status, reason, tags in q.yield_per(TREE_LOG_EXPORT_CHUNK_SIZE):
+        log = flask.json.dumps(dict(tree=tree, when=when, who=who, status=status, reason=reason))
+        # tags are stored as JSON already
+        yield f'{separator}{log[:-1]}, "tags": {tags}}}'
+        separator = ', '
+    yield '], "next": null}'
+
+
+def get_logs(tree, all=0, limit=None, before=None):
+    '''Return the logs of a tree, most recent first, a page at a time.
+
+       Pages are of `limit` entries, and the next one starts `before` the
+       cursor which comes with the previous one.  Without a page, all the
+       logs are returned if `all` is set, as a stream, or only the most recent
+       ones otherwise.
+    '''
     session = flask.current_app.db.session
+    Log = treestatus_api.models.Log
 
     # verify the tree exists first
     t = session.query(treestatus_api.models.Tree).get(tree)
     if not t:
         raise werkzeug.exceptions.NotFound('No such tree')
 
-    logs = []
-    q = session.query(treestatus_api.models.Log).filter_by(tree=tree)
-    q = q.order_by(treestatus_api.models.Log.when.desc())
-    if not all:
-        q = q.limit(TREE_SUMMARY_LOG_LIMIT)
+    q = session.query(Log).filter(Log.tree == tree)
+    q = q.order_by(Log.when.desc(), Log.id.desc())
+
+    if all and limit is None and before is None:
+        return flask.Response(flask.stream_with_context(_export_logs(q)),
+                              mimetype='application/json')
 
-    logs = [l.to_dict() for l in q]
-    return dict(result=logs)
+    if before is not None:
+        q = q.filter(sa.tuple_(Log.when, Log.id) < sa.tuple_(*_parse_cursor(before)))
+    limit = min(limit or TREE_SUMMARY_LOG_LIMIT, TREE_LOG_MAX_LIMIT)
+
+    # one more log tells whether there is a next page
+    logs = q.limit(limit + 1).all()
+    return dict(
+        result=[log.to_dict() for log in logs[:limit]],
+        next=_cursor(logs[limit - 1].when, logs[limit - 1].id) if len(logs) > limit else None,
+    )
 
 
 def v0_get_trees(format):
@@ -448,13 +423,53 @@ def get_tree(tree):
     return dict(result=v0_get_tree(tree))
 
 
-def get_stack():
+def _stack_query():
+    StatusChange = treestatus_api.models.StatusChange
+    q = StatusChange.query.options(sa.orm.selectinload(StatusChange.trees))
+    return q.order_by(StatusChange.when.desc(), StatusChange.id.desc())
+
+
+def _get_stack_snapshot():
+    '''Return the snapshot of the whole change stack, most recent first,
+       which changes along with the trees, and so has the same version.
+    '''
+    shared = _shared_cache()
+    version = _trees_version() if shared else 0
+    snapshot = backend_common.cache.cache.get(STACK_SNAPSHOT_KEY) if shared else None
+    if snapshot is not None and snapshot['version'] == version:
+        return snapshot
+
+    snapshot = dict(
+        version=version,
+        changes=[change.to_dict() for change in _stack_query()],
+    )
+    if shared:
+        backend_common.cache.cache.set(STACK_SNAPSHOT_KEY, snapshot)
+    return snapshot
+
+
+def get_stack(limit=None, before=None):
+    '''Return the change stack, most recent first, a page at a time if
+       `limit` is set, the next one starting `before` the cursor which comes
+       with the previous one.
+    '''
+    # only the whole stack is cached, the pages are read from the database
+    if limit is None and before is None:
+        return dict(result=_get_stack_snapshot()['changes'], next=None)
+
+    StatusChange = treestatus_api.models.StatusChange
+    q = _stack_query()
+    if before is not None:
+        q = q.filter(sa.tuple_(StatusChange.when, StatusChange.id) < sa.tuple_(*_parse_cursor(before)))
+    if limit is None:
+        return dict(result=[change.to_dict() for change in q], next=None)
+
+    # one more change tells whether there is a next page
+    limit = min(limit, TREE_LOG_MAX_LIMIT)
+    changes = q.limit(limit + 1).all()
     return dict(
-        result=[
-            i.to_dict()
-            for i in treestatus_api.models.StatusChange.query.order_by(
-                treestatus_api.models.StatusChange.when.desc())
-        ]
+        result=[change.to_dict() for change in changes[:limit]],
+        next=_cursor(changes[limit - 1].when, changes[limit - 1].id) if len(changes) > limit else None,
     )
 
 
@@ -468,6 +483,7 @@ def _revert_change(id, revert=None):
         raise werkzeug.exceptions.NotFound
 
     trees_status_change = []
+    trees_events = []
 
     if revert:
         for chtree in ch.trees:
@@ -487,11 +503,14 @@ def _revert_change(id, revert=None):
             if last_state['status'] and current_status != last_state['status']:
                 trees_status_change.append(
                     (tree, current_status, last_state['status']))
+            trees_events.append(_tree_event(tree, current_status))
 
     session.delete(ch)
+    treestatus_api.notifications.queue(session, trees_status_change)
     session.commit()
-
-    _notify_status_change(trees_status_change)
+    _invalidate_trees_snapshot()
+    treestatus_api.notifications.wake()
+    _publish_tree_events(trees_events)
 
     return None, 204
 
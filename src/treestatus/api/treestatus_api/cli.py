@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import click
+import flask
+
+import treestatus_api.notifications
+
+
+@click.command()
+@flask.cli.with_appcontext
+def cmd_drain_notifications():
+    '''Send the notifications of tree status changes which are due, e.g. from
+    cron when the background worker is disabled with NOTIFICATIONS_WORKER.
+    '''
+    while treestatus_api.notifications.drain(flask.current_app.db.session) == 0:
+        pass
@@ -11,3 +11,24 @@ SCOPE_TREES_UPDATE = f'{SCOPE_PREFIX}/trees/update'
 SCOPE_TREES_CREATE = f'{SCOPE_PREFIX}/trees/create'
 SCOPE_TREES_DELETE = f'{SCOPE_PREFIX}/trees/delete'
 SCOPE_REVERT_CHANGES = f'{SCOPE_PREFIX}/recent_changes/revert'
+
+# Notifications of tree status changes are sent by a background worker, in
+# batches of NOTIFICATIONS_BATCH_SIZE, and retried with an exponential backoff
+# starting at NOTIFICATIONS_RETRY_DELAY seconds.
+NOTIFICATIONS_BATCH_SIZE = 50
+NOTIFICATIONS_MAX_ATTEMPTS = 10
+NOTIFICATIONS_RETRY_DELAY = 30
+NOTIFICATIONS_MAX_RETRY_DELAY = 60 * 60
+NOTIFICATIONS_POLL_INTERVAL = 60
+# notifications are claimed by a worker for this many seconds, after which
+# another worker sends those it didn't
+NOTIFICATIONS_CLAIM_TIMEOUT = 5 * 60
+
+# Tree status changes are streamed to the clients as server-sent events; the
+# latest EVENTS_HISTORY_SIZE are kept for the clients which reconnect, and
+# streams are ended after EVENTS_STREAM_DURATION seconds, the clients
+# reconnecting EVENTS_RETRY milliseconds later.
+EVENTS_HISTORY_SIZE = 1000
+EVENTS_HEARTBEAT_INTERVAL = 15
+EVENTS_STREAM_DURATION = 5 * 60
+EVENTS_RETRY = 1000
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import json
+import threading
+import time
+
+import redis
+
+import cli_common.log
+import treestatus_api.config
+
+VERSION_KEY = 'treestatus:events:version'
+HISTORY_KEY = 'treestatus:events:history'
+CHANNEL = 'treestatus:events'
+
+# versions are assigned, and events kept and published, in a single script,
+# which redis runs atomically, so that events are published in the order of
+# their versions; ARGV[1] is the JSON of the change, without its braces
+PUBLISH_SCRIPT = '''
+local version = redis.call('INCR', KEYS[1])
+local data = '{"version": ' .. version
+if ARGV[1] ~= '' then
+    data = data .. ', ' .. ARGV[1]
+end
+data = data .. '}'
+redis.call('RPUSH', KEYS[2], data)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('PUBLISH', ARGV[3], data)
+return version
+'''
+
+log = cli_common.log.get_logger(__name__)
+
+
+class EventBus(object):
+    '''Fan out the tree status changes to the clients watching them.
+
+       Each change is an event with a version, which increases monotonically,
+       and which clients use as a cursor.  The latest events are kept in
+       memory, and the watchers of a process wait for new ones on a condition,
+       so that they cost no queries.
+
+       When the cache is a redis one, events are published on a redis channel,
+       to which a single thread of each process listens, and the latest ones
+       are also kept in redis, so that they are shared by all the processes.
+       Otherwise, they are only seen by the process they were published from.
+    '''
+
+    def __init__(self, size=treestatus_api.config.EVENTS_HISTORY_SIZE):
+        self.size = size
+        self.redis = None
+        self._publish_script = None
+        self._events = collections.deque(maxlen=size)
+        self._version = 0
+        self._condition = threading.Condition()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def init_app(self, app):
+        cache = app.config.get('CACHE', {})
+        if cache.get('CACHE_TYPE') == 'redis':
+            self.redis = redis.StrictRedis.from_url(cache['CACHE_REDIS_URL'])
+            self._publish_script = self.redis.register_script(PUBLISH_SCRIPT)
+
+    def _receive(self, event):
+        with self._condition:
+            if event['version'] > self._version:
+                self._events.append(event)
+                self._version = event['version']
+                self._condition.notify_all()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # subscribed first, so that no event is missed in between
+                for data in self.redis.lrange(HISTORY_KEY, 0, -1):
+                    self._receive(json.loads(data))
+                for message in pubsub.listen():
+                    self._receive(json.loads(message['data']))
+            except Exception as e:
+                log.exception('Lost the treestatus events channel', error=e)
+                time.sleep(1)
+
+    def _start_listener(self):
+        if self.redis is None:
+            return
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, daemon=True)
+                self._listener.start()
+
+    def publish(self, changes):
+        '''Publish tree status changes, a list of dicts with the new state of
+           the tree, and its status before and after the change.
+        '''
+        for change in changes:
+            if self.redis is None:
+                with self._condition:
+                    self._receive(dict(change, version=self._version + 1))
+                continue
+
+            self._publish_script(
+                keys=[VERSION_KEY, HISTORY_KEY],
+                args=[json.dumps(change)[1:-1], self.size, CHANNEL],
+            )
+
+    def version(self):
+        '''Return the version of the latest event.
+        '''
+        self._start_listener()
+        if self.redis is not None:
+            return int(self.redis.get(VERSION_KEY) or 0)
+        with self._condition:
+            return self._version
+
+    def wait(self, since, timeout):
+        '''Return the events which came after version `since`, waiting up to
+           `timeout` seconds for one if there is none yet, or None if some of
+           them are not known anymore.
+        '''
+        self._start_listener()
+        with self._condition:
+            self._condition.wait_for(lambda: self._version > since, timeout)
+            events = [event for event in self._events if event['version'] > since]
+            if events and events[0]['version'] != since + 1:
+                return None
+            return events
+
+
+bus = EventBus()
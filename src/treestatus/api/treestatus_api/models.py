@@ -59,13 +59,18 @@ class Log(db.Model):
     __tablename__ = 'releng_treestatus_log'
 
     id = sa.Column(sa.Integer, primary_key=True)
-    tree = sa.Column(sa.String(32), nullable=False, index=True)
+    tree = sa.Column(sa.String(32), nullable=False)
     when = sa.Column(UTCDateTime, nullable=False, index=True)
     who = sa.Column(sa.Text, nullable=False)
     status = sa.Column(sa.String(64), nullable=False)
     reason = sa.Column(sa.Text, nullable=False)
     _tags = sa.Column('tags', sa.Text, nullable=False)
 
+    __table_args__ = (
+        # the log of a tree is paginated by (when, id), most recent first
+        sa.Index('releng_treestatus_log_tree_when_id', tree, when.desc(), id.desc()),
+    )
+
     def __init__(self, tags=None, **kwargs):
         if tags is not None:
             kwargs['_tags'] = json.dumps(tags)
@@ -118,3 +123,29 @@ class StatusChangeTree(db.Model):
     last_state = sa.Column(sa.Text, nullable=False)
 
     stack = relation(StatusChange, backref='trees')
+
+
+class Notification(db.Model):
+    '''A tree status change, in the outbox of the statuspage or pulse
+       notifications (see treestatus_api.notifications).
+    '''
+
+    __tablename__ = 'releng_treestatus_notifications'
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    target = sa.Column(sa.String(32), nullable=False)
+    tree = sa.Column(sa.String(32), nullable=False)
+    status_from = sa.Column(sa.String(64), nullable=False)
+    status_to = sa.Column(sa.String(64), nullable=False)
+    _payload = sa.Column('payload', sa.Text, nullable=False)
+    attempts = sa.Column(sa.Integer, default=0, nullable=False)
+    next_attempt = sa.Column(UTCDateTime, nullable=False, index=True)
+
+    def __init__(self, payload=None, **kwargs):
+        if payload is not None:
+            kwargs['_payload'] = json.dumps(payload)
+        super(Notification, self).__init__(**kwargs)
+
+    @hybrid_property
+    def payload(self):
+        return json.loads(self._payload)
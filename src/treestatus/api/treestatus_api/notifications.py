@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import datetime
+import threading
+
+import flask
+import pytz
+import requests
+import sqlalchemy as sa
+
+import cli_common.log
+import treestatus_api.config
+import treestatus_api.models
+
+STATUSPAGE_URL = 'https://api.statuspage.io/v1'
+STATUSPAGE_ERROR_ON_CREATE = '''Hi,
+
+For some reason we weren't able to create an incident for tree `{tree}`.
+
+Please make sure that an incident is open for every closed tree.
+'''
+STATUSPAGE_ERROR_ON_CLOSE = '''Hi,
+
+For some reason we weren't able to close an incident for tree `{tree}`.
+
+Please make sure that an incident is closed for every open (or under approval) tree.
+'''
+TARGET_STATUSPAGE = 'statuspage'
+TARGET_PULSE = 'pulse'
+
+log = cli_common.log.get_logger(__name__)
+
+_wakeup = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+
+
+def _statuspage_data(
+    resolved,
+    component_id,
+    tree,
+    status_from,
+    status_to,
+):
+    data = {
+        'status': resolved and 'resolved' or 'investigating',
+        'components': {
+            component_id: resolved and 'operational' or 'major_outage',
+        }
+    }
+    if not resolved:
+        data['name'] = f'Tree {tree["tree"]} closed'
+        data['component_ids'] = [component_id]
+        data['metadata'] = {
+            'treestatus': {
+                'tree': tree['tree'],
+                'status_from': status_from,
+                'status_to': status_to,
+            },
+        }
+        data['body'] = (
+            f'Message of the day: {tree["message_of_the_day"]}\n'
+            f'Reason: {tree["reason"]}\n'
+        )
+    return dict(incident=data)
+
+
+def _statuspage_send_email_on_error(subject, content, incident_id=None):
+    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
+    address = flask.current_app.config.get('STATUSPAGE_NOTIFY_ON_ERROR')
+    if not address or not page_id:
+        log.error('STATUSPAGE_NOTIFY_ON_ERROR and/or STATUSPAGE_PAGE_ID not defined in app config.')
+        return
+
+    link = {
+        'href': f'https://manage.statuspage.io/pages/{page_id}',
+        'text': 'Visit statuspage',
+    }
+    if incident_id:
+        link = {
+            'href': f'https://manage.statuspage.io/pages/{page_id}/incidents/{incident_id}',
+            'text': 'Visit statuspage incident',
+        }
+    flask.current_app.notify.email({
+        'address': address,
+        'subject': subject,
+        'content': content,
+        'link': link,
+    })
+
+
+def _statuspage_create_incident(
+    headers,
+    component_id,
+    tree,
+    status_from,
+    status_to,
+):
+    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
+    if not page_id:
+        log.error('STATUSPAGE_PAGE_ID not defined in app config.')
+        return
+
+    data = _statuspage_data(False,
+                            component_id,
+                            tree,
+                            status_from,
+                            status_to,
+                            )
+    log.debug(f'Create statuspage incident for tree `{tree["tree"]}` under page `{page_id}`', data=data)
+    response = requests.post(
+        f'{STATUSPAGE_URL}/pages/{page_id}/incidents',
+        headers=headers,
+        json=data,
+    )
+    response.raise_for_status()
+
+
+def _statuspage_unresolved_incidents(headers):
+    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
+    response = requests.get(
+        f'{STATUSPAGE_URL}/pages/{page_id}/incidents/unresolved',
+        headers=headers,
+    )
+    response.raise_for_status()
+    return sorted(response.json(), key=lambda x: x['created_at'])
+
+
+def _statuspage_resolve_incident(
+    headers,
+    incidents,
+    component_id,
+    tree,
+    status_from,
+    status_to,
+):
+    page_id = flask.current_app.config.get('STATUSPAGE_PAGE_ID')
+
+    # last incident with meta.treestatus.tree == tree.tree
+    incident_id = None
+    for incident in incidents:
+        if 'id' in incident and \
+                'metadata' in incident and \
+                'treestatus' in incident['metadata'] and \
+                'tree' in incident['metadata']['treestatus'] and \
+                incident['metadata']['treestatus']['tree'] == tree['tree']:
+            incident_id = incident['id']
+            break
+
+    if incident_id is None:
+        log.error(f'No incident found when closing tree `{tree["tree"]}`')
+        _statuspage_send_email_on_error(
+            subject=f'[treestatus] Error when closing statuspage incident',
+            content=STATUSPAGE_ERROR_ON_CLOSE.format(tree=tree['tree']),
+        )
+        return
+
+    response = requests.patch(
+        f'{STATUSPAGE_URL}/pages/{page_id}/incidents/{incident_id}',
+        headers=headers,
+        json=_statuspage_data(True,
+                              component_id,
+                              tree,
+                              status_from,
+                              status_to,
+                              ),
+    )
+    response.raise_for_status()
+
+
+class _Batch(object):
+    '''Notify the changes of a batch of notifications, sharing what can be
+       between the trees, e.g. the unresolved statuspage incidents.
+    '''
+
+    def __init__(self):
+        self._incidents = None
+
+    def statuspage_headers(self):
+        return {'Authorization': f'OAuth {flask.current_app.config.get("STATUSPAGE_TOKEN")}'}
+
+    def incidents(self):
+        if self._incidents is None:
+            self._incidents = _statuspage_unresolved_incidents(self.statuspage_headers())
+        return self._incidents
+
+    def notify_statuspage(self, tree, status_from, status_to, tags):
+        if not flask.current_app.config.get('STATUSPAGE_TOKEN'):
+            log.error('STATUSPAGE_TOKEN not defined in app config.')
+            return
+
+        log.debug(f'Notify statuspage about: {tree["tree"]}')
+        component_id = flask.current_app.config.get('STATUSPAGE_COMPONENTS', {})[tree['tree']]
+
+        # create an accident
+        if status_from in ['open', 'approval required'] and status_to == 'closed':
+            _statuspage_create_incident(self.statuspage_headers(),
+                                        component_id,
+                                        tree,
+                                        status_from,
+                                        status_to,
+                                        )
+
+        # close an accident
+        elif status_from == 'closed' and status_to in ['open', 'approval required']:
+            _statuspage_resolve_incident(self.statuspage_headers(),
+                                         self.incidents(),
+                                         component_id,
+                                         tree,
+                                         status_from,
+                                         status_to,
+                                         )
+
+    def notify_pulse(self, tree, status_from, status_to, tags):
+        exchange = flask.current_app.config.get('PULSE_TREESTATUS_EXCHANGE')
+        routing_key = 'tree/{0}/status_change'.format(tree['tree'])
+        payload = {'status_from': status_from,
+                   'status_to': status_to,
+                   'tree': tree,
+                   'tags': tags}
+
+        log.info(
+            'Sending pulse to {} for tree: {}'.format(
+                exchange,
+                tree['tree'],
+            ))
+        flask.current_app.pulse.publish(exchange, routing_key, payload)
+
+    def give_up(self, target, tree, status_from, status_to):
+        if target != TARGET_STATUSPAGE:
+            return
+        if status_to == 'closed':
+            _statuspage_send_email_on_error(
+                subject=f'[treestatus] Error when creating statuspage incident',
+                content=STATUSPAGE_ERROR_ON_CREATE.format(tree=tree['tree']),
+            )
+        else:
+            _statuspage_send_email_on_error(
+                subject=f'[treestatus] Error when closing statuspage incident',
+                content=STATUSPAGE_ERROR_ON_CLOSE.format(tree=tree['tree']),
+            )
+
+
+def queue(session, trees_changes, tags=[]):
+    '''Add the notifications of tree status changes to the outbox; note that
+       this does not commit the session, so that they are committed along
+       with the changes.  Call `wake` once committed.
+    '''
+    config = flask.current_app.config
+    targets = []
+    if config.get('STATUSPAGE_ENABLE'):
+        targets.append(TARGET_STATUSPAGE)
+    if config.get('PULSE_TREESTATUS_ENABLE'):
+        targets.append(TARGET_PULSE)
+
+    components = config.get('STATUSPAGE_COMPONENTS', {})
+    now = _now()
+    for tree, status_from, status_to in trees_changes:
+        for target in targets:
+            if target == TARGET_STATUSPAGE and tree.tree not in components:
+                continue
+            session.add(treestatus_api.models.Notification(
+                target=target,
+                tree=tree.tree,
+                status_from=status_from,
+                status_to=status_to,
+                payload=dict(tree=tree.to_dict(), tags=tags),
+                next_attempt=now,
+            ))
+
+
+_Claimed = collections.namedtuple('_Claimed', 'id target tree status_from status_to payload attempts')
+
+
+def _claim(session, batch_size, now):
+    '''Claim a batch of the notifications which are due, by delaying them by
+       NOTIFICATIONS_CLAIM_TIMEOUT seconds, after which they are sent by
+       another worker if this one didn't get to it.
+
+       The notifications of a tree for a target which follow one that isn't
+       due, i.e. which awaits a retry or is claimed by another worker, aren't
+       due either, so that they're sent in order.
+    '''
+    Notification = treestatus_api.models.Notification
+    earlier = sa.orm.aliased(Notification)
+
+    # skip the notifications which another worker is claiming
+    q = session.query(Notification)
+    q = q.filter(Notification.next_attempt <= now)
+    q = q.filter(~sa.exists().where(sa.and_(
+        earlier.target == Notification.target,
+        earlier.tree == Notification.tree,
+        earlier.id < Notification.id,
+        earlier.next_attempt > now,
+    )))
+    q = q.order_by(Notification.id)
+    q = q.limit(batch_size)
+    notifications = q.with_for_update(skip_locked=True).all()
+
+    claimed = []
+    for notification in notifications:
+        claimed.append(_Claimed(
+            notification.id,
+            notification.target,
+            notification.tree,
+            notification.status_from,
+            notification.status_to,
+            notification.payload,
+            notification.attempts,
+        ))
+        notification.next_attempt = now + datetime.timedelta(seconds=treestatus_api.config.NOTIFICATIONS_CLAIM_TIMEOUT)
+    session.commit()
+    return claimed
+
+
+def _sends(target, group):
+    '''Return the changes to send for the notifications of a tree for a
+       target, each with the notifications it covers.
+    '''
+    if target != TARGET_STATUSPAGE:
+        return [([n], n.status_from, n.status_to, n.payload) for n in group]
+
+    # statuspage only needs to know about the status the tree ends up in
+    return [(group, group[0].status_from, group[-1].status_to, group[-1].payload)]
+
+
+def drain(session, batch_size=treestatus_api.config.NOTIFICATIONS_BATCH_SIZE):
+    '''Send a batch of the notifications which are due.
+
+       The notifications are claimed, and the transaction committed, before
+       they are sent, so that no lock is held while waiting for statuspage or
+       pulse.  Each notification is sent to pulse, in order, while those of a
+       tree for statuspage are coalesced into a single change, from the status
+       before the first one to the status after the last one, which isn't
+       notified at all when the tree ends up in the status it started from.
+       Those which fail are retried later, with an exponential backoff, up to
+       NOTIFICATIONS_MAX_ATTEMPTS times, and the following ones of the tree
+       wait for them.
+
+       Returns the number of seconds until the next notification is due, 0 if
+       some may be due already, or None if the outbox is empty.
+    '''
+    Notification = treestatus_api.models.Notification
+    now = _now()
+
+    notifications = _claim(session, batch_size, now)
+    if not notifications:
+        next_attempt = session.query(sa.func.min(Notification.next_attempt)).scalar()
+        session.commit()
+        if next_attempt is None:
+            return None
+        return max(0, (next_attempt - now).total_seconds())
+
+    groups = collections.OrderedDict()
+    for notification in notifications:
+        groups.setdefault((notification.target, notification.tree), []).append(notification)
+
+    batch = _Batch()
+    done = []
+    retries = dict()
+    for (target, tree), group in groups.items():
+        sends = _sends(target, group)
+        while sends:
+            covered, status_from, status_to, payload = sends.pop(0)
+            try:
+                if target != TARGET_STATUSPAGE or status_from != status_to:
+                    getattr(batch, f'notify_{target}')(payload['tree'], status_from, status_to, payload['tags'])
+            except Exception as e:
+                attempts = max(n.attempts for n in covered) + 1
+                log.exception(f'Failed to notify {target} about tree `{tree}`', attempts=attempts, error=e)
+                if attempts < treestatus_api.config.NOTIFICATIONS_MAX_ATTEMPTS:
+                    delay = min(treestatus_api.config.NOTIFICATIONS_RETRY_DELAY * 2 ** (attempts - 1),
+                                treestatus_api.config.NOTIFICATIONS_MAX_RETRY_DELAY)
+                    # keep the notifications of the tree in order
+                    for notification in covered + [n for rest in sends for n in rest[0]]:
+                        retries[notification.id] = (attempts, now + datetime.timedelta(seconds=delay))
+                    break
+                try:
+                    batch.give_up(target, payload['tree'], status_from, status_to)
+                except Exception as e:
+                    log.exception(e)
+            done.extend(notification.id for notification in covered)
+
+    for id, (attempts, next_attempt) in retries.items():
+        q = session.query(Notification).filter(Notification.id == id)
+        q.update(dict(attempts=attempts, next_attempt=next_attempt), synchronize_session=False)
+    if done:
+        q = session.query(Notification).filter(Notification.id.in_(done))
+        q.delete(synchronize_session=False)
+    session.commit()
+    return 0
+
+
+def _run(app):
+    while True:
+        _wakeup.clear()
+        with app.app_context():
+            try:
+                delay = drain(app.db.session)
+            except Exception as e:
+                log.exception('Failed to send notifications', error=e)
+                app.db.session.rollback()
+                delay = treestatus_api.config.NOTIFICATIONS_RETRY_DELAY
+            finally:
+                app.db.session.remove()
+        if delay != 0:
+            # also poll the outbox every now and then, for the notifications
+            # left by other processes
+            _wakeup.wait(min(delay or treestatus_api.config.NOTIFICATIONS_POLL_INTERVAL,
+                             treestatus_api.config.NOTIFICATIONS_POLL_INTERVAL))
+
+
+def wake():
+    '''Have the worker of this process send the notifications, starting it if
+       needed, unless the worker is disabled with NOTIFICATIONS_WORKER, in
+       which case they are sent by the `drain-notifications` command.
+    '''
+    global _worker
+
+    app = flask.current_app._get_current_object()
+    if not app.config.get('NOTIFICATIONS_WORKER', True):
+        return
+
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, args=(app,), daemon=True)
+            _worker.start()
+    _wakeup.set()